@@ -1,4 +1,5 @@
 ''' Module where we place all aggregation functions. '''
+from drought.data.df_extensions import add_year_month_columns, df_month_key
 import ee
 import pandas as pd
 from typing import Callable
@@ -101,14 +102,37 @@ def from_cummulative_8_days_to_daily(ic: ee.ImageCollection,
     return ee.ImageCollection(days.map(aggregate))
 
 
+def group_by_month_key(df: pd.DataFrame, groupby: list[str]):
+    '''
+    Groups df by the groupby columns, where year and month are replaced by
+    their single month_key.
+    '''
+    if 'year' not in groupby or 'month' not in groupby:
+        return df.groupby(groupby)
+    keys = [column for column in groupby if column not in ['year', 'month']]
+    df = df.drop(columns=['year', 'month']).assign(month_key=df_month_key(df))
+    return df.groupby(['month_key', *keys])
+
+
+def with_year_month(df: pd.DataFrame, groupby: list[str]) -> pd.DataFrame:
+    '''
+    Adds back the year and month of grouped data, ordered by the original
+    groupby columns.
+    '''
+    if 'month_key' not in df.columns:
+        return df
+    return add_year_month_columns(df) \
+        .sort_values(groupby, ignore_index=True)
+
+
 def aggregate_monthly_per_polygon(df: pd.DataFrame, aggregator: Callable,
                                   columns: list[str],
                                   groupby: list[str] =
                                   ['month', 'year', 'polygon_id'],
                                   ) -> pd.DataFrame:
     ''' Calculate monthly aggregation for each year-month for each polygon. '''
-    return aggregator(df.groupby(groupby)) \
-        .reset_index()[[*groupby,  *columns]]
+    monthly = aggregator(group_by_month_key(df, groupby)).reset_index()
+    return with_year_month(monthly, groupby)[[*groupby,  *columns]]
 
 
 def aggregate_monthly_per_polygon_across_years(df: pd.DataFrame,
@@ -128,17 +152,19 @@ def get_monthly_means_and_shot_count(df: pd.DataFrame, columns: list[str]) \
     ''' Gets number of shots by month and polygon, joined by the monthly means
     of the data. '''
     index_columns = ['year', 'month', 'polygon_id']
+    grouped = group_by_month_key(df, index_columns)
 
     # Get number of footprints shots per month per year, stored in a 'number'
     # column.
-    shot_distribution = df.groupby(index_columns).count() \
-                          .rename(columns={'pai': 'number'})[['number']]
+    shot_distribution = grouped.count() \
+                               .rename(columns={'pai': 'number'})[['number']]
 
     # Calculate means per polygon per month per year.
-    mean_monthly = df.groupby(index_columns).mean(numeric_only=True)
+    mean_monthly = grouped.mean(numeric_only=True)
 
     # Join the number of shots with data means
-    monthly = shot_distribution.join(mean_monthly).reset_index(
+    monthly = with_year_month(
+        shot_distribution.join(mean_monthly).reset_index(), index_columns
     )[[*columns, *index_columns, 'number']]
 
     return monthly
@@ -146,6 +172,7 @@ def get_monthly_means_and_shot_count(df: pd.DataFrame, columns: list[str]) \
 
 def aggregate_number_of_shots(df: pd.DataFrame) -> pd.DataFrame:
     ''' Gets number of shots by month and polygon. '''
-    return df.groupby(['year', 'month', 'polygon_id']) \
-        .count().reset_index() \
-        .rename(columns={'pai': 'number'})[['year', 'month', 'polygon_id', 'number']]  # noqa: E501
+    index_columns = ['year', 'month', 'polygon_id']
+    grouped = group_by_month_key(df, index_columns)
+    return with_year_month(grouped.count().reset_index(), index_columns) \
+        .rename(columns={'pai': 'number'})[[*index_columns, 'number']]
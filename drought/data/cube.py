@@ -0,0 +1,198 @@
+'''
+Persistent cube of the analysis variables, on shared cell and monthly time
+axes.
+
+A cube is a directory holding an axes.json file and one <variable>.npy
+array of shape (cells, months) per variable. Every array is stored in cell
+major order, so the whole time series of a cell is one contiguous chunk,
+and the arrays are memory mapped when a cube is opened. Slicing a block of
+cells, months and variables only reads the chunks of these cells.
+'''
+from drought.data.df_extensions import df_month_key, month_key, \
+    month_key_to_datetime
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# File describing the axes and the variables of a cube.
+AXES_FILE = 'axes.json'
+
+# Column of the long dataframes holding the cell labels.
+CELL_COLUMN = 'polygon_id'
+
+
+def month_offsets(df: pd.DataFrame, start: pd.Period) -> np.ndarray:
+    ''' Returns the number of months from `start` to each row of df. '''
+    return df_month_key(df).astype(np.int32) \
+        - month_key(start.year, start.month)
+
+
+def save_array(path: str, array: np.ndarray):
+    ''' Saves an array as a .npy file, replacing any older version. '''
+    with open(f'{path}.part', 'wb') as f:
+        np.save(f, array)
+    os.replace(f'{path}.part', path)
+
+
+def build_cube(path: str, sources: list, start: str = None,
+               end: str = None, cells: list = None) -> 'AnalysisCube':
+    '''
+    Builds a cube from long dataframes and returns it opened.
+
+    sources is a list of (df, columns) pairs: the given columns of each df
+    become variables of the cube. Each df needs a polygon_id column and
+    either year and month, or datetime columns. The months of the cube
+    range from start (inclusive) to end (exclusive), and its cells are the
+    given ones, both defaulting to those found in the sources. Months
+    without data are NaN.
+    '''
+    variables = [column for _, columns in sources for column in columns]
+    if len(set(variables)) != len(variables):
+        raise ValueError(f"Variables must come from a single source, \
+                         got {variables}.")
+
+    if cells is None:
+        cells = sorted(set().union(*(df[CELL_COLUMN] for df, _ in sources)))
+    cells = np.asarray(cells, np.int64)
+    if start is None or end is None:
+        keys = np.concatenate([df_month_key(df) for df, _ in sources])
+        months = month_key_to_datetime([keys.min(), keys.max() + 1])
+        start = start or months[0]
+        end = end or months[1]
+    start, end = pd.Period(start, 'M'), pd.Period(end, 'M')
+    n_months = (end - start).n
+
+    os.makedirs(path, exist_ok=True)
+    for df, columns in sources:
+        t = month_offsets(df, start)
+        c = np.searchsorted(cells, df[CELL_COLUMN].values)
+        c[c == len(cells)] = 0
+        # Rows outside of the axes are left out.
+        inside = (t >= 0) & (t < n_months) & (cells[c] == df[CELL_COLUMN])
+        for column in columns:
+            array = np.full((len(cells), n_months), np.nan, np.float32)
+            array[c[inside], t[inside]] = df[column].values[inside]
+            save_array(os.path.join(path, f'{column}.npy'), array)
+
+    axes = {
+        'cells': cells.tolist(),
+        'start': str(start),
+        'n_months': n_months,
+        'variables': variables,
+    }
+    with open(os.path.join(path, AXES_FILE), 'w') as f:
+        json.dump(axes, f)
+    return open_cube(path)
+
+
+def cell_frames(data, cells, variables: list = None, start: str = None,
+                end: str = None):
+    '''
+    Yields a (cell, df) pair for each of the given cells. From a cube, df
+    is read from the contiguous time series of the cell, with a row per
+    month from start (inclusive) to end (exclusive), see to_frame. From a
+    long dataframe, df holds its rows of the cell.
+    '''
+    for cell in cells:
+        if isinstance(data, AnalysisCube):
+            yield cell, data.to_frame([cell], start, end, variables)
+        else:
+            yield cell, data[data[CELL_COLUMN] == cell]
+
+
+def open_cube(path: str) -> 'AnalysisCube':
+    ''' Opens a cube, without reading any of its arrays yet. '''
+    with open(os.path.join(path, AXES_FILE)) as f:
+        axes = json.load(f)
+    return AnalysisCube(path, axes)
+
+
+class AnalysisCube(object):
+    ''' Lazily loaded cell x month x variable cube, see build_cube. '''
+
+    def __init__(self, path: str, axes: dict):
+        self.path = path
+        self.cells = np.asarray(axes['cells'], np.int64)
+        self.months = pd.period_range(axes['start'], periods=axes['n_months'],
+                                      freq='M')
+        self.variables = axes['variables']
+        self.arrays = {}
+
+    def __repr__(self):
+        return f'AnalysisCube({len(self.cells)} cells, ' \
+            f'{self.months[0]} to {self.months[-1]}, {self.variables})'
+
+    def array(self, variable: str) -> np.ndarray:
+        ''' Returns the memory mapped (cells, months) array of a variable. '''
+        if variable not in self.arrays:
+            if variable not in self.variables:
+                raise ValueError(f'Cube has no variable {variable}.')
+            self.arrays[variable] = np.load(
+                os.path.join(self.path, f'{variable}.npy'), mmap_mode='r')
+        return self.arrays[variable]
+
+    def cell_positions(self, cells) -> np.ndarray:
+        ''' Returns the positions of the given cells on the cell axis. '''
+        if cells is None:
+            return np.arange(len(self.cells))
+        cells = np.atleast_1d(np.asarray(cells, np.int64))
+        positions = np.searchsorted(self.cells, cells)
+        positions[positions == len(self.cells)] = 0
+        missing = self.cells[positions] != cells
+        if missing.any():
+            raise ValueError(f'Cube has no cells {cells[missing]}.')
+        return positions
+
+    def month_slice(self, start: str = None, end: str = None) -> slice:
+        ''' Returns the slice of months from start (inclusive) to end. '''
+        first = self.months[0]
+        start = 0 if start is None else (pd.Period(start, 'M') - first).n
+        end = len(self.months) if end is None \
+            else (pd.Period(end, 'M') - first).n
+        return slice(max(start, 0), min(end, len(self.months)))
+
+    def block(self, cells=None, start: str = None, end: str = None,
+              variables: list = None) -> dict:
+        '''
+        Returns the (cells, months) arrays of the variables, for the given
+        cells and months from start (inclusive) to end (exclusive). All
+        cells, months and variables are returned by default.
+        '''
+        positions = self.cell_positions(cells)
+        months = self.month_slice(start, end)
+        return {
+            variable: np.asarray(self.array(variable)[positions, months])
+            for variable in (self.variables if variables is None
+                             else variables)
+        }
+
+    def series(self, cell: int, variable: str, start: str = None,
+               end: str = None) -> pd.Series:
+        ''' Returns the monthly time series of a variable in one cell. '''
+        months = self.month_slice(start, end)
+        position = self.cell_positions(cell)[0]
+        return pd.Series(
+            np.asarray(self.array(variable)[position, months]),
+            index=self.months[months].to_timestamp(), name=variable)
+
+    def to_frame(self, cells=None, start: str = None, end: str = None,
+                 variables: list = None) -> pd.DataFrame:
+        '''
+        Returns a block of the cube as a long dataframe, with one row per
+        cell and month, like the monthly dataframes of the pipeline.
+        '''
+        positions = self.cell_positions(cells)
+        months = self.months[self.month_slice(start, end)]
+        block = self.block(cells, start, end, variables)
+        df = pd.DataFrame({
+            CELL_COLUMN: np.repeat(self.cells[positions], len(months)),
+            'year': np.tile(months.year, len(positions)).astype(np.int16),
+            'month': np.tile(months.month, len(positions)).astype(np.int8),
+            'month_key': np.tile(month_key(months.year, months.month),
+                                 len(positions)),
+            'datetime': np.tile(months.to_timestamp(), len(positions)),
+        })
+        for variable, array in block.items():
+            df[variable] = array.reshape(-1)
+        return df
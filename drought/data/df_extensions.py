@@ -1,5 +1,78 @@
+import numpy as np
 import pandas as pd
 
+# Month keys count the months since January of this year.
+MONTH_KEY_EPOCH = 2000
+
+
+def month_key(year, month) -> np.ndarray:
+    '''
+    Returns the int16 month keys of the given years and months, i.e. the
+    number of months since January of MONTH_KEY_EPOCH.
+    '''
+    year = np.asarray(year, np.int32)
+    month = np.asarray(month, np.int32)
+    return ((year - MONTH_KEY_EPOCH) * 12 + month - 1).astype(np.int16)
+
+
+def datetime_to_month_key(dates) -> np.ndarray:
+    ''' Returns the month keys of the months the given dates fall in. '''
+    dates = pd.DatetimeIndex(dates)
+    return month_key(dates.year, dates.month)
+
+
+def month_key_to_year_month(keys) -> tuple[np.ndarray, np.ndarray]:
+    ''' Returns the years and months of the given month keys. '''
+    years, months = np.divmod(np.asarray(keys, np.int32), 12)
+    return (years + MONTH_KEY_EPOCH).astype(np.int16), \
+        (months + 1).astype(np.int8)
+
+
+def month_key_to_datetime(keys) -> pd.DatetimeIndex:
+    ''' Returns the first day of the months of the given month keys. '''
+    epoch = np.datetime64(f'{MONTH_KEY_EPOCH}-01', 'M')
+    months = epoch + np.asarray(keys, np.int32).astype('timedelta64[M]')
+    return pd.DatetimeIndex(months.astype('datetime64[ns]'))
+
+
+def month_key_to_label(keys) -> np.ndarray:
+    ''' Returns the '%m-%y' labels of the given month keys. '''
+    years, months = month_key_to_year_month(keys)
+    return np.char.add(np.char.add(np.char.zfill(months.astype(str), 2), '-'),
+                       np.char.zfill((years % 100).astype(str), 2))
+
+
+def df_month_key(df: pd.DataFrame) -> np.ndarray:
+    '''
+    Returns the month keys of the rows of df, taken from its month_key,
+    year and month or datetime columns, in this order.
+    '''
+    if 'month_key' in df.columns:
+        return df['month_key'].values
+    if 'year' in df.columns and 'month' in df.columns:
+        return month_key(df['year'], df['month'])
+    return datetime_to_month_key(df['datetime'])
+
+
+def add_month_key_column(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Adds 'month_key' column to the DataFrame df.
+
+    DataFrame must have columns 'year' and 'month', or 'datetime' already.
+    '''
+    df['month_key'] = df_month_key(df)
+    return df
+
+
+def add_year_month_columns(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Adds 'year' and 'month' columns to the DataFrame df.
+
+    DataFrame must have column 'month_key' already.
+    '''
+    df['year'], df['month'] = month_key_to_year_month(df['month_key'])
+    return df
+
 
 def add_date_column(df: pd.DataFrame):
     '''
@@ -8,13 +81,11 @@ def add_date_column(df: pd.DataFrame):
     DataFrame must have columns 'year' and 'month' already.
     '''
     if 'datetime' in df.columns:
-        df['date'] = df.datetime.dt.strftime('%m-%y')
+        df['date'] = month_key_to_label(df_month_key(df[['datetime']]))
     else:
         df = df.sort_values(by=['year', 'month'])
 
-        df['date'] = pd.to_datetime(df['year'].astype(str) +
-                                    df['month'] .astype(str),
-                                    format='%Y%m').dt.strftime('%m-%y')
+        df['date'] = month_key_to_label(df_month_key(df))
     return df
 
 
@@ -24,7 +95,5 @@ def add_datetime_column(df: pd.DataFrame):
 
     DataFrame must have columns 'year' and 'month' already.
     '''
-    df_copy = df.copy()
-    df_copy['day'] = 1
-    df['datetime'] = pd.to_datetime(df_copy[['month', 'day', 'year']])
+    df['datetime'] = month_key_to_datetime(df_month_key(df))
     return df
@@ -0,0 +1,287 @@
+''' Partitioned parquet store of GEDI footprints. '''
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# Footprints are partitioned by product, polygon, year and month.
+PARTITION_COLUMNS = ['polygon_id', 'year', 'month']
+
+# Columns the footprint timestamps can be taken from, in order. The shot
+# times come first, as timestamps of daily shots are those of their window.
+TIME_COLUMNS = ['absolute_time', 'timestamp', 'time_bucket']
+
+# Vertical profile columns, stored as fixed size lists of float32.
+PROFILE_COLUMNS = ['pai_z', 'pavd_z']
+
+# Comparison operators of the (column, op, value) filters.
+FILTER_OPS = {
+    '==': lambda x, v: x == v,
+    '=': lambda x, v: x == v,
+    '!=': lambda x, v: x != v,
+    '<': lambda x, v: x < v,
+    '<=': lambda x, v: x <= v,
+    '>': lambda x, v: x > v,
+    '>=': lambda x, v: x >= v,
+    'in': lambda x, v: x.isin(v),
+    'not in': lambda x, v: ~x.isin(v),
+}
+
+
+def product_path(root: str, product: str) -> str:
+    ''' Returns the directory of one product in the store. '''
+    return os.path.join(root, f'product={product}')
+
+
+def with_partition_columns(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Adds the year and month of the footprints if they are missing, taken
+    from the first of TIME_COLUMNS present.
+    '''
+    if 'year' in df.columns and 'month' in df.columns:
+        return df
+    time_column = next(col for col in TIME_COLUMNS if col in df.columns)
+    times = pd.to_datetime(df[time_column])
+    return df.assign(year=times.dt.year, month=times.dt.month)
+
+
+def parse_profile_strings(values) -> pa.FixedSizeListArray:
+    '''
+    Parses profile strings like '[0.5, 0.25, 0.0]', as profiles are stored
+    in the csvs, into a fixed size list array of float32.
+    '''
+    if not isinstance(values, pa.Array):
+        values = pa.array(values, pa.string())
+    strings = pc.replace_substring_regex(values, r'[\[\]\s]', '')
+    lists = pc.split_pattern(strings, ',')
+    lengths = pc.min_max(pc.list_value_length(lists))
+    if lengths['min'] != lengths['max']:
+        raise ValueError(f"Profiles must have the same length, got \
+                         {lengths['min']} to {lengths['max']} values.")
+    values = pc.cast(pc.list_flatten(lists), pa.float32())
+    return pa.FixedSizeListArray.from_arrays(
+        values, max(lengths['max'].as_py() or 0, 1))
+
+
+def profile_array(matrix: np.ndarray) -> pa.FixedSizeListArray:
+    ''' Returns an N x bins matrix as a fixed size list array of float32. '''
+    matrix = np.ascontiguousarray(matrix, np.float32)
+    return pa.FixedSizeListArray.from_arrays(
+        pa.array(matrix.reshape(-1)), matrix.shape[1])
+
+
+def profile_values(array) -> np.ndarray:
+    '''
+    Returns a (chunked) array of profiles, either fixed size lists or
+    strings, as an N x bins float32 matrix. The matrix of a single chunk of
+    fixed size lists is a read-only view of its arrow buffer.
+    '''
+    if isinstance(array, pa.ChunkedArray):
+        array = array.chunk(0) if array.num_chunks == 1 \
+            else array.combine_chunks()
+    if pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+        array = parse_profile_strings(array)
+    values = array.flatten().to_numpy(zero_copy_only=False)
+    return values.reshape(len(array), array.type.list_size)
+
+
+def split_profiles(df: pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+    '''
+    Takes the profile columns out of df, whether they hold strings, arrays
+    or are split into column_0, column_1, ... columns as gedi_query_h5.py
+    writes them. Returns the remaining df and a fixed size list array per
+    profile column.
+    '''
+    profiles = {}
+    for column in PROFILE_COLUMNS:
+        split = []
+        while f'{column}_{len(split)}' in df.columns:
+            split.append(f'{column}_{len(split)}')
+        if split:
+            profiles[column] = profile_array(df[split].to_numpy(np.float32))
+            df = df.drop(columns=split)
+        elif column in df.columns and len(df) \
+                and isinstance(df[column].iloc[0], str):
+            profiles[column] = parse_profile_strings(df[column].values)
+            df = df.drop(columns=[column])
+        elif column in df.columns and len(df):
+            profiles[column] = profile_array(np.stack(df[column].values))
+            df = df.drop(columns=[column])
+    return df, profiles
+
+
+class FootprintProfiles(object):
+    '''
+    Profile columns of footprints, loaded only when a column is first
+    requested and returned as N x bins float32 matrices (see
+    profile_values) aligned with the rows of the footprints.
+
+    load returns the arrow array of a column, e.g. by reading it from the
+    store with the filters the footprints were read with.
+    '''
+
+    def __init__(self, columns: list, load):
+        self.columns = list(columns)
+        self.load = load
+        self.matrices = {}
+
+    def __repr__(self):
+        return f'FootprintProfiles({self.columns})'
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.columns
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        if column not in self.columns:
+            raise KeyError(column)
+        if column not in self.matrices:
+            self.matrices[column] = profile_values(self.load(column))
+        return self.matrices[column]
+
+
+def write_footprints(root: str, product: str, df: pd.DataFrame,
+                     name: str, compression: str = 'zstd'):
+    '''
+    Writes footprints into the product's polygon/year/month partitions,
+    one file per partition named after `name`. Writing the same name
+    again replaces these files, so a retried task leaves no duplicates.
+    Profile columns are stored as fixed size lists, see split_profiles.
+    '''
+    df = with_partition_columns(df)
+    df = df.loc[:, ~df.columns.str.startswith('Unnamed')]
+    # Sorted footprints give row groups with tight statistics.
+    sort_columns = [col for col in TIME_COLUMNS if col in df.columns][:1]
+    df = df.sort_values(PARTITION_COLUMNS + sort_columns)
+    df, profiles = split_profiles(df)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for column, array in profiles.items():
+        table = table.append_column(column, array)
+    ds.write_dataset(
+        table,
+        product_path(root, product),
+        format='parquet',
+        partitioning=PARTITION_COLUMNS,
+        partitioning_flavor='hive',
+        basename_template=f'{name}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        file_options=ds.ParquetFileFormat().make_write_options(
+            compression=compression),
+    )
+
+
+def import_csv(csv_path: str, root: str, product: str,
+               chunk_rows: int = 1_000_000):
+    ''' Moves a footprint csv into the store, `chunk_rows` at a time. '''
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    chunks = pd.read_csv(csv_path, index_col=0, chunksize=chunk_rows)
+    for i, chunk in enumerate(chunks):
+        write_footprints(root, product, chunk, f'{name}-{i}')
+
+
+def filter_footprints(df: pd.DataFrame, filters: list) -> pd.DataFrame:
+    ''' Applies (column, op, value) filters to a loaded dataframe. '''
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters or []:
+        mask &= FILTER_OPS[op](df[column], value)
+    return df.loc[mask]
+
+
+def product_dataset(root: str, product: str, filters: list = None):
+    '''
+    Returns the dataset of one product and the expression of filters. Its
+    schema is the union of the schemas of all files, as files written by
+    different tasks may hold different columns.
+    '''
+    path = product_path(root, product)
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    schema = pa.unify_schemas([dataset.schema] + [
+        fragment.physical_schema for fragment in dataset.get_fragments()])
+    dataset = ds.dataset(path, schema=schema, format='parquet',
+                         partitioning='hive')
+    expression = pq.filters_to_expression(filters) if filters else None
+    return dataset, expression
+
+
+def read_footprints(root: str, product: str, columns: list = None,
+                    filters: list = None, profiles: bool = False):
+    '''
+    Reads footprints of one product from the store.
+
+    Only the given columns are read. filters are (column, op, value)
+    tuples that are and-ed, e.g. [('polygon_id', '==', 3),
+    ('year', 'in', [2020, 2021]), ('pai', '>', 0)]. Filters on the
+    partition columns skip whole directories, and filters on other
+    columns skip the row groups whose statistics rule them out.
+
+    With profiles, the profile columns are left out of the dataframe and
+    a FootprintProfiles, which reads them only once they are requested,
+    is returned alongside it.
+    '''
+    dataset, expression = product_dataset(root, product, filters)
+    if not profiles:
+        return dataset.to_table(columns=columns, filter=expression) \
+            .to_pandas()
+
+    names = dataset.schema.names if columns is None else columns
+    profile_columns = [col for col in names if col in PROFILE_COLUMNS]
+    table = dataset.to_table(
+        columns=[col for col in names if col not in profile_columns],
+        filter=expression)
+    load = lambda column: dataset.to_table(  # noqa: E731
+        columns=[column], filter=expression)[column]
+    return table.to_pandas(), FootprintProfiles(profile_columns, load)
+
+
+def iter_footprints(root: str, product: str, columns: list = None,
+                    filters: list = None, batch_rows: int = 1_000_000):
+    '''
+    Yields the footprints of read_footprints with profiles, at most
+    batch_rows at a time, as (df, FootprintProfiles) pairs. The profile
+    matrices are views of the batches.
+    '''
+    dataset, expression = product_dataset(root, product, filters)
+    batches = dataset.to_batches(columns=columns, filter=expression,
+                                 batch_size=batch_rows)
+    for batch in batches:
+        if not batch.num_rows:
+            continue
+        names = batch.schema.names
+        profile_columns = [col for col in names if col in PROFILE_COLUMNS]
+        df = pa.Table.from_batches([batch]).select(
+            [col for col in names if col not in profile_columns]).to_pandas()
+        yield df, FootprintProfiles(profile_columns, batch.column)
+
+
+def read_footprints_or_csv(root: str, product: str, csv_path: str,
+                           columns: list = None,
+                           filters: list = None, profiles: bool = False):
+    '''
+    Reads footprints from the store if the product has been written to
+    it, and from the original csv otherwise. See read_footprints for
+    profiles, which are parsed from the strings of the csv.
+    '''
+    if os.path.isdir(product_path(root, product)):
+        return read_footprints(root, product, columns, filters, profiles)
+
+    # The csv can only skip the columns that are not needed.
+    filter_columns = [column for column, _, _ in filters or []]
+    usecols = None
+    if columns is not None:
+        # Keep the unnamed index column of the csv.
+        usecols = lambda col: (  # noqa: E731
+            col in {*columns, *filter_columns} or col.startswith('Unnamed'))
+    gedi_csv = pd.read_csv(csv_path, index_col=0, usecols=usecols)
+    gedi_csv = filter_footprints(gedi_csv, filters)
+    if columns is not None:
+        gedi_csv = gedi_csv[columns]
+    if not profiles:
+        return gedi_csv
+
+    profile_columns = [col for col in gedi_csv.columns
+                       if col in PROFILE_COLUMNS]
+    strings = {col: gedi_csv.pop(col).values for col in profile_columns}
+    load = lambda column: pa.array(strings[column])  # noqa: E731
+    return gedi_csv, FootprintProfiles(profile_columns, load)
@@ -0,0 +1,105 @@
+import argparse
+import geopandas as gpd
+from utils.constants import LOCAL_DB_FILE
+from utils.gedi_database import GediQueryExecutor, gedi_time_windows
+from utils.local_database import LocalGediDatabase
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape_path",
+                        default="data/polygons/Amazonia_drought_gradient_polygons.shp",  # noqa: E501
+                        type=str, help="path of shapefile")
+    parser.add_argument("--year_range", nargs='+', type=int,
+                        default=[2019, 2023],
+                        help="the range of years [start_year, end_year) to load")  # noqa: E501
+    parser.add_argument("--product_level", type=str, default="level_2b",
+                        help="level of GEDI product to load")
+    parser.add_argument("--fields", nargs='+', type=str, default=[],
+                        help="fields to load for corresponding level of product")  # noqa: E501
+    parser.add_argument("--local_db", type=str, default=str(LOCAL_DB_FILE),
+                        help="path of the local DuckDB warehouse")
+    parser.add_argument("--files", nargs='+', type=str, default=[],
+                        help="load these csv/parquet shards of the query scripts instead of querying the GEDI database")  # noqa: E501
+    parser.add_argument("--chunk_rows", type=int, default=100_000,
+                        help="number of shots fetched and loaded at a time")  # noqa: E501
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of queries to run concurrently")
+    return parser.parse_args()
+
+
+def gedi_load_local(
+    shape_path: str,
+    year_range: list,
+    product_level: str,
+    local_db: str,
+    fields: list = [],
+    files: list = [],
+    chunk_rows: int = 100_000,
+    jobs: int = 1,
+):
+    """
+    Fills the local warehouse with the shots of the polygons, queried from
+    the GEDI database one (polygon, year) task at a time. The shots are
+    loaded unfiltered, so that the query scripts can apply their quality
+    checks to the warehouse as they do to the database.
+
+    If `files` are given, these shards are loaded instead. They must have
+    been queried with the `shot_number` and `absolute_time` fields.
+    """
+    assert product_level in ["level_4a", "level_2b"]
+    local_database = LocalGediDatabase(local_db)
+    if files:
+        n_shots = local_database.load_files(product_level, files)
+        print("files", len(files), "shots", n_shots)
+        return
+
+    shape = gpd.read_file(shape_path)
+    executor = GediQueryExecutor(jobs=jobs)
+
+    QUALITY_FLAG = f"l{product_level.split('_')[1]}_quality_flag"
+    columns = fields + [
+        column
+        for column in ["shot_number", "absolute_time", "lon_lowestmode",
+                       "lat_lowestmode", QUALITY_FLAG]
+        if column not in fields
+    ]
+    tasks = [
+        (polygon_id, window)
+        for window in gedi_time_windows(
+            f"{year_range[0]}-01-01", f"{year_range[1]}-01-01")
+        for polygon_id in shape.id
+    ]
+
+    def load_task(database, task):
+        """Streams the shots of one task into the local warehouse."""
+        polygon_id, (start_time, end_time) = task
+        chunks = database.query_polygons_iter(
+            table_name=product_level,
+            polygons=shape[shape.id == polygon_id],
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            lazy_geometry=True,
+            chunk_rows=chunk_rows,
+        )
+        return sum(local_database.load(product_level, chunk)
+                   for chunk in chunks)
+
+    for task, n_shots in executor.map(load_task, tasks):
+        print("timestamp", task[1][0], "polygon", task[0], "shots", n_shots)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+    gedi_load_local(
+        shape_path=args.shape_path,
+        year_range=args.year_range,
+        product_level=args.product_level,
+        local_db=args.local_db,
+        fields=args.fields,
+        files=args.files,
+        chunk_rows=args.chunk_rows,
+        jobs=args.jobs,
+    )
@@ -1,39 +1,245 @@
-import h5py
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import geopandas as gpd
+import h5py
 import numpy as np
 import pandas as pd
+from footprint_store import write_footprints
+from polygon_join import assign_polygons
+from utils.column_cache import ColumnCache
+from utils.constants import GEDI_L2B_PATH, WGS84
+from utils.granule_index import (
+    BEAMS,
+    GEDI_EPOCH,
+    GranuleIndex,
+    beam_dataset,
+    read_masked,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape_path",
+                        default="data/polygons/Amazonia_drought_gradient_polygons.shp",  # noqa: E501
+                        type=str, help="path of shapefile")
+    parser.add_argument("--h5_path", type=str, default=str(GEDI_L2B_PATH),
+                        help="directory of the GEDI .h5 granules")
+    parser.add_argument("--product_level", type=str, default="level_2b",
+                        help="level of GEDI product of the granules")
+    parser.add_argument("--fields", nargs='+', type=str, default=["pai"],
+                        help="fields to read for corresponding level of product")  # noqa: E501
+    parser.add_argument("--store", type=str, required=True,
+                        help="partitioned footprint store to write the shots into")  # noqa: E501
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of granules to read concurrently")
+    parser.add_argument("--index", type=str, default=None,
+                        help="sidecar granule index to update and read only the granules and track segments over the polygons")  # noqa: E501
+    parser.add_argument("--date_range", nargs=2, type=str, default=None,
+                        help="only ingest the shots of [start_date, end_date)")  # noqa: E501
+    parser.add_argument("--cache", type=str, default=None,
+                        help="directory caching the extracted columns of the granules as memory mapped arrays")  # noqa: E501
+    return parser.parse_args()
+
+
+def read_beam(
+    beam: h5py.Group,
+    quality_flag: str,
+    fields: list,
+    bounds: np.ndarray,
+    segments: list = None,
+) -> pd.DataFrame:
+    """
+    Reads the shots of one beam that pass the quality check and lie in
+    the bounds [min_lon, min_lat, max_lon, max_lat]. Every other field is
+    only read for these shots. With `segments`, a list of [first_row,
+    last_row) ranges, only the shots of these rows are read at all.
+    """
+    quality = beam_dataset(beam, quality_flag)
+    if segments is None:
+        mask = quality[:] == 1
+    else:
+        mask = np.zeros(quality.shape[0], bool)
+        for first, last in segments:
+            mask[first:last] = True
+        mask[mask] = read_masked(quality, mask) == 1
+    lon = read_masked(beam_dataset(beam, "lon_lowestmode"), mask)
+    lat = read_masked(beam_dataset(beam, "lat_lowestmode"), mask)
+    inside = (lon >= bounds[0]) & (lat >= bounds[1]) \
+        & (lon <= bounds[2]) & (lat <= bounds[3])
+    mask[mask] = inside
+    if not mask.any():
+        return None
+
+    data = {"lon_lowestmode": lon[inside], "lat_lowestmode": lat[inside]}
+    for field in ["shot_number", "delta_time", *fields]:
+        data[field] = read_masked(beam_dataset(beam, field), mask)
+    return shots_frame(data)
+
+
+def read_cached(
+    columns: dict,
+    bounds: np.ndarray,
+    segments: dict = None,
+) -> pd.DataFrame:
+    """
+    Selects the cached shots of a granule, see ColumnCache.get, that lie
+    in the bounds, and in the row ranges of `segments` if given, like
+    read_beam does for the shots of the granule itself.
+    """
+    lon, lat = columns["lon_lowestmode"], columns["lat_lowestmode"]
+    mask = (lon >= bounds[0]) & (lat >= bounds[1]) \
+        & (lon <= bounds[2]) & (lat <= bounds[3])
+    if segments is not None:
+        in_segments = np.zeros(len(mask), bool)
+        for beam, rows in segments.items():
+            on_beam = columns["beam"] == BEAMS.index(beam)
+            for first, last in rows:
+                in_segments |= on_beam & (columns["row"] >= first) \
+                    & (columns["row"] < last)
+        mask &= in_segments
+    if not mask.any():
+        return None
+    return shots_frame({
+        column: values[mask] for column, values in columns.items()
+        if column not in ["beam", "row"]
+    })
+
+
+def shots_frame(data: dict) -> pd.DataFrame:
+    """
+    Returns the shots of the read columns as a dataframe, where profiles
+    like pai_z get one column per bin and delta_time becomes the
+    absolute_time of the shots.
+    """
+    columns = {}
+    for column, values in data.items():
+        if values.ndim == 1:
+            columns[column] = values
+        else:
+            for i in range(values.shape[1]):
+                columns[f"{column}_{i}"] = values[:, i]
+    df = pd.DataFrame(columns)
+    df["absolute_time"] = GEDI_EPOCH \
+        + (df.pop("delta_time").values * 1e6).astype("timedelta64[us]")
+    return df
+
+
+def ingest_granule(
+    path: str,
+    segments: dict,
+    polygons: gpd.GeoDataFrame,
+    product_level: str,
+    fields: list,
+    store: str,
+    date_range: list = None,
+    cache: str = None,
+) -> int:
+    """
+    Reads the shots of all beams of a granule that lie in the polygons
+    and writes them into the footprint store. Returns the number of shots
+    written. `segments` maps each beam to the row ranges to read, beams
+    missing from it are skipped, or is None to read all rows of all beams.
+
+    With a `cache`, the shots are read from the granule's cached columns,
+    which are extracted from the granule the first time.
+    """
+    quality_flag = f"l{product_level.split('_')[1]}_quality_flag"
+    bounds = polygons.total_bounds
+    if cache is not None:
+        columns = ColumnCache(cache).get(path, quality_flag, fields)
+        beams = [read_cached(columns, bounds, segments)]
+    else:
+        with h5py.File(path, "r") as granule:
+            beams = [
+                read_beam(granule[beam], quality_flag, fields, bounds,
+                          None if segments is None else segments[beam])
+                for beam in BEAMS
+                if beam in granule and (segments is None or beam in segments)
+            ]
+    beams = [df for df in beams if df is not None]
+    if not beams:
+        return 0
+
+    shots = assign_polygons(pd.concat(beams, ignore_index=True), polygons)
+    if date_range is not None:
+        shots = shots[(shots.absolute_time >= date_range[0])
+                      & (shots.absolute_time < date_range[1])]
+    # Shots with a meaningless pai are dropped, as by gedi_qa_conditions.
+    if "pai" in shots.columns:
+        shots = shots[shots.pai > 0]
+    if shots.empty:
+        return 0
+    name = os.path.splitext(os.path.basename(path))[0]
+    write_footprints(store, product_level, shots, name=name)
+    return shots.shape[0]
+
+
+def gedi_query_h5(
+    shape_path: str,
+    h5_path: str,
+    product_level: str,
+    store: str,
+    fields: list = ["pai"],
+    jobs: int = 1,
+    index: str = None,
+    date_range: list = None,
+    cache: str = None,
+):
+    """
+    Builds a footprint store of the shots within the polygons from raw
+    GEDI granules, without the GEDI database. Granules are read in a pool
+    of `jobs` processes, and the shots of each are written to the store
+    as a whole, so a granule read again replaces its shots.
+
+    With an `index`, new granules are indexed first, and only the track
+    segments crossing the polygons' bounds during `date_range` are read.
+    With a `cache`, the quality filtered columns of the granules are
+    cached there, and later runs read them instead of the granules.
+    """
+    assert product_level in ["level_4a", "level_2b"]
+    polygons = gpd.read_file(shape_path)[["id", "geometry"]].to_crs(WGS84)
+    h5_files = sorted(
+        os.path.join(h5_path, f) for f in os.listdir(h5_path)
+        if f.endswith(".h5")
+    )
+    segments = {path: None for path in h5_files}
+    if index is not None:
+        granule_index = GranuleIndex(index)
+        granule_index.update(h5_files, jobs=jobs)
+        found = granule_index.segments(
+            polygons.total_bounds, *(date_range or [None, None]))
+        segments = {
+            path: {
+                beam: list(zip(rows.first_row, rows.last_row))
+                for beam, rows in granule_segments.groupby("beam")
+            }
+            for path, granule_segments in found.groupby("path")
+        }
+        print("granules", len(segments), "of", len(h5_files))
+
+    ingest = partial(ingest_granule, polygons=polygons,
+                     product_level=product_level, fields=fields, store=store,
+                     date_range=date_range, cache=cache)
+    paths = list(segments)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(ingest, paths, segments.values())
+        for path, n_shots in zip(paths, results):
+            print("granule", os.path.basename(path), "shots", n_shots)
+
 
-DATA_PATH = "/maps/forecol/data/GEDI/level2B"
-h5_files = [f for f in os.listdir(DATA_PATH) if f.endswith(".h5")]
-"""
-NOTE the data can be initiated as follows and then append arrays
-when iterating over h5 files.
-"""
-# data = {
-#     "pai": np.array([]),
-#     "l2b_quality_flag": np.array([]),
-#     "shot_number": np.array([]),
-#     "lon": np.array([]),
-#     "lat": np.array([]),
-# }
-
-for f in h5_files:
-    fname = os.path.join(DATA_PATH, f)
-    granule = h5py.File(fname, "r")
-    qa_check_ok = np.array(granule['BEAM0000']['l2b_quality_flag']) == 1
-    data = {}
-    data["pai"] = np.array(granule['BEAM0000']['pai'])[filter]
-    data["l2b_quality_flag"] = np.array(
-        granule['BEAM0000']['l2b_quality_flag']
-    )[qa_check_ok]
-    data["shot_number"] = np.array(
-        granule['BEAM0000']['geolocation']['shot_number']
-    )[qa_check_ok]
-    data["lon"] = np.array(
-        granule['BEAM0000']['geolocation']['lon_lowestmode']
-    )[qa_check_ok]
-    data["lat"] = np.array(
-        granule['BEAM0000']['geolocation']['lat_lowestmode']
-    )[qa_check_ok]
-    # NOTE the following line can be used to save the data as a csv file
-    df = pd.DataFrame(data)
+if __name__ == "__main__":
+    args = parse_args()
+    print(args)
+    gedi_query_h5(
+        shape_path=args.shape_path,
+        h5_path=args.h5_path,
+        product_level=args.product_level,
+        store=args.store,
+        fields=args.fields,
+        jobs=args.jobs,
+        index=args.index,
+        date_range=args.date_range,
+        cache=args.cache,
+    )
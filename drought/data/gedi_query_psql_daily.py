@@ -1,10 +1,19 @@
 import argparse
 import os
-import numpy as np
-import pandas as pd
 import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
 from datetime import date, timedelta
-from utils.gedi_database import GediDatabase
+from footprint_store import write_footprints
+from utils.gedi_database import (
+    GediQueryExecutor,
+    gedi_plan_windows,
+    gedi_qa_conditions,
+    gedi_time_windows,
+)
+from utils.local_database import LocalGediDatabase
+from utils.shot_index import ShotIndex
+from utils.task_manifest import TaskManifest, concat_csv_shards
 
 
 def parse_args():
@@ -15,7 +24,7 @@ def parse_args():
     parser.add_argument("--start_time", type=str, default="2019-1-1",
                         help="start date of query in the format yyyy-m-d")
     parser.add_argument("--end_time", type=str, default="2022-12-31",
-                        help="end date of query in the format yyyy-m-d")
+                        help="end date of query (inclusive) in the format yyyy-m-d")  # noqa: E501
     parser.add_argument("--time_delta", type=int, default=7,
                         help="time interval to specify the query dates")
     parser.add_argument("--product_level", type=str, default="level_2b",
@@ -24,6 +33,23 @@ def parse_args():
                         help="fields to query for corresponding level of product")  # noqa: E501
     parser.add_argument("--save_path", default="data/interim/",
                         type=str, help="path to save the query result as a csv file")  # noqa: E501
+    parser.add_argument("--chunk_rows", type=int, default=100_000,
+                        help="number of shots fetched and written at a time")  # noqa: E501
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of queries to run concurrently")
+    parser.add_argument("--since", action="store_true",
+                        help="only query windows newer than the last completed one")  # noqa: E501
+    parser.add_argument("--target_rows", type=int, default=None,
+                        help="split or merge the yearly windows to about this many shots per query")  # noqa: E501
+    parser.add_argument("--estimate", type=str, default="explain",
+                        choices=["explain", "count"],
+                        help="how the shots per window are estimated for --target_rows")  # noqa: E501
+    parser.add_argument("--local_db", type=str, default=None,
+                        help="query a local DuckDB warehouse filled by gedi_load_local.py instead of the GEDI database")  # noqa: E501
+    parser.add_argument("--store", type=str, default=None,
+                        help="also write the shots into this partitioned footprint store")  # noqa: E501
+    parser.add_argument("--export", action="store_true",
+                        help="bulk export the shots into parquet shards instead of a csv")  # noqa: E501
     return parser.parse_args()
 
 
@@ -35,75 +61,243 @@ def gedi_query_psql(
     product_level: str,
     save_path: str,
     fields: list = [],
+    chunk_rows: int = 100_000,
+    jobs: int = 1,
+    since: bool = False,
+    export: bool = False,
+    target_rows: int = None,
+    estimate: str = "explain",
+    local_db: str = None,
+    store: str = None,
 ):
     """
     The function can be used to query the GEDI shots at given level,
     fields and polygons.
+
+    Every (polygon, window) task is saved to its own shard and recorded in a
+    manifest next to the shards, so a rerun skips the completed tasks. With
+    `since` set, only windows after the last completed one of each polygon
+    are queried.
+    With `target_rows` set, the windows of every polygon are planned to
+    hold about that many shots each, see `gedi_adaptive_windows`.
+    With `store` set, every shard is also written into that footprint
+    store, partitioned by polygon, year and month, as the product
+    `{product_level}_{time_delta}d`, apart from the monthly shots.
+    With `local_db` set, the shots are queried from that local warehouse.
+    With `export` set, the shots are bulk exported into parquet shards
+    instead, which is much faster for large polygons.
     """
     assert product_level in ["level_4a", "level_2b"]
     shape = gpd.read_file(shape_path)
-    database = GediDatabase()
+    database = LocalGediDatabase(local_db) if local_db else None
+    executor = GediQueryExecutor(jobs=jobs, database=database)
 
     # Load data columns for all GEDI shots of given polygons.
     QUALITY_FLAG = f"l{product_level.split('_')[1]}_quality_flag"
     columns = fields+["shot_number", "lon_lowestmode",
                       "lat_lowestmode", QUALITY_FLAG]
+    if store is not None:
+        # Partition the store by the month of each shot, not of its window.
+        columns.append("absolute_time")
+    # Only shots passing the quality checks are returned by the database.
+    conditions = gedi_qa_conditions(product_level, columns)
 
-    # iterate over time
-    processed_data = gpd.GeoDataFrame(geometry=[])
-    # year_range = range(year_range[0], year_range[1])
-    # month_range = range(1, 13)
     start_time = [int(i) for i in start_time.split('-')]
     end_time = [int(i) for i in end_time.split('-')]
     start_time = date(start_time[0], start_time[1], start_time[2])
     end_time = date(end_time[0], end_time[1], end_time[2])
     time_delta = timedelta(days=time_delta)
 
-    # iterate over each polygon
-    for i in range(len(shape)):
-        start_time_query = start_time
-        while start_time_query < end_time:
-            feature = shape.loc[i]
-            gedi_shots_gdf = database.query(
-                table_name=product_level,
-                columns=columns,
-                geometry=gpd.GeoDataFrame(
-                    geometry=[feature.geometry]).geometry,
-                crs=shape.crs,
-                start_time=start_time_query.strftime("%Y-%m-%d"),
-                end_time=(start_time_query+time_delta).strftime("%Y-%m-%d"),
-                # Get a GeoDataFrame instead of pandas DataFrame
-                use_geopandas=True,
-            )
-            print("timestamp", start_time_query.strftime(
-                "%Y-%m-%d"), "polygon", feature.id)
-            start_time_query += time_delta
-
-            # Check the quality flag of the data product. If PAI is
-            # queried, also make sure it is greater than 0.
-            if "pai" in columns:
-                qa_check_ok = np.logical_and(
-                    gedi_shots_gdf[QUALITY_FLAG] == 1,
-                    gedi_shots_gdf["pai"] > 0,
-                )
-            else:
-                gedi_shots_gdf[QUALITY_FLAG] == 1
-
-            gedi_shots_gdf = gedi_shots_gdf.loc[qa_check_ok]
-            if gedi_shots_gdf.shape[0] == 0:
-                continue
-
-            gedi_shots_gdf["timestamp"] = pd.Timestamp(
-                start_time_query-time_delta)
-            gedi_shots_gdf["polygon_id"] = feature.id
-            gedi_shots_gdf["polygon_spei"] = feature.SPEI
-            processed_data = processed_data.append(gedi_shots_gdf)
-
     if not os.path.exists(save_path):
         os.makedirs(save_path)
-    processed_data.to_csv(
-        os.path.join(save_path, f"gedi_shots_{product_level}_7d_pai.csv")
-    )
+    output_name = f"gedi_shots_{product_level}_{time_delta.days}d"
+    # The monthly script writes the same shots as `product_level`.
+    store_product = f"{product_level}_{time_delta.days}d"
+    output_path = os.path.join(save_path, f"{output_name}_pai.csv")
+    shard_dir = os.path.join(save_path, f"{output_name}_shards")
+    if export:
+        shard_dir = f"{shard_dir}_export"
+    manifest = TaskManifest(os.path.join(shard_dir, "manifest.sqlite"))
+    # A dict, as the lazily built index of a shared Series is not safe to
+    # use from several query threads.
+    polygon_spei = shape.set_index("id").SPEI.to_dict()
+
+    # Windows keep counting from `start_time` when resuming with `since`,
+    # every polygon after its own last completed window.
+    first_window_start = start_time.strftime("%Y-%m-%d")
+    start_times = dict.fromkeys(shape.id, first_window_start)
+    if since:
+        for polygon_id in shape.id:
+            start_times[polygon_id] = manifest.last_window_end(
+                product_level, polygon_id, columns) or first_window_start
+
+    # One task per polygon and window, run `jobs` at a time. Tasks completed
+    # in an earlier run are skipped. Windows are [start, end), so the last
+    # one ends the day after the inclusive `end_time`. Their boundaries stay
+    # on the `time_delta` grid, to keep whole buckets in every window.
+    last_window_end = (end_time + timedelta(days=1)).strftime("%Y-%m-%d")
+    if target_rows is None:
+        windows = {
+            polygon_id: gedi_time_windows(
+                start_times[polygon_id], last_window_end,
+                step_days=time_delta.days, origin=first_window_start)
+            for polygon_id in shape.id
+        }
+    else:
+        windows = gedi_plan_windows(
+            executor, manifest, shape, product_level, columns,
+            start_times, last_window_end, target_rows, estimate,
+            step_days=time_delta.days,
+            origin=first_window_start,
+            conditions=conditions,
+        )
+    tasks = [
+        (polygon_id, window)
+        for polygon_id in shape.id
+        for window in windows[polygon_id]
+        if not manifest.is_done(product_level, polygon_id, window, columns)
+    ]
+
+    # Shots already extracted per polygon, so that re-pulled windows do
+    # not write them again. Kept per field list, like the tasks, as shards
+    # of other fields do not hold these shots.
+    shot_index_dir = os.path.join(
+        shard_dir, "shot_index", manifest.fields_key(columns))
+    shot_indexes = {
+        polygon_id: ShotIndex.load(
+            os.path.join(shot_index_dir, f"{polygon_id}.npy"))
+        for polygon_id in shape.id
+    }
+
+    def query_task(database, task):
+        """
+        Queries the shots of one task, the server assigns every shot to the
+        `time_delta` window (counted from `start_time`) it falls in. The
+        result is streamed in chunks, each of which is appended to the
+        task's shard csv without the shots extracted before.
+        """
+        polygon_id, (window_start, window_end) = task
+        shard_path = os.path.join(
+            shard_dir, f"{polygon_id}_{window_start}_{window_end}.csv")
+        chunks = database.query_polygons_iter(
+            table_name=product_level,
+            polygons=shape[shape.id == polygon_id],
+            start_time=window_start,
+            end_time=window_end,
+            columns=columns,
+            cadence=time_delta,
+            origin=start_time.strftime("%Y-%m-%d"),
+            # Filter on the server, but only transfer lon/lat instead of
+            # the point geometries.
+            lazy_geometry=True,
+            conditions=conditions,
+            chunk_rows=chunk_rows,
+        )
+        n_shots = 0
+        new_shots = []
+        for gedi_shots_gdf in chunks:
+            gedi_shots_gdf = shot_indexes[polygon_id].dedup(gedi_shots_gdf)
+            new_shots.append(gedi_shots_gdf.shot_number.values)
+            gedi_shots_gdf = gedi_shots_gdf.rename(
+                columns={"time_bucket": "timestamp"})
+            gedi_shots_gdf["polygon_spei"] = gedi_shots_gdf.polygon_id.map(
+                polygon_spei)
+
+            # Keep a running index across chunks, as a single to_csv would.
+            gedi_shots_gdf.index = range(
+                n_shots, n_shots + gedi_shots_gdf.shape[0])
+            gedi_shots_gdf.to_csv(
+                f"{shard_path}.part",
+                mode="w" if n_shots == 0 else "a",
+                header=n_shots == 0,
+            )
+            n_shots += gedi_shots_gdf.shape[0]
+
+        # Only complete shards get their final name.
+        if n_shots == 0:
+            if os.path.exists(f"{shard_path}.part"):
+                os.remove(f"{shard_path}.part")
+            return None, 0, []
+        os.replace(f"{shard_path}.part", shard_path)
+        if store is not None:
+            write_footprints(
+                store, store_product, pd.read_csv(shard_path, index_col=0),
+                name=f"daily-{polygon_id}_{window_start}_{window_end}")
+        return shard_path, n_shots, new_shots
+
+    def export_table(table: pa.Table) -> pa.Table:
+        """
+        Post-processes an exported Arrow table like `query_task` does its
+        chunks, so that the shards of both modes share one schema.
+        """
+        table = table.rename_columns([
+            "timestamp" if column == "time_bucket" else column
+            for column in table.column_names
+        ])
+        spei = pd.Series(table["polygon_id"].to_numpy()).map(polygon_spei)
+        return table.append_column(
+            "polygon_spei", pa.array(spei.values, pa.float64()))
+
+    def export_task(database, task):
+        """
+        Exports the shots of one task into the task's parquet shard with a
+        single COPY, without the shots extracted before.
+        """
+        polygon_id, (window_start, window_end) = task
+        shard_path = os.path.join(
+            shard_dir, f"{polygon_id}_{window_start}_{window_end}.parquet")
+        new_shots = []
+
+        def dedup_table(table: pa.Table) -> pa.Table:
+            table = export_table(table)
+            table = table.filter(pa.array(shot_indexes[polygon_id].new_mask(
+                table["shot_number"].to_numpy())))
+            new_shots.append(table["shot_number"].to_numpy())
+            return table
+
+        n_shots = database.export_polygons(
+            f"{shard_path}.part",
+            table_name=product_level,
+            polygons=shape[shape.id == polygon_id],
+            start_time=window_start,
+            end_time=window_end,
+            columns=columns,
+            cadence=time_delta,
+            origin=start_time.strftime("%Y-%m-%d"),
+            lazy_geometry=True,
+            conditions=conditions,
+            transform=dedup_table,
+        )
+        if n_shots == 0:
+            os.remove(f"{shard_path}.part")
+            return None, 0, []
+        os.replace(f"{shard_path}.part", shard_path)
+        if store is not None:
+            write_footprints(
+                store, store_product, pd.read_parquet(shard_path),
+                name=f"daily-{polygon_id}_{window_start}_{window_end}")
+        return shard_path, n_shots, new_shots
+
+    task_fn = export_task if export else query_task
+    try:
+        for task, (shard_path, n_shots, new_shots) in executor.map(
+                task_fn, tasks):
+            print("timestamp", task[1][0], "polygon", task[0],
+                  "shots", n_shots)
+            # Shots count as extracted once their shard is recorded.
+            for shot_numbers in new_shots:
+                shot_indexes[task[0]].add(shot_numbers)
+            manifest.record(
+                product_level, *task, columns, n_shots, shard_path)
+    finally:
+        for polygon_id, shot_index in shot_indexes.items():
+            shot_index.save(
+                os.path.join(shot_index_dir, f"{polygon_id}.npy"))
+
+    # Concatenate all completed shards, including those of earlier runs.
+    if not export:
+        concat_csv_shards(
+            manifest.shards(product_level, columns), output_path)
 
 
 if __name__ == "__main__":
@@ -117,4 +311,12 @@ if __name__ == "__main__":
         product_level=args.product_level,
         save_path=args.save_path,
         fields=args.fields,
+        chunk_rows=args.chunk_rows,
+        jobs=args.jobs,
+        since=args.since,
+        export=args.export,
+        target_rows=args.target_rows,
+        estimate=args.estimate,
+        local_db=args.local_db,
+        store=args.store,
     )
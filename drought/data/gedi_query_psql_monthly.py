@@ -1,8 +1,18 @@
 import argparse
 import os
-import numpy as np
 import geopandas as gpd
-from utils.gedi_database import GediDatabase
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from footprint_store import write_footprints
+from utils.gedi_database import (
+    GediQueryExecutor,
+    gedi_plan_windows,
+    gedi_qa_conditions,
+    gedi_time_windows,
+)
+from utils.local_database import LocalGediDatabase
+from utils.task_manifest import TaskManifest, concat_csv_shards
 
 
 def parse_args():
@@ -19,6 +29,23 @@ def parse_args():
                         help="fields to query for corresponding level of product")  # noqa: E501
     parser.add_argument("--save_path", default="data/interim/",
                         type=str, help="path to save the query result as a csv file")  # noqa: E501
+    parser.add_argument("--chunk_rows", type=int, default=100_000,
+                        help="number of shots fetched and written at a time")  # noqa: E501
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of queries to run concurrently")
+    parser.add_argument("--since", action="store_true",
+                        help="only query windows newer than the last completed one")  # noqa: E501
+    parser.add_argument("--target_rows", type=int, default=None,
+                        help="split or merge the yearly windows to about this many shots per query")  # noqa: E501
+    parser.add_argument("--estimate", type=str, default="explain",
+                        choices=["explain", "count"],
+                        help="how the shots per window are estimated for --target_rows")  # noqa: E501
+    parser.add_argument("--local_db", type=str, default=None,
+                        help="query a local DuckDB warehouse filled by gedi_load_local.py instead of the GEDI database")  # noqa: E501
+    parser.add_argument("--store", type=str, default=None,
+                        help="also write the shots into this partitioned footprint store")  # noqa: E501
+    parser.add_argument("--export", action="store_true",
+                        help="bulk export the shots into parquet shards instead of a csv")  # noqa: E501
     return parser.parse_args()
 
 
@@ -28,73 +55,178 @@ def gedi_query_psql(
     product_level: str,
     save_path: str,
     fields: list = [],
+    chunk_rows: int = 100_000,
+    jobs: int = 1,
+    since: bool = False,
+    export: bool = False,
+    target_rows: int = None,
+    estimate: str = "explain",
+    local_db: str = None,
+    store: str = None,
 ):
     """
     The function can be used to query the GEDI shots at given level,
     fields and polygons.
+
+    Every (polygon, window) task is saved to its own shard and recorded in a
+    manifest next to the shards, so a rerun skips the completed tasks. With
+    `since` set, only windows after the last completed one of each polygon
+    are queried.
+    With `target_rows` set, the windows of every polygon are planned to
+    hold about that many shots each, see `gedi_adaptive_windows`.
+    With `store` set, every shard is also written into that footprint
+    store, partitioned by polygon, year and month.
+    With `local_db` set, the shots are queried from that local warehouse.
+    With `export` set, the shots are bulk exported into parquet shards
+    instead, which is much faster for large polygons.
     """
     assert product_level in ["level_4a", "level_2b"]
     shape = gpd.read_file(shape_path)
-    database = GediDatabase()
+    database = LocalGediDatabase(local_db) if local_db else None
+    executor = GediQueryExecutor(jobs=jobs, database=database)
 
     # Load data columns for all GEDI shots of given polygons.
     QUALITY_FLAG = f"l{product_level.split('_')[1]}_quality_flag"
     columns = fields+["lon_lowestmode", "lat_lowestmode", QUALITY_FLAG]
-
-    # iterate over time
-    processed_data = gpd.GeoDataFrame(geometry=[])
-    year_range = range(year_range[0], year_range[1])
-    month_range = range(1, 13)
-
-    for year in year_range:
-        for month in month_range:
-            start_time = f"{year}-{month}-01"
-            if month == 12:
-                # end of year
-                end_time = f"{year+1}-01-01"
-            else:
-                end_time = f"{year}-{month+1}-01"
-
-            # iterate over each polygon
-            for i in range(len(shape)):
-                feature = shape.loc[i]
-                gedi_shots_gdf = database.query(
-                    table_name=product_level,
-                    columns=columns,
-                    geometry=gpd.GeoDataFrame(
-                        geometry=[feature.geometry]).geometry,
-                    crs=shape.crs,
-                    start_time=start_time,
-                    end_time=end_time,
-                    # Get a GeoDataFrame instead of pandas DataFrame
-                    use_geopandas=True,
-                )
-                print("timestamp", f"{year}-{month}-01", "polygon", feature.id)
-
-                # Check the quality flag of the data product. If PAI is
-                # queried, also make sure it is greater than 0.
-                if "pai" in columns:
-                    qa_check_ok = np.logical_and(
-                        gedi_shots_gdf[QUALITY_FLAG] == 1,
-                        gedi_shots_gdf["pai"] > 0,
-                    )
-                else:
-                    qa_check_ok = gedi_shots_gdf[QUALITY_FLAG] == 1
-
-                gedi_shots_gdf = gedi_shots_gdf.loc[qa_check_ok]
-                if gedi_shots_gdf.shape[0] == 0:
-                    continue
-                gedi_shots_gdf["year"] = year
-                gedi_shots_gdf["month"] = month
-                gedi_shots_gdf["polygon_id"] = feature.id
-                # gedi_shots_gdf["polygon_spei"] = feature.SPEI
-                processed_data = processed_data.append(gedi_shots_gdf)
+    # Only shots passing the quality checks are returned by the database.
+    conditions = gedi_qa_conditions(product_level, columns)
 
     if not os.path.exists(save_path):
         os.makedirs(save_path)
-    processed_data.to_csv(
-        os.path.join(save_path, f"gedi_shots_{product_level}_20230310.csv")
-    )
+    output_path = os.path.join(save_path, f"gedi_shots_{product_level}.csv")
+    shard_dir = os.path.join(save_path, f"gedi_shots_{product_level}_shards")
+    if export:
+        shard_dir = f"{shard_dir}_export"
+    manifest = TaskManifest(os.path.join(shard_dir, "manifest.sqlite"))
+
+    # With `since`, every polygon resumes after its last completed window.
+    first_window_start = f"{year_range[0]}-01-01"
+    start_times = dict.fromkeys(shape.id, first_window_start)
+    if since:
+        for polygon_id in shape.id:
+            start_times[polygon_id] = manifest.last_window_end(
+                product_level, polygon_id, columns) or first_window_start
+
+    # One task per polygon and window, run `jobs` at a time. Tasks completed
+    # in an earlier run are skipped.
+    end_time = f"{year_range[1]}-01-01"
+    if target_rows is None:
+        windows = {
+            polygon_id: gedi_time_windows(start_times[polygon_id], end_time)
+            for polygon_id in shape.id
+        }
+    else:
+        windows = gedi_plan_windows(
+            executor, manifest, shape, product_level, columns,
+            start_times, end_time, target_rows, estimate, step_days=1,
+            conditions=conditions,
+        )
+    tasks = [
+        (polygon_id, window)
+        for polygon_id in shape.id
+        for window in windows[polygon_id]
+        if not manifest.is_done(product_level, polygon_id, window, columns)
+    ]
+
+    def query_task(database, task):
+        """
+        Queries the shots of one task, the server assigns every shot to its
+        month. The result is streamed in chunks, each of which is appended
+        to the task's shard csv.
+        """
+        polygon_id, (start_time, end_time) = task
+        shard_path = os.path.join(
+            shard_dir, f"{polygon_id}_{start_time}_{end_time}.csv")
+        chunks = database.query_polygons_iter(
+            table_name=product_level,
+            polygons=shape[shape.id == polygon_id],
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence="month",
+            # Filter on the server, but only transfer lon/lat instead of
+            # the point geometries.
+            lazy_geometry=True,
+            conditions=conditions,
+            chunk_rows=chunk_rows,
+        )
+        n_shots = 0
+        for gedi_shots_gdf in chunks:
+            gedi_shots_gdf["year"] = gedi_shots_gdf.time_bucket.dt.year
+            gedi_shots_gdf["month"] = gedi_shots_gdf.time_bucket.dt.month
+            gedi_shots_gdf = gedi_shots_gdf.drop(columns=["time_bucket"])
+
+            # Keep a running index across chunks, as a single to_csv would.
+            gedi_shots_gdf.index = range(
+                n_shots, n_shots + gedi_shots_gdf.shape[0])
+            gedi_shots_gdf.to_csv(
+                f"{shard_path}.part",
+                mode="w" if n_shots == 0 else "a",
+                header=n_shots == 0,
+            )
+            n_shots += gedi_shots_gdf.shape[0]
+
+        # Only complete shards get their final name.
+        if n_shots == 0:
+            if os.path.exists(f"{shard_path}.part"):
+                os.remove(f"{shard_path}.part")
+            return None, 0
+        os.replace(f"{shard_path}.part", shard_path)
+        if store is not None:
+            write_footprints(
+                store, product_level, pd.read_csv(shard_path, index_col=0),
+                name=f"monthly-{polygon_id}_{start_time}_{end_time}")
+        return shard_path, n_shots
+
+    def export_table(table: pa.Table) -> pa.Table:
+        """
+        Post-processes an exported Arrow table like `query_task` does its
+        chunks, so that the shards of both modes share one schema.
+        """
+        time_bucket = table["time_bucket"]
+        return table.drop(["time_bucket"]) \
+            .append_column("year", pc.year(time_bucket).cast(pa.int32())) \
+            .append_column("month", pc.month(time_bucket).cast(pa.int32()))
+
+    def export_task(database, task):
+        """
+        Exports the shots of one task into the task's parquet shard with a
+        single COPY.
+        """
+        polygon_id, (start_time, end_time) = task
+        shard_path = os.path.join(
+            shard_dir, f"{polygon_id}_{start_time}_{end_time}.parquet")
+        n_shots = database.export_polygons(
+            f"{shard_path}.part",
+            table_name=product_level,
+            polygons=shape[shape.id == polygon_id],
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence="month",
+            lazy_geometry=True,
+            conditions=conditions,
+            transform=export_table,
+        )
+        if n_shots == 0:
+            os.remove(f"{shard_path}.part")
+            return None, 0
+        os.replace(f"{shard_path}.part", shard_path)
+        if store is not None:
+            write_footprints(
+                store, product_level, pd.read_parquet(shard_path),
+                name=f"monthly-{polygon_id}_{start_time}_{end_time}")
+        return shard_path, n_shots
+
+    task_fn = export_task if export else query_task
+    for task, (shard_path, n_shots) in executor.map(task_fn, tasks):
+        print("timestamp", task[1][0], "polygon", task[0], "shots", n_shots)
+        manifest.record(product_level, *task, columns, n_shots, shard_path)
+
+    # Concatenate all completed shards, including those of earlier runs.
+    if not export:
+        concat_csv_shards(
+            manifest.shards(product_level, columns), output_path)
 
 
 if __name__ == "__main__":
@@ -106,4 +238,12 @@ if __name__ == "__main__":
         product_level=args.product_level,
         save_path=args.save_path,
         fields=args.fields,
+        chunk_rows=args.chunk_rows,
+        jobs=args.jobs,
+        since=args.since,
+        export=args.export,
+        target_rows=args.target_rows,
+        estimate=args.estimate,
+        local_db=args.local_db,
+        store=args.store,
     )
@@ -1,7 +1,19 @@
 import argparse
-import json
-import pandas as pd
 import numpy as np
+import pandas as pd
+from footprint_store import iter_footprints
+from pai_vertical import PROFILE_BINS, bin_heights, parse_profiles
+
+# Statistics computed by vertical_stats, besides quantile heights.
+STATS = ['sum', 'mean', 'max', 'min', 'max_height']
+
+# Statistics of every field when none are given, those of the original
+# analysis. Fields not listed get DEFAULT_FIELD_STATS.
+DEFAULT_STATS = {
+    'pai_z': ['sum', 'mean', 'max', 'min'],
+    'pavd_z': ['mean', 'max', 'min'],
+}
+DEFAULT_FIELD_STATS = ['mean', 'max', 'min']
 
 
 def parse_args():
@@ -11,43 +23,128 @@ def parse_args():
                         type=str, help="path of GEDI data")
     parser.add_argument("--save_path",
                         default="/maps/ys611/drought-with-gedi/data/interim/gedi_shots_level_2b_vertical.csv",  # noqa: E501
-                        help=str, help="path to save the results csv")
+                        type=str, help="path to save the results csv")
+    parser.add_argument("--store", type=str, default=None,
+                        help="footprint store to read the shots from, instead of data_path")  # noqa: E501
+    parser.add_argument("--product", type=str, default="level_2b",
+                        help="product of the footprint store to read")
+    parser.add_argument("--fields", nargs='+', type=str,
+                        default=['pai_z', 'pavd_z'],
+                        help="profile fields to compute the statistics of")
+    parser.add_argument("--stats", nargs='+', type=str, default=None,
+                        help=f"statistics to compute for every field, of {STATS} or quantile heights like height_q50, by default those of DEFAULT_STATS")  # noqa: E501
+    parser.add_argument("--chunk_rows", type=int, default=500_000,
+                        help="number of shots read and written at a time")
     return parser.parse_args()
 
 
-def vertical_stats(x, stat: str):
-    assert stat in ['mean', 'max', 'min', 'sum']
-    x = np.array(json.loads(x))
-    if stat == 'mean':
-        return x[x != 0].mean() if sum(x != 0) != 0 else 0
-    if stat == 'max':
-        return x.max()
-    if stat == 'min':
-        return x[x != 0].min() if sum(x != 0) != 0 else 0
-    if stat == 'sum':
-        return x.sum()
+def vertical_stats(profiles: np.ndarray, stats: list) -> dict:
+    '''
+    Computes statistics of every profile of an N x bins matrix at once:
+    sum, mean and min of its non-zero bins (0 if there are none), max,
+    max_height (the height of the bin of the max), and height_qNN, the
+    height of the bin where the profile's cumulative sum reaches NN% of
+    its sum (NaN if its sum is not positive). Heights are those of the
+    bottom of the bins, see pai_vertical.bin_heights.
+    '''
+    results = {}
+    heights = bin_heights(profiles.shape[1])
+    nonzero = profiles != 0
+    n_nonzero = nonzero.sum(axis=1)
+    totals = profiles.sum(axis=1)
+    cumulative = None
+    for stat in stats:
+        if stat == 'sum':
+            results[stat] = totals
+        elif stat == 'mean':
+            results[stat] = nonzero_means(profiles, nonzero, n_nonzero)
+        elif stat == 'max':
+            results[stat] = profiles.max(axis=1)
+        elif stat == 'min':
+            results[stat] = np.where(
+                n_nonzero != 0,
+                np.where(nonzero, profiles, np.inf).min(axis=1), 0)
+        elif stat == 'max_height':
+            results[stat] = heights[profiles.argmax(axis=1)]
+        elif stat.startswith('height_q'):
+            if cumulative is None:
+                cumulative = profiles.cumsum(axis=1)
+            q = float(stat[len('height_q'):]) / 100
+            reached = cumulative >= q * totals[:, None]
+            results[stat] = np.where(
+                totals > 0, heights[reached.argmax(axis=1)], np.nan)
+        else:
+            raise ValueError(f"Unsupported statistic {stat}. \
+                             Must be one of {STATS} or height_qNN.")
+    return results
+
+
+def nonzero_means(profiles: np.ndarray, nonzero: np.ndarray,
+                  n_nonzero: np.ndarray) -> np.ndarray:
+    '''
+    Returns the mean of the non-zero bins of every profile, 0 if there are
+    none. The non-zero bins are moved to the front of their rows first, so
+    that every mean sums the same values in the same order, and thus to
+    the same float, as x[x != 0].mean() of the profile.
+    '''
+    order = np.argsort(~nonzero, axis=1, kind='stable')
+    compacted = np.take_along_axis(profiles, order, axis=1)
+    means = np.zeros(len(profiles), profiles.dtype)
+    for k in np.unique(n_nonzero[n_nonzero != 0]):
+        rows = n_nonzero == k
+        means[rows] = compacted[rows, :k].sum(axis=1) / k
+    return means
+
+
+def csv_chunks(data_path: str, fields: list, chunk_rows: int):
+    '''
+    Yields the shots of a csv chunk_rows at a time, as (df, profiles)
+    pairs like footprint_store.iter_footprints, where profiles maps each
+    field to its float64 matrix, parsed once.
+    '''
+    for data in pd.read_csv(data_path, chunksize=chunk_rows):
+        profiles = {
+            field: parse_profiles(data[field], PROFILE_BINS,
+                                  dtype=np.float64)
+            for field in fields
+        }
+        yield data.drop(columns=fields), profiles
 
 
 def vertical(
     data_path: str,
     save_path: str,
+    fields: list = ['pai_z', 'pavd_z'],
+    stats: list = None,
+    chunk_rows: int = 500_000,
+    store: str = None,
+    product: str = 'level_2b',
 ):
-    GEDI_DATA_DIR = data_path
-    SAVE_PATH = save_path
-    data = pd.read_csv(GEDI_DATA_DIR)
-
-    data['pai_z_sum'] = data['pai_z'].map(
-        lambda x: vertical_stats(x, stat='sum'))
-
-    stats = ['mean', 'max', 'min']
-    for field in ['pai_z', 'pavd_z']:
-        for stat in stats:
-            print(field, stat)
-            data[f"{field}_{stat}"] = data[field].map(
-                lambda x: vertical_stats(x, stat=stat))
-        data.drop(columns=[field], axis=1, inplace=True)
+    '''
+    Replaces the profile fields of the shots by their statistics, see
+    vertical_stats, named {field}_{stat}. Without stats, every field gets
+    those of DEFAULT_STATS, as in the original analysis. The shots are
+    read, parsed once into profile matrices and written chunk_rows at a
+    time. With a store, they are read from the footprint store, whose
+    fixed size list profiles need no parsing, instead of the csv at
+    data_path.
+    '''
+    chunks = csv_chunks(data_path, fields, chunk_rows) if store is None \
+        else iter_footprints(store, product, batch_rows=chunk_rows)
+    n_shots = 0
+    for data, profiles in chunks:
+        for field in fields:
+            field_stats = stats or DEFAULT_STATS.get(
+                field, DEFAULT_FIELD_STATS)
+            for stat, values in vertical_stats(
+                    profiles[field], field_stats).items():
+                data[f"{field}_{stat}"] = values
 
-    data.to_csv(SAVE_PATH)
+        data.index = pd.RangeIndex(n_shots, n_shots + len(data))
+        data.to_csv(save_path, mode='a' if n_shots else 'w',
+                    header=not n_shots)
+        n_shots += len(data)
+        print("shots", n_shots)
 
 
 if __name__ == "__main__":
@@ -56,4 +153,9 @@ if __name__ == "__main__":
     vertical(
         data_path=args.data_path,
         save_path=args.save_path,
+        fields=args.fields,
+        stats=args.stats,
+        chunk_rows=args.chunk_rows,
+        store=args.store,
+        product=args.product,
     )
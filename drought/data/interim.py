@@ -0,0 +1,179 @@
+''' Schemas of the interim datasets and a loader that applies them. '''
+from pathlib import Path
+import pandas as pd
+
+INTERIM_DIR = Path(__file__).resolve().parents[2] / 'data' / 'interim'
+
+# Compact dtypes of the key columns. Any other column that is not a date
+# is a measure, stored as float32.
+KEY_DTYPES = {
+    'polygon_id': 'int8',
+    'year': 'int16',
+    'month': 'int8',
+    'month_key': 'int16',
+    'number': 'int32',
+    'time': 'int64',
+    'date': 'category',
+}
+
+# Columns holding dates, which are parsed when loading.
+DATE_COLUMNS = ['datetime']
+
+# Interim datasets by name. 'file' is relative to INTERIM_DIR and 'columns'
+# lists its columns. 'index' is None if the csv was written without an
+# index, 'drop' if it holds a meaningless pandas index, and otherwise the
+# name under which the index is kept.
+INTERIM_DATASETS = {
+    'gedi_monthly_mean': {
+        'file': 'gedi_PAI_monthly_mean_per_polygon_4-2019_to_6-2022.csv',
+        'columns': ['month', 'year', 'polygon_id', 'pai'],
+        'index': 'drop',
+    },
+    'gedi_monthly_median': {
+        'file': 'gedi_PAI_monthly_median_per_polygon_4-2019_to_6-2022.csv',
+        'columns': ['month', 'year', 'polygon_id', 'pai'],
+        'index': 'drop',
+    },
+    'gedi_monthly_agg_mean': {
+        'file': 'gedi_PAI_monthly_mean_per_polygon_across_years_4-2019_to_6-2022.csv',  # noqa: E501
+        'columns': ['month', 'polygon_id', 'pai'],
+        'index': 'drop',
+    },
+    'gedi_monthly_agg_median': {
+        'file': 'gedi_PAI_monthly_median_per_polygon_across_years_4-2019_to_6-2022.csv',  # noqa: E501
+        'columns': ['month', 'polygon_id', 'pai'],
+        'index': 'drop',
+    },
+    'gedi_fitted_monthly': {
+        'file': 'gedi_PAI_fitted_monthly.csv',
+        'columns': ['polygon_id', 'year', 'month', 'pai', 'date'],
+        'index': 'key',
+    },
+    'gedi_monthly_extended_interpolated': {
+        'file': 'gedi_monthly_extended_interpolated_March_11.csv',
+        'columns': ['pai', 'rh100', 'year', 'month', 'polygon_id', 'number',
+                    'datetime', 'date'],
+        'index': 'drop',
+    },
+    'gedi_monthly_interpolated': {
+        'file': 'gedi_monthly_interpolated_via_weighted_average.csv',
+        'columns': ['pai', 'rh100', 'year', 'month', 'polygon_id', 'number',
+                    'date', 'pai_interpolated'],
+        'index': 'drop',
+    },
+    'gedi_monthly_interpolated_min_6000_shots': {
+        'file': 'gedi_monthly_interpolated_via_weighted_average_excluding_months_with_less_than_6000_shots.csv',  # noqa: E501
+        'columns': ['pai', 'rh100', 'year', 'month', 'polygon_id', 'number',
+                    'date', 'pai_interpolated', 'rh100_interpolated'],
+        'index': 'drop',
+    },
+    'climate_monthly_mean': {
+        'file': 'climate_r_p_t_monthly_mean_per_polygon_1-2019_to_12-2022.csv',  # noqa: E501
+        'columns': ['month', 'year', 'polygon_id', 'precipitation',
+                    'temperature', 'radiation'],
+        'index': 'drop',
+    },
+    'climate_monthly_agg_mean': {
+        'file': 'climate_r_p_t_aggregate_monthly_mean_per_polygon_1-2019_to_12-2022.csv',  # noqa: E501
+        'columns': ['month', 'polygon_id', 'precipitation', 'temperature',
+                    'radiation'],
+        'index': 'drop',
+    },
+    'climate_all_monthly_mean': {
+        'file': 'all_climate_monthly_mean_5000_scale_2001_to_2023.csv',
+        'columns': ['month', 'polygon_id', 'year', 'datetime', 'date',
+                    'precipitation', 'radiation', 'temperature', 'fpar',
+                    'PET', 'P-PET'],
+        'index': 'drop',
+    },
+    'climate_vars_timeseries': {
+        'file': 'monthly_means_timeseries_of_climate_vars_01-2010_to_11-2022.csv',  # noqa: E501
+        'columns': ['month', 'polygon_id', 'year', 'datetime', 'date',
+                    'precipitation', 'ET', 'PET', 'P-PET', 'P-ET',
+                    'temperature', 'radiation', 'fpar'],
+        'index': 'drop',
+    },
+    'radiation_vars_timeseries': {
+        'file': 'monthly_means_timeseries_of_radiation_vars_01-2010_to_11-2022.csv',  # noqa: E501
+        'columns': ['month', 'polygon_id', 'year', 'temperature',
+                    'radiation', 'fpar', 'datetime', 'date'],
+        'index': 'drop',
+    },
+    'water_vars_timeseries': {
+        'file': 'monthly_means_timeseries_of_water_climate_vars_01-2010_to_11-2022.csv',  # noqa: E501
+        'columns': ['month', 'polygon_id', 'year', 'precipitation', 'ET',
+                    'PET', 'datetime', 'date', 'P-PET', 'P-ET'],
+        'index': 'drop',
+    },
+    'p_pet_50km': {
+        'file': 'p_pet_2001-2023_scale_50km.csv',
+        'columns': ['time', 'datetime', 'month', 'year', 'longitude',
+                    'latitude', 'precipitation', 'PET', 'polygon_id'],
+        'index': 'drop',
+    },
+    'spei': {
+        'file': '2001-2023_spei_per_polygon.csv',
+        'columns': ['datetime', 'P-PET', 'polygon_id', 'spei_1', 'spei_3',
+                    'spei_6', 'spei_9', 'spei_12', 'spei_18'],
+        'index': None,
+    },
+    'spei_50km': {
+        'file': '2001-2023_spei_per_polygon_50km_climate_resolution.csv',
+        'columns': ['datetime', 'month', 'year', 'polygon_id', 'PET',
+                    'precipitation', 'P-PET', 'spei_1', 'spei_3', 'spei_6',
+                    'spei_9', 'spei_12', 'spei_18'],
+        'index': None,
+    },
+    'vi_monthly_mean': {
+        'file': 'vi_monthly_mean_per_polygon_3-2000_to_1-2023.csv',
+        'columns': ['month', 'year', 'polygon_id', 'ndvi', 'evi'],
+        'index': 'drop',
+    },
+    'vi_monthly_agg_mean': {
+        'file': 'vi_aggregate_monthly_mean_per_polygon_3-2000_to_1-2023.csv',
+        'columns': ['month', 'polygon_id', 'ndvi', 'evi'],
+        'index': 'drop',
+    },
+}
+
+
+def column_dtype(column: str) -> str:
+    ''' Returns the dtype a column of an interim dataset is loaded as. '''
+    return KEY_DTYPES.get(column, 'float32')
+
+
+def load_interim(name: str, columns: list = None,
+                 interim_dir: Path = INTERIM_DIR) -> pd.DataFrame:
+    '''
+    Loads an interim dataset with its compact dtypes and parsed dates.
+
+    Only the given columns are parsed, in the order they are given, all
+    columns of the dataset otherwise.
+    '''
+    schema = INTERIM_DATASETS[name]
+    columns = columns or schema['columns']
+    unknown = set(columns) - set(schema['columns'])
+    if unknown:
+        raise ValueError(f'{name} has no columns {unknown}.')
+
+    index = schema['index']
+    dates = [col for col in columns if col in DATE_COLUMNS]
+    # Keys are cast after parsing, as some were written as floats.
+    dtypes = {col: column_dtype(col) for col in columns
+              if col not in dates and col not in KEY_DTYPES}
+    df = pd.read_csv(
+        Path(interim_dir) / schema['file'],
+        usecols=lambda col: col in columns or (
+            index is not None and col.startswith('Unnamed: 0')),
+        index_col=0 if index is not None else None,
+        dtype=dtypes,
+        parse_dates=dates,
+    )
+    df = df.astype({col: KEY_DTYPES[col] for col in columns
+                    if col in KEY_DTYPES})
+
+    if index == 'drop':
+        df = df.reset_index(drop=True)
+    elif index is not None:
+        df.index.name = index
+    return df[columns]
@@ -1,12 +1,20 @@
+from drought.data.cube import cell_frames
+from drought.data.df_extensions import datetime_to_month_key, df_month_key, \
+    month_key_to_year_month
+import numpy as np
 import pandas as pd
 
 
 def interpolate_using_linear(df_all_polygons: pd.DataFrame,
                              colummns: list[str]):
+    '''
+    Linearly interpolates the missing values of the columns in the time
+    series of every polygon. df_all_polygons is a long DataFrame or an
+    AnalysisCube, whose series are read one contiguous chunk at a time.
+    '''
     all_polygons = []
-    for polygon_id in range(1, 9):
-        df = df_all_polygons[df_all_polygons.polygon_id == polygon_id]
-        df = df.sort_values(by=['year', 'month'])
+    for _, df in cell_frames(df_all_polygons, range(1, 9), colummns):
+        df = df.iloc[np.argsort(df_month_key(df), kind='stable')]
 
         for column in colummns:
             df[column] = df[column].interpolate()
@@ -25,7 +33,8 @@ def interpolate_using_weighted_average(df_all_polygons: pd.DataFrame,
     interpolated_value_i = (value_i-1 * weight_i-1 + value_i * weight_i + value_i+1 * weight_i+1) \\ (weight_i-1 + weight_i + weight_i+1)  # noqa: E501
 
     Interpolated values are returned on the 'value_interpolated' column of the
-    returned DataFrame.
+    returned DataFrame. df_all_polygons is a long DataFrame or an
+    AnalysisCube, see interpolate_using_linear.
 
 
     Example:
@@ -38,16 +47,14 @@ def interpolate_using_weighted_average(df_all_polygons: pd.DataFrame,
       available for that month. More GEDI shots => more significant PAI value.
     '''
     all_polygons = []
-    for polygon_id in range(1, 9):
-        df = df_all_polygons[df_all_polygons.polygon_id == polygon_id]
-
+    for _, df in cell_frames(df_all_polygons, range(1, 9), [weight, value]):
         # Sort based on dates, in this case just year and month. This is
         # important because we want to interpolate values for the current
         # month based on the previous and the next month.
 
         # TODO: If we wanted to interpolate on a less than month granularity,
         # we'd need to update this.
-        df = df.sort_values(by=['year', 'month'])
+        df = df.iloc[np.argsort(df_month_key(df), kind='stable')]
 
         # Step 1: Calculate weighted value for each date = value * weight.
         weighted_values = df[value] * df[weight]
@@ -77,17 +84,19 @@ def fill_timeseries_missing_data(df: pd.DataFrame, start_date: str,
 
     values_to_fill is a dictionary of the form: column_name -> value_to_fill.
     '''
-    df_copy = df.copy()
-    for polygon in range(1, 9):
-        for date in pd.date_range(start=start_date, end=end_date, freq='M'):
-            if not ((df['year'] == date.year)
-                    & (df['month'] == date.month)
-                    & (df['polygon_id'] == polygon)).any():
-
-                new_row = pd.DataFrame({'year': date.year,
-                                        'month': date.month,
-                                        'polygon_id': polygon}
-                                       | values_to_fill,
-                                       index=[0])
-                df_copy = pd.concat([df_copy, new_row], ignore_index=True)
-    return df_copy
+    # Find the (polygon, month key) pairs missing from df.
+    month_keys = datetime_to_month_key(
+        pd.date_range(start=start_date, end=end_date, freq='M'))
+    all_keys = pd.MultiIndex.from_product([range(1, 9), month_keys])
+    existing_keys = pd.MultiIndex.from_arrays(
+        [df['polygon_id'], df_month_key(df)])
+    missing = all_keys[~all_keys.isin(existing_keys)]
+    if len(missing) == 0:
+        return df.copy()
+
+    years, months = month_key_to_year_month(missing.get_level_values(1))
+    new_rows = pd.DataFrame({'year': years,
+                             'month': months,
+                             'polygon_id': missing.get_level_values(0)}
+                            | values_to_fill)
+    return pd.concat([df, new_rows], ignore_index=True)
@@ -1,51 +1,136 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pcsv
 
+# Number of 5 m height bins of the GEDI vertical profiles, e.g. pai_z.
+PROFILE_BINS = 30
 
-def transform_pai_z(df: pd.DataFrame):
+# Height of the bins of the profiles. Profiles are stored ground first: bin
+# i holds the heights from i * BIN_HEIGHT to (i + 1) * BIN_HEIGHT.
+BIN_HEIGHT = 5
+
+# Number of profiles parsed at a time.
+PARSE_CHUNK_ROWS = 1_000_000
+
+
+def bin_heights(bins: int = PROFILE_BINS) -> np.ndarray:
+    ''' Returns the height of the bottom of every bin of a profile. '''
+    return np.arange(bins) * BIN_HEIGHT
+
+
+def parse_profiles(profiles: pd.Series, bins: int = PROFILE_BINS,
+                   chunk_rows: int = PARSE_CHUNK_ROWS,
+                   dtype=np.float32) -> np.ndarray:
     '''
-    Transforms the original pai_z array into a more useful set of columns:
-    pai_z_np - numpy array representing cumulative vertical pai starting from
-    the lowest heights, pai_z_padded - same as pai_z_np but padded with zeros
-    so that all the arrays are of the same length of 30, pai_z_delta_np -
-    delta PAI for each height bucket.
+    Parses a column of profile strings like '[0.5, 0.25, 0.0]', as pai_z
+    and pavd_z are stored, into one contiguous N x bins matrix of dtype.
 
-    NOTE: This function can run for a long time (~12 mins) for ~10 million
-    footprints.
+    The profiles of chunk_rows rows at a time are joined into one csv of
+    bins columns, which is parsed by arrow in bulk instead of splitting
+    every string in python.
     '''
-    df = transform_pai_z_array_to_np(df)
-    df = pad_all_pai_z_to_constant_length(df)
-    df = calculate_pai_z_delta(df)
-    return df
+    matrix = np.empty((len(profiles), bins), dtype)
+    names = [str(i) for i in range(bins)]
+    read_options = pcsv.ReadOptions(column_names=names)
+    convert_options = pcsv.ConvertOptions(
+        column_types=dict.fromkeys(names, pa.from_numpy_dtype(dtype)))
+    values = profiles.values
+    for start in range(0, len(values), chunk_rows):
+        chunk = values[start:start + chunk_rows]
+        text = '\n'.join(chunk).replace('[', '').replace(']', '')
+        try:
+            table = pcsv.read_csv(pa.py_buffer(text.encode()), read_options,
+                                  convert_options=convert_options)
+        except pa.ArrowInvalid as e:
+            raise ValueError(f"Profiles must have {bins} values each: {e}")
+        if table.num_rows != len(chunk):
+            raise ValueError(f"Expected {len(chunk)} profiles, \
+                             got {table.num_rows}.")
+        for i, column in enumerate(table.columns):
+            matrix[start:start + len(chunk), i] = column.to_numpy()
+    return matrix
 
 
-def transform_pai_z_array_to_np(df: pd.DataFrame):
+def profile_matrix(df: pd.DataFrame, column: str = 'pai_z',
+                   bins: int = PROFILE_BINS,
+                   profiles=None) -> np.ndarray:
     '''
-    For some reason, pai_z is a string, so convert to a numpy array,
-    flip it around (so that the lowest heights come first in the array),
-    and trim zeros.
+    Returns the profiles of a column as an N x bins float32 matrix. They
+    are taken from profiles if it holds the column, e.g. the lazily loaded
+    FootprintProfiles of footprints read from the store, without a copy.
+    Otherwise they are parsed from the column's strings, stacked from its
+    arrays, or stacked from the column_0 ... column_{bins - 1} columns that
+    gedi_query_h5.py writes.
     '''
-    df['pai_z_np'] = df.apply(lambda row: np.flip(np.trim_zeros(
-        np.array(row.pai_z[1:-1].split(", ")).astype(float))), axis=1)
-    return df
+    if profiles is not None and column in profiles:
+        return profiles[column]
+    if column in df.columns:
+        if len(df) and not isinstance(df[column].iloc[0], str):
+            return np.stack(df[column].values).astype(np.float32, copy=False)
+        return parse_profiles(df[column], bins)
+    columns = [f'{column}_{i}' for i in range(bins)]
+    return df[columns].to_numpy(np.float32)
 
 
-def pad_all_pai_z_to_constant_length(df: pd.DataFrame):
-    def pad_numpy_array(df):
-        pai_array = df.pai_z_np
-        return np.pad(pai_array, (0, 30-pai_array.size), 'constant')
+def pad_profiles(matrix: np.ndarray) -> np.ndarray:
+    '''
+    Trims the leading and trailing zeros of every profile, flips it around
+    (so that its highest non-zero bin, the top of the canopy, comes first)
+    and pads it with zeros back to its length, for all profiles at once.
+    '''
+    bins = matrix.shape[1]
+    nonzero = matrix != 0
+    has_values = nonzero.any(axis=1)
+    first = nonzero.argmax(axis=1)
+    last = bins - 1 - nonzero[:, ::-1].argmax(axis=1)
 
-    df['pai_z_padded'] = df.apply(pad_numpy_array, axis=1)
-    return df
+    # Position k of a padded profile is position last - k of the original.
+    source = last[:, None] - np.arange(bins)[None, :]
+    valid = (source >= first[:, None]) & has_values[:, None]
+    padded = np.take_along_axis(matrix, np.maximum(source, 0), axis=1)
+    padded[~valid] = 0
+    return padded
 
 
-def calculate_pai_z_delta(df: pd.DataFrame):
-    def calc_delta(df):
-        pai_array = df.pai_z_padded
-        pai_rolled = np.roll(pai_array, 1)
-        pai_delta = pai_array - pai_rolled
-        pai_delta[pai_delta < 0] = 0
-        return pai_delta
+def delta_profiles(padded: np.ndarray) -> np.ndarray:
+    '''
+    Returns the increase of every padded cumulative profile over the bin
+    below it, where decreases count as 0. As np.roll wraps around, the
+    first bin is compared to the last one.
+    '''
+    delta = padded - np.roll(padded, 1, axis=1)
+    delta[delta < 0] = 0
+    return delta
+
+
+def pai_z_profiles(df: pd.DataFrame, column: str = 'pai_z',
+                   profiles=None):
+    '''
+    Returns the padded and delta profiles of df, see pad_profiles and
+    delta_profiles, as two N x 30 float32 matrices aligned with its rows.
+    '''
+    padded = pad_profiles(profile_matrix(df, column, profiles=profiles))
+    return padded, delta_profiles(padded)
 
-    df['pai_z_delta_np'] = df.apply(calc_delta, axis=1)
+
+def transform_pai_z(df: pd.DataFrame, profiles=None):
+    '''
+    Transforms the original pai_z array into a more useful set of columns:
+    pai_z_np - numpy array representing cumulative vertical pai starting from
+    the top of the canopy, pai_z_padded - same as pai_z_np but padded with
+    zeros so that all the arrays are of the same length of 30,
+    pai_z_delta_np - delta PAI for each height bucket.
+
+    The columns hold views of the rows of the matrices of pai_z_profiles,
+    which should be used directly where whole-array operations are needed.
+    '''
+    padded, delta = pai_z_profiles(df, profiles=profiles)
+    nonzero = padded != 0
+    # Interior zeros are kept, only the padding after the last value is not.
+    lengths = np.where(nonzero.any(axis=1),
+                       padded.shape[1] - nonzero[:, ::-1].argmax(axis=1), 0)
+    df['pai_z_np'] = [row[:n] for row, n in zip(padded, lengths)]
+    df['pai_z_padded'] = list(padded)
+    df['pai_z_delta_np'] = list(delta)
     return df
@@ -1,13 +1,20 @@
 ''' Module that contains our entire data pipeline. '''
 from drought.data.aggregator import aggregate_monthly_per_polygon
 from drought.data.aggregator import aggregate_monthly_per_polygon_across_years
+from drought.data.cube import build_cube, open_cube
+from drought.data.df_extensions import add_month_key_column
 from drought.data.ee_climate import get_monthly_climate_data_as_pdf, \
     CLIMATE_COLUMNS
 from drought.data.vi_extract import get_monthly_vi_data_as_pdf, VI_COLUMNS
 from drought.data.ee_converter import gdf_to_ee_polygon
+from drought.data.footprint_store import read_footprints_or_csv
+from drought.data.interim import load_interim
+from drought.data.polygon_join import assign_grid_cells, assign_polygons
+from drought.data.profile_cube import PROFILE_FIELDS, ProfileAccumulator, \
+    open_profile_cube
 import ee
 import geopandas as gpd
-import pandas as pd
+import os
 
 POLYGONS_DIR = '../../data/polygons/Amazonia_drought_gradient_polygons.shp'
 
@@ -39,24 +46,67 @@ GEDI_EXTENDED_FOOTPRINTS = "/maps-priv/maps/drought-with-gedi/gedi_data/gedi_ext
 VI_MONTHLY_MEANS_CSV = "../../data/interim/vi_monthly_mean_per_polygon_3-2000_to_1-2023.csv"  # noqa: E501
 VI_MONTHLY_AGG_MEANS_CSV = "../../data/interim/vi_aggregate_monthly_mean_per_polygon_3-2000_to_1-2023.csv"  # noqa: E501
 
+# Partitioned parquet store of the footprints, see footprint_store.py.
+GEDI_FOOTPRINT_STORE = "/maps-priv/maps/drought-with-gedi/gedi_data/footprints"  # noqa: E501
+
+# Polygon x month x variable cube of all monthly variables, see cube.py.
+ANALYSIS_CUBE_DIR = "../../data/interim/analysis_cube"
+
+# Variables of the analysis cube, by the interim dataset they come from.
+ANALYSIS_CUBE_VARIABLES = {
+    'gedi_monthly_interpolated': ['pai', 'rh100', 'number',
+                                  'pai_interpolated'],
+    'climate_all_monthly_mean': ['precipitation', 'radiation', 'temperature',
+                                 'fpar', 'PET', 'P-PET'],
+    'vi_monthly_mean': ['ndvi', 'evi'],
+    'spei': ['spei_1', 'spei_3', 'spei_6', 'spei_9', 'spei_12', 'spei_18'],
+}
+
+# Polygon x month x height cube of the footprint profiles, see
+# profile_cube.py. Cubes over grid cells get a _{r}x{r} suffix.
+PROFILE_CUBE_DIR = "../../data/interim/profile_cube"
+
+# Profile accumulators of each polygon, merged into the profile cubes.
+PROFILE_ACCUMULATOR_DIR = "../../data/interim/profile_accumulators"
+
 
 def get_gpd_polygons():
     ''' Returns a list of GTC Regions of Interest, as geopandas geometries. '''
     return gpd.read_file(POLYGONS_DIR)
 
 
-def get_gedi_footprints():
-    ''' Returns dataframe containing all footprints within polygons. '''
-    gedi_csv = pd.read_csv(GEDI_FOOTPRINTS, index_col=0)
+def get_gedi_footprints(columns=None, filters=None, profiles=False):
+    '''
+    Returns dataframe containing all footprints within polygons.
 
-    return gedi_csv
+    Only the given columns are loaded, and filters are (column, op, value)
+    tuples, e.g. [('polygon_id', '==', 3), ('year', '>=', 2020)]. They are
+    pushed down to the footprint store, if the footprints were written to
+    it, and applied to the csv otherwise. With profiles, the pai_z/pavd_z
+    profiles are returned separately, as lazily loaded matrices, see
+    footprint_store.read_footprints.
+    '''
+    return read_footprints_or_csv(
+        GEDI_FOOTPRINT_STORE, 'level_2b', GEDI_FOOTPRINTS, columns, filters,
+        profiles)
 
 
-def get_extended_gedi_footprints():
-    ''' Returns dataframe containing all footprints within polygons. '''
-    gedi_csv = pd.read_csv(GEDI_EXTENDED_FOOTPRINTS, index_col=0)
+def get_extended_gedi_footprints(columns=None, filters=None):
+    '''
+    Returns dataframe containing all footprints within polygons. See
+    get_gedi_footprints for columns and filters.
+    '''
+    return read_footprints_or_csv(
+        GEDI_FOOTPRINT_STORE, 'extended_filtered', GEDI_EXTENDED_FOOTPRINTS,
+        columns, filters)
 
-    return gedi_csv
+
+def assign_gedi_footprints_to_polygons(df):
+    '''
+    Labels footprints held locally, e.g. read from a csv or extracted from
+    GEDI granules, with the polygon_id of the polygons they lie in.
+    '''
+    return assign_polygons(df, get_gpd_polygons())
 
 
 def get_ee_polygons():
@@ -68,7 +118,7 @@ def get_ee_polygons():
 def generate_GEDI_monthly_data():
     ''' Generates monthly GEDI data and saves it to a CSV file.'''
     # Read GEDI data from Sherwood.
-    gedi_csv = pd.read_csv(GEDI_FOOTPRINTS)
+    gedi_csv = get_gedi_footprints(['pai', 'polygon_id', 'year', 'month'])
 
     # Calculate monthly means for each polygon.
     monthly_means = aggregate_monthly_per_polygon(
@@ -99,6 +149,46 @@ def generate_GEDI_monthly_data():
     total_monthly_median.to_csv(GEDI_MONTHLY_AGG_MEDIANS_CSV)
 
 
+def generate_GEDI_monthly_data_in_database(database):
+    '''
+    Generates the same monthly GEDI CSV files as generate_GEDI_monthly_data,
+    but reduces the footprints inside the GEDI database, so that only the
+    aggregates are transferred.
+
+    database is a GediDatabase from drought/data/utils/gedi_database.py.
+    '''
+    polygons = get_gpd_polygons()
+
+    # Same quality filtering as in the GEDI query scripts.
+    conditions = ['l2b_quality_flag = 1', 'pai > 0']
+
+    # Calculate monthly means and medians for each polygon.
+    groupby = ['month', 'year', 'polygon_id']
+    monthly = database.aggregate(
+        'level_2b', polygons, {'pai': ['mean', 'median']},
+        START_DATE, END_DATE, group_by=groupby, conditions=conditions)
+
+    # Save to csv files.
+    monthly_means = monthly.rename(columns={'pai_mean': 'pai'})
+    monthly_means[[*groupby, 'pai']].to_csv(GEDI_MONTHLY_MEANS_CSV)
+    monthly_median = monthly.rename(columns={'pai_median': 'pai'})
+    monthly_median[[*groupby, 'pai']].to_csv(GEDI_MONTHLY_MEDIANS_CSV)
+
+    # Calculate aggregate monthly means and medians across all the years.
+    groupby = ['month', 'polygon_id']
+    total_monthly = database.aggregate(
+        'level_2b', polygons, {'pai': ['mean', 'median']},
+        START_DATE, END_DATE, group_by=groupby, conditions=conditions)
+
+    # Save to csv files.
+    total_monthly_mean = total_monthly.rename(columns={'pai_mean': 'pai'})
+    total_monthly_mean[[*groupby, 'pai']].to_csv(GEDI_MONTHLY_AGG_MEANS_CSV)
+    total_monthly_median = total_monthly.rename(
+        columns={'pai_median': 'pai'})
+    total_monthly_median[[*groupby, 'pai']] \
+        .to_csv(GEDI_MONTHLY_AGG_MEDIANS_CSV)
+
+
 def generate_climate_monthly_data():
     ''' Generates monthly climate data and saves it to a CSV file.'''
     ee.Initialize()
@@ -161,19 +251,101 @@ def generate_vi_monthly_data():
 
 def get_monthly_means_per_polygon():
     ''' Combines all monthly data sources into one DataFrame. '''
-    climate_monthly = pd.read_csv(CLIMATE_MONTHLY_MEANS_CSV, index_col=0)
-    gedi_monthly = pd.read_csv(GEDI_MONTHLY_MEANS_CSV, index_col=0)
-
-    # Join data sets.
-    climate_indexed = climate_monthly.set_index(
-        ['month', 'year', 'polygon_id'])
-    gedi_indexed = gedi_monthly.set_index(['month', 'year', 'polygon_id'])
-    monthly_data = gedi_indexed.join(climate_indexed).reset_index()
-    return monthly_data
-
-
-def get_filtered_gedi_footprints():
-    return pd.read_csv(GEDI_FILTERED_FOOTPRINTS, index_col=0)
+    climate_monthly = add_month_key_column(
+        load_interim('climate_monthly_mean')).drop(columns=['month', 'year'])
+    gedi_monthly = add_month_key_column(load_interim('gedi_monthly_mean'))
+
+    # Join data sets on their polygon and month key.
+    monthly_data = gedi_monthly.merge(
+        climate_monthly, on=['polygon_id', 'month_key'], how='left')
+    return monthly_data.drop(columns=['month_key'])
+
+
+def generate_analysis_cube():
+    '''
+    Builds the analysis cube from the monthly interim datasets, on the
+    union of their months.
+    '''
+    sources = []
+    for name, variables in ANALYSIS_CUBE_VARIABLES.items():
+        df = load_interim(name)
+        sources.append((df, variables))
+    return build_cube(ANALYSIS_CUBE_DIR, sources)
+
+
+def get_analysis_cube():
+    '''
+    Opens the analysis cube lazily. Blocks of it are read with e.g.
+    cube.to_frame(cells=[1, 2], start='2019-04', end='2022-07',
+    variables=['pai', 'precipitation']), or cube.series(3, 'pai').
+    '''
+    return open_cube(ANALYSIS_CUBE_DIR)
+
+
+def profile_cube_dir(r=None):
+    ''' Returns the directory of the profile cube of r x r grids, if r. '''
+    return PROFILE_CUBE_DIR if r is None else f'{PROFILE_CUBE_DIR}_{r}x{r}'
+
+
+def accumulate_polygon_profiles(polygon, r=None):
+    '''
+    Returns the profile accumulator of the footprints of one polygon, per
+    month and, with r, per cell of the r x r grid over the polygon. Grid
+    cells are labelled polygon_id * r * r + cell_id.
+    '''
+    columns = ['polygon_id', 'year', 'month', *PROFILE_FIELDS]
+    if r is not None:
+        columns += ['lon_lowestmode', 'lat_lowestmode']
+    footprints, profiles = get_gedi_footprints(
+        columns, [('polygon_id', '==', polygon.id)], profiles=True)
+    if r is None:
+        return ProfileAccumulator().add_frame(footprints, profiles=profiles)
+
+    cell_id = assign_grid_cells(footprints, polygon.geometry, r)
+    inside = cell_id >= 0
+    footprints = footprints[inside].assign(
+        cell_id=polygon.id * r * r + cell_id[inside])
+    profiles = {field: profiles[field][inside] for field in PROFILE_FIELDS}
+    return ProfileAccumulator().add_frame(footprints, 'cell_id', profiles)
+
+
+def generate_profile_cube(r=None, recompute=False):
+    '''
+    Builds the cube of the monthly vertical profile statistics of the
+    footprints, per polygon or, with r, per cell of the r x r grids over
+    the polygons. The accumulator of every polygon is saved and reused,
+    unless recompute, so e.g. new quantiles don't need the footprints.
+    '''
+    os.makedirs(PROFILE_ACCUMULATOR_DIR, exist_ok=True)
+    accumulator = ProfileAccumulator()
+    for polygon in get_gpd_polygons().to_crs('EPSG:4326').itertuples():
+        name = f'polygon_{polygon.id}' + ('' if r is None else f'_{r}x{r}')
+        path = os.path.join(PROFILE_ACCUMULATOR_DIR, f'{name}.npz')
+        if os.path.exists(path) and not recompute:
+            partial = ProfileAccumulator.load(path)
+        else:
+            partial = accumulate_polygon_profiles(polygon, r)
+            partial.save(path)
+        accumulator.merge(partial)
+    return accumulator.to_cube(profile_cube_dir(r))
+
+
+def get_profile_cube(r=None):
+    '''
+    Opens the profile cube lazily, e.g. cube.series(3, 'pavd_z_mean') is
+    a month x height dataframe of the mean pavd_z profiles of polygon 3.
+    '''
+    return open_profile_cube(profile_cube_dir(r))
+
+
+def get_filtered_gedi_footprints(columns=None, filters=None):
+    '''
+    Returns the land use filtered footprints. See get_gedi_footprints for
+    columns and filters.
+    '''
+    return read_footprints_or_csv(
+        GEDI_FOOTPRINT_STORE, 'level_2b_land_filtered',
+        GEDI_FILTERED_FOOTPRINTS, columns, filters)
 
 
 def execute():
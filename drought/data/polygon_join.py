@@ -0,0 +1,129 @@
+''' Vectorised assignment of lon/lat points to polygons. '''
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Number of points turned into geometries and queried at a time.
+BATCH_SIZE = 1_000_000
+
+
+class PolygonIndex(object):
+    '''
+    STRtree over any set of polygons, e.g. the polygons of interest or the
+    grid cells of polygon_grid, that finds the polygons of many points in
+    batched array calls.
+
+    Points outside of the bounds of all polygons are skipped before any
+    geometry is built. Points in the bounding box of a rectangular polygon,
+    like a grid cell, are inside it without an exact test.
+    '''
+
+    def __init__(self, geometries, ids=None):
+        self.geometries = np.asarray(geometries)
+        self.ids = np.arange(len(self.geometries)) if ids is None \
+            else np.asarray(ids)
+        self.tree = shapely.STRtree(self.geometries)
+        self.bounds = shapely.total_bounds(self.geometries)
+        self.rectangles = shapely.area(self.geometries) \
+            == shapely.area(shapely.envelope(self.geometries))
+        shapely.prepare(self.geometries)
+
+    @classmethod
+    def from_frame(cls, polygons: gpd.GeoDataFrame,
+                   id_column: str = 'id', crs: str = 'EPSG:4326'):
+        ''' Indexes the polygons of a GeoDataFrame, by their id_column. '''
+        polygons = polygons.to_crs(crs)
+        return cls(polygons.geometry.values, polygons[id_column].values)
+
+    def query(self, lon, lat, batch_size: int = BATCH_SIZE):
+        '''
+        Returns every (point, polygon) pair where the point lies in the
+        polygon, as an array of point positions and an array of polygon
+        positions, ordered by point.
+        '''
+        lon, lat = np.asarray(lon, np.float64), np.asarray(lat, np.float64)
+        points, polygons = [], []
+        for start in range(0, len(lon), batch_size):
+            x = lon[start:start + batch_size]
+            y = lat[start:start + batch_size]
+            candidates = np.flatnonzero(
+                (x >= self.bounds[0]) & (y >= self.bounds[1])
+                & (x <= self.bounds[2]) & (y <= self.bounds[3]))
+            geometries = shapely.points(x[candidates], y[candidates])
+
+            # Bounding box hits, of which only those on polygons that are
+            # not rectangles need the exact test.
+            point, polygon = self.tree.query(geometries)
+            exact = ~self.rectangles[polygon]
+            inside = np.ones(len(point), bool)
+            inside[exact] = shapely.intersects(
+                self.geometries[polygon[exact]], geometries[point[exact]])
+            points.append(start + candidates[point[inside]])
+            polygons.append(polygon[inside])
+
+        points = np.concatenate(points) if points else np.empty(0, int)
+        polygons = np.concatenate(polygons) if polygons else np.empty(0, int)
+        order = np.lexsort((polygons, points))
+        return points[order], polygons[order]
+
+    def assign(self, lon, lat, batch_size: int = BATCH_SIZE) -> np.ndarray:
+        '''
+        Returns the position of the polygon each point lies in, the first
+        one if it lies in several, and -1 if it lies in none.
+        '''
+        points, polygons = self.query(lon, lat, batch_size)
+        positions = np.full(len(np.asarray(lon)), -1)
+        first = np.unique(points, return_index=True)[1]
+        positions[points[first]] = polygons[first]
+        return positions
+
+
+def assign_polygons(df: pd.DataFrame, polygons: gpd.GeoDataFrame,
+                    id_column: str = 'id',
+                    lon_column: str = 'lon_lowestmode',
+                    lat_column: str = 'lat_lowestmode') -> pd.DataFrame:
+    '''
+    Returns one row per (shot, polygon) the shot of df lies in, with the
+    id of the polygon in a polygon_id column. Shots outside of all
+    polygons are left out. polygons may also be a PolygonIndex, to reuse
+    it across calls.
+    '''
+    index = polygons if isinstance(polygons, PolygonIndex) \
+        else PolygonIndex.from_frame(polygons, id_column)
+    points, positions = index.query(df[lon_column], df[lat_column])
+    assigned = df.iloc[points].copy()
+    assigned['polygon_id'] = index.ids[positions]
+    return assigned
+
+
+def polygon_grid(geometry, r: int,
+                 crs: str = 'EPSG:4326') -> gpd.GeoDataFrame:
+    '''
+    Returns the cells of the r x r grid over the bounds of a polygon that
+    intersect it, like those of rasterisation.rasterise_polygon, with
+    their x and y positions and a cell_id of y * r + x.
+    '''
+    minx, miny, maxx, maxy = geometry.bounds
+    stepx, stepy = (maxx - minx) / r, (maxy - miny) / r
+    y, x = np.divmod(np.arange(r * r), r)
+    cells = shapely.box(minx + x * stepx, maxy - (y + 1) * stepy,
+                        minx + (x + 1) * stepx, maxy - y * stepy)
+    inside = shapely.intersects(cells, geometry)
+    return gpd.GeoDataFrame({'cell_id': y[inside] * r + x[inside],
+                             'x': x[inside], 'y': y[inside]},
+                            geometry=cells[inside], crs=crs)
+
+
+def assign_grid_cells(df: pd.DataFrame, geometry, r: int,
+                      lon_column: str = 'lon_lowestmode',
+                      lat_column: str = 'lat_lowestmode') -> np.ndarray:
+    '''
+    Returns the cell_id of the cell of the r x r grid of polygon_grid over
+    a polygon that each shot of df lies in, and -1 for shots outside of
+    all of its cells.
+    '''
+    grid = polygon_grid(geometry, r)
+    positions = PolygonIndex(grid.geometry.values).assign(
+        df[lon_column], df[lat_column])
+    return np.where(positions >= 0, grid.cell_id.values[positions], -1)
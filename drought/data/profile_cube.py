@@ -0,0 +1,318 @@
+'''
+Monthly vertical profile statistics per cell, e.g. per polygon or grid cell.
+
+Profiles like pai_z are reduced into a ProfileAccumulator, which holds the
+count, sum and a fixed histogram of the values of every height bin, per
+cell and month. Accumulators of separate partitions of the footprints, e.g.
+of each polygon, are merged by adding them up, so the footprints are read
+once and partial results combined later.
+
+The means and quantiles of an accumulator are stored as a profile cube: a
+cube like those of cube.py, whose arrays have a third axis of height bins,
+i.e. are of shape (cells, months, bins).
+'''
+from drought.data.cube import AXES_FILE, CELL_COLUMN, AnalysisCube, \
+    save_array
+from drought.data.df_extensions import df_month_key, month_key, \
+    month_key_to_datetime
+from drought.data.pai_vertical import PROFILE_BINS, bin_heights, \
+    profile_matrix
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Profile fields accumulated by default.
+PROFILE_FIELDS = ['pai_z', 'pavd_z']
+
+# Number of histogram bins the values of every height bin are counted in.
+HISTOGRAM_BINS = 64
+
+# Upper edge of the histograms of each field, larger values are counted in
+# the last histogram bin.
+HISTOGRAM_MAX = {'pai_z': 10.0, 'pavd_z': 1.0}
+
+# Quantiles stored in a profile cube by default.
+QUANTILES = [0.25, 0.5, 0.75]
+
+
+class ProfileAccumulator(object):
+    '''
+    Mergeable per (cell, month, height bin) statistics of profiles: the
+    number and sum of their valid values, and their histogram between 0
+    and the field's HISTOGRAM_MAX, from which quantiles are interpolated.
+    With histogram_bins=0 no histograms, and so no quantiles, are kept.
+
+    Negative and NaN values, like the -9999 fill values of GEDI, are not
+    counted.
+    '''
+
+    def __init__(self, fields: list = PROFILE_FIELDS,
+                 bins: int = PROFILE_BINS,
+                 histogram_bins: int = HISTOGRAM_BINS,
+                 histogram_max: dict = None):
+        self.fields = list(fields)
+        self.bins = bins
+        self.histogram_bins = histogram_bins
+        histogram_max = {**HISTOGRAM_MAX, **(histogram_max or {})}
+        self.histogram_max = {
+            field: float(histogram_max[field]) for field in self.fields}
+        self.cells = np.empty(0, np.int64)
+        self.month_keys = np.empty(0, np.int16)
+        self.state = {
+            name: np.empty((0, *shape), dtype)
+            for name, (shape, dtype) in self._layout().items()
+        }
+
+    def __repr__(self):
+        return f'ProfileAccumulator({len(self.cells)} cell months, ' \
+            f'{self.fields})'
+
+    def _layout(self) -> dict:
+        ''' Returns the shape of a row and dtype of every state array. '''
+        layout = {}
+        for field in self.fields:
+            layout[f'{field}_count'] = ((self.bins,), np.int64)
+            layout[f'{field}_sum'] = ((self.bins,), np.float64)
+            if self.histogram_bins:
+                layout[f'{field}_histogram'] = \
+                    ((self.bins, self.histogram_bins), np.uint32)
+        return layout
+
+    def _config(self) -> dict:
+        return {
+            'fields': self.fields,
+            'bins': self.bins,
+            'histogram_bins': self.histogram_bins,
+            'histogram_max': self.histogram_max,
+        }
+
+    def _combine(self, cells: np.ndarray, month_keys: np.ndarray,
+                 state: dict):
+        '''
+        Adds the given rows of state to the accumulator, summing the rows
+        of the same cell and month.
+        '''
+        keys = np.stack([np.concatenate([self.cells, cells]),
+                         np.concatenate([self.month_keys, month_keys])],
+                        axis=1).astype(np.int64)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        # Rows of the same cell month are made adjacent and summed at once.
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        starts = np.searchsorted(inverse.reshape(-1)[order],
+                                 np.arange(len(unique)))
+        for name, (shape, dtype) in self._layout().items():
+            rows = np.concatenate([self.state[name], state[name]])
+            rows = rows[order].astype(dtype, copy=False)
+            self.state[name] = np.add.reduceat(rows, starts, axis=0) \
+                if len(unique) else rows
+        self.cells = unique[:, 0]
+        self.month_keys = unique[:, 1].astype(np.int16)
+
+    def add(self, cells, month_keys, profiles: dict) -> \
+            'ProfileAccumulator':
+        '''
+        Accumulates N profiles, given the cell and month key of each, and
+        an N x bins matrix per field.
+        '''
+        keys = np.stack([np.asarray(cells, np.int64),
+                         np.asarray(month_keys, np.int64)], axis=1)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        n = len(unique)
+        # Position of every value in the flattened (cell month, bin) axes.
+        index = inverse.reshape(-1, 1) * self.bins + np.arange(self.bins)
+        state = {}
+        for field in self.fields:
+            values = profiles[field]
+            valid = values >= 0
+            positions, values = index[valid], values[valid]
+            state[f'{field}_count'] = np.bincount(
+                positions, minlength=n * self.bins).reshape(n, self.bins)
+            state[f'{field}_sum'] = np.bincount(
+                positions, values, n * self.bins).reshape(n, self.bins)
+            if self.histogram_bins:
+                h = values * (self.histogram_bins
+                              / self.histogram_max[field])
+                h = np.minimum(h.astype(np.int64), self.histogram_bins - 1)
+                state[f'{field}_histogram'] = np.bincount(
+                    positions * self.histogram_bins + h,
+                    minlength=n * self.bins * self.histogram_bins,
+                ).reshape(n, self.bins, self.histogram_bins)
+        self._combine(unique[:, 0], unique[:, 1].astype(np.int16), state)
+        return self
+
+    def add_frame(self, df: pd.DataFrame, cell_column: str = CELL_COLUMN,
+                  profiles=None) -> 'ProfileAccumulator':
+        '''
+        Accumulates the profiles of footprints, by their cell_column and
+        month (see df_month_key). Profiles are read with profile_matrix,
+        from profiles if given, e.g. a FootprintProfiles.
+        '''
+        matrices = {
+            field: profile_matrix(df, field, self.bins, profiles)
+            for field in self.fields
+        }
+        return self.add(df[cell_column].values, df_month_key(df), matrices)
+
+    def merge(self, other: 'ProfileAccumulator') -> 'ProfileAccumulator':
+        ''' Adds the statistics of another accumulator to this one. '''
+        if other._config() != self._config():
+            raise ValueError(f"Cannot merge accumulators of {other._config()} \
+                             into {self._config()}.")
+        self._combine(other.cells, other.month_keys, other.state)
+        return self
+
+    def save(self, path: str):
+        ''' Saves the accumulator as a .npz file. '''
+        with open(f'{path}.part', 'wb') as f:
+            np.savez(f, cells=self.cells, month_keys=self.month_keys,
+                     config=json.dumps(self._config()), **self.state)
+        os.replace(f'{path}.part', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ProfileAccumulator':
+        ''' Loads an accumulator saved with save. '''
+        with np.load(path) as saved:
+            accumulator = cls(**json.loads(str(saved['config'])))
+            accumulator.cells = saved['cells']
+            accumulator.month_keys = saved['month_keys']
+            for name in accumulator.state:
+                accumulator.state[name] = saved[name]
+        return accumulator
+
+    def count(self, field: str) -> np.ndarray:
+        ''' Returns the (cell months, bins) number of values of a field. '''
+        return self.state[f'{field}_count']
+
+    def mean(self, field: str) -> np.ndarray:
+        ''' Returns the (cell months, bins) means, NaN without values. '''
+        count = self.count(field)
+        return np.divide(self.state[f'{field}_sum'], count,
+                         out=np.full(count.shape, np.nan),
+                         where=count > 0).astype(np.float32)
+
+    def quantile(self, field: str, q: float) -> np.ndarray:
+        '''
+        Returns the (cell months, bins) q quantiles, interpolated linearly
+        within the histogram bin they fall in. NaN without values.
+        '''
+        if not self.histogram_bins:
+            raise ValueError("Quantiles need an accumulator with \
+                             histogram_bins.")
+        histogram = self.state[f'{field}_histogram']
+        cumulative = histogram.cumsum(axis=2)
+        target = q * self.count(field)
+        h = (cumulative >= target[..., None]).argmax(axis=2)
+        reached = np.take_along_axis(cumulative, h[..., None], 2)[..., 0]
+        in_bin = np.take_along_axis(histogram, h[..., None], 2)[..., 0]
+        fraction = np.divide(target - reached + in_bin, in_bin,
+                             out=np.zeros(target.shape), where=in_bin > 0)
+        width = self.histogram_max[field] / self.histogram_bins
+        return np.where(self.count(field) > 0, (h + fraction) * width,
+                        np.nan).astype(np.float32)
+
+    def to_cube(self, path: str, quantiles: list = QUANTILES,
+                start: str = None, end: str = None,
+                cells: list = None) -> 'ProfileCube':
+        '''
+        Stores the count, mean and quantiles (as e.g. pai_z_q50) of every
+        field as a profile cube, and returns it opened. The months range
+        from start (inclusive) to end (exclusive), and the cells are the
+        given ones, both defaulting to those accumulated. Cells and months
+        without values are NaN.
+        '''
+        if cells is None:
+            cells = np.unique(self.cells)
+        cells = np.asarray(cells, np.int64)
+        if start is None or end is None:
+            months = month_key_to_datetime(
+                [self.month_keys.min(), self.month_keys.max() + 1])
+            start = start or months[0]
+            end = end or months[1]
+        start, end = pd.Period(start, 'M'), pd.Period(end, 'M')
+        n_months = (end - start).n
+
+        t = self.month_keys.astype(np.int32) \
+            - month_key(start.year, start.month)
+        c = np.searchsorted(cells, self.cells)
+        c[c == len(cells)] = 0
+        # Cell months outside of the axes are left out.
+        inside = (t >= 0) & (t < n_months) & (cells[c] == self.cells)
+
+        os.makedirs(path, exist_ok=True)
+        variables = []
+        for field in self.fields:
+            statistics = {
+                f'{field}_count': self.count(field),
+                f'{field}_mean': self.mean(field),
+            }
+            for q in quantiles:
+                statistics[f'{field}_q{round(q * 100)}'] = \
+                    self.quantile(field, q)
+            for variable, values in statistics.items():
+                array = np.full((len(cells), n_months, self.bins), np.nan,
+                                np.float32)
+                array[c[inside], t[inside]] = values[inside]
+                save_array(os.path.join(path, f'{variable}.npy'), array)
+                variables.append(variable)
+
+        axes = {
+            'cells': cells.tolist(),
+            'start': str(start),
+            'n_months': n_months,
+            'variables': variables,
+            'heights': bin_heights(self.bins).tolist(),
+        }
+        with open(os.path.join(path, AXES_FILE), 'w') as f:
+            json.dump(axes, f)
+        return open_profile_cube(path)
+
+
+def open_profile_cube(path: str) -> 'ProfileCube':
+    ''' Opens a profile cube, without reading any of its arrays yet. '''
+    with open(os.path.join(path, AXES_FILE)) as f:
+        axes = json.load(f)
+    return ProfileCube(path, axes)
+
+
+class ProfileCube(AnalysisCube):
+    '''
+    Lazily loaded cell x month x height cube, see ProfileAccumulator.to_cube.
+    Blocks are (cells, months, bins) arrays.
+    '''
+
+    def __init__(self, path: str, axes: dict):
+        super().__init__(path, axes)
+        self.heights = np.asarray(axes['heights'])
+
+    def __repr__(self):
+        return f'ProfileCube({len(self.cells)} cells, ' \
+            f'{self.months[0]} to {self.months[-1]}, ' \
+            f'{len(self.heights)} heights, {self.variables})'
+
+    def series(self, cell: int, variable: str, start: str = None,
+               end: str = None) -> pd.DataFrame:
+        '''
+        Returns the monthly profiles of a variable in one cell, with one
+        column per height.
+        '''
+        months = self.month_slice(start, end)
+        position = self.cell_positions(cell)[0]
+        return pd.DataFrame(
+            np.asarray(self.array(variable)[position, months]),
+            index=self.months[months].to_timestamp(), columns=self.heights)
+
+    def to_frame(self, cells=None, start: str = None, end: str = None,
+                 variables: list = None) -> pd.DataFrame:
+        '''
+        Returns a block of the cube as a long dataframe, with one row per
+        cell, month and height.
+        '''
+        df = super().to_frame(cells, start, end, variables=[])
+        df = df.loc[df.index.repeat(len(self.heights))] \
+            .reset_index(drop=True)
+        df['height'] = np.tile(self.heights, len(df) // len(self.heights))
+        block = self.block(cells, start, end, variables)
+        for variable, array in block.items():
+            df[variable] = array.reshape(-1)
+        return df
@@ -1,18 +1,42 @@
+from drought.data.cube import cell_frames
+from drought.data.df_extensions import df_month_key
+import numpy as np
 import pandas as pd
 from statsmodels.tsa.seasonal import STL
 from statsmodels.tsa import seasonal
 
 
+def polygon_time_series(df, polygon_id: int, start_date: str, end_date: str,
+                        columns: list[str]) -> pd.DataFrame:
+    '''
+    Returns the month sorted rows of one polygon, indexed by month from
+    start_date to end_date (inclusive). From an AnalysisCube, only these
+    months of the columns are read.
+    '''
+    end = pd.Period(end_date, 'M') + 1
+    _, polygon_ts = next(cell_frames(df, [polygon_id], columns, start_date,
+                                     end))
+    polygon_ts = polygon_ts.iloc[np.argsort(df_month_key(polygon_ts))]
+    polygon_ts.index = pd.date_range(
+        start=start_date, end=end_date, freq=pd.offsets.MonthBegin(1))
+    return polygon_ts
+
+
 def get_ts_seasonal_component(df: pd.DataFrame, polygon_id: int,
                               start_date: str, end_date: str,
                               columns: list[str], method='STL'
                               ) -> dict[str, pd.Series]:
-    polygon_ts = df.loc[df.polygon_id == polygon_id]
-    polygon_ts = polygon_ts.sort_values('datetime')
-    polygon_ts.index = pd.date_range(
-        start=start_date, end=end_date, freq=pd.offsets.MonthBegin(1))
+    '''
+    Returns the seasonal components of the columns of one polygon, from
+    start_date to end_date (inclusive). df is a long DataFrame or an
+    AnalysisCube, of which only the polygon's months are read.
+    '''
+    polygon_ts = polygon_time_series(df, polygon_id, start_date, end_date,
+                                     columns)
 
-    seasonal_df = polygon_ts[['polygon_id', 'date', 'month', 'year']]
+    seasonal_df = polygon_ts[[
+        col for col in ['polygon_id', 'date', 'month', 'year']
+        if col in polygon_ts.columns]]
     for column in columns:
         if method == 'STL':
             seasonal_df[column] = STL(polygon_ts[[column]], seasonal=13) \
@@ -29,10 +53,9 @@ def get_ts_seasonal_decomposition(df: pd.DataFrame, polygon_id: int,
                                   start_date: str, end_date: str,
                                   columns: list[str], method='STL'
                                   ) -> dict[str, pd.Series]:
-    polygon_ts = df.loc[df.polygon_id == polygon_id]
-    polygon_ts = polygon_ts.sort_values('datetime')
-    polygon_ts.index = pd.date_range(
-        start=start_date, end=end_date, freq=pd.offsets.MonthBegin(1))
+    ''' See get_ts_seasonal_component. '''
+    polygon_ts = polygon_time_series(df, polygon_id, start_date, end_date,
+                                     columns)
 
     seasonal = {}
     for column in columns:
@@ -56,7 +79,9 @@ def get_ts_seasonal_component_per_polygon(df: pd.DataFrame, start_date: str,
 
 
 def calculate_nrmse(original, seasonal, polygon_id, column):
-    original_polygon = original[original.polygon_id == polygon_id].set_index(
+    # The original series may be read from an AnalysisCube.
+    _, original_polygon = next(cell_frames(original, [polygon_id], [column]))
+    original_polygon = original_polygon.set_index(
         'datetime').sort_index()[column]
     seasonal_polygon = seasonal[seasonal.polygon_id == polygon_id].set_index(
         'datetime').sort_index()[column]
@@ -0,0 +1,186 @@
+"""Memory-mapped cache of the quality filtered columns of GEDI granules."""
+import hashlib
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+from utils.granule_index import BEAMS, beam_dataset, read_masked
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+# Bytes read from the start and from the end of a granule for its checksum.
+CHECKSUM_BYTES = 1 << 20
+
+# Columns cached for every granule, besides the requested fields.
+BASE_COLUMNS = ["shot_number", "lon_lowestmode", "lat_lowestmode",
+                "delta_time"]
+
+
+def granule_checksum(path: str) -> str:
+    """
+    Returns the sha1 of the size and of the first and last CHECKSUM_BYTES
+    of a granule. Granules are written once and are GBs large, so this
+    tells them apart without reading them whole.
+    """
+    sha1 = hashlib.sha1()
+    size = os.path.getsize(path)
+    sha1.update(str(size).encode())
+    with open(path, "rb") as f:
+        sha1.update(f.read(CHECKSUM_BYTES))
+        f.seek(max(size - CHECKSUM_BYTES, 0))
+        sha1.update(f.read(CHECKSUM_BYTES))
+    return sha1.hexdigest()
+
+
+def extract_columns(path: str, quality_flag: str, fields: list) -> dict:
+    """
+    Reads the shots of all beams of a granule that pass the quality
+    check. Returns an array per column, including `beam`, the position
+    of the shot's beam in BEAMS, and `row`, its row within the beam.
+    """
+    columns = {column: [] for column in
+               ["beam", "row", *BASE_COLUMNS, *fields]}
+    with h5py.File(path, "r") as granule:
+        for i, beam in enumerate(BEAMS):
+            if beam not in granule:
+                continue
+            mask = beam_dataset(granule[beam], quality_flag)[:] == 1
+            rows = np.flatnonzero(mask)
+            columns["beam"].append(np.full(len(rows), i, np.uint8))
+            columns["row"].append(rows.astype(np.int32))
+            for column in [*BASE_COLUMNS, *fields]:
+                columns[column].append(
+                    read_masked(beam_dataset(granule[beam], column), mask))
+    return {
+        column: np.concatenate(parts) if parts else np.empty(0)
+        for column, parts in columns.items()
+    }
+
+
+class ColumnCache(object):
+    """
+    Caches the quality filtered columns of GEDI granules as uncompressed
+    .npy arrays, one directory per granule and field list, which later
+    passes memory map instead of decompressing the granule again.
+
+    A sqlite manifest keys the cached directories on the checksum of the
+    granule, its quality flag and the field list, so a changed granule
+    is extracted again.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        # Granules are cached by concurrent processes.
+        self.connection = sqlite3.connect(
+            os.path.join(root, "manifest.sqlite"), timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "checksum TEXT, quality_flag TEXT, fields TEXT, path TEXT, "
+            "directory TEXT, n_shots INTEGER, created_at TEXT, PRIMARY KEY "
+            "(checksum, quality_flag, fields))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS checksums ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, checksum TEXT)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def _fields_key(fields: list) -> str:
+        return ",".join(sorted(fields))
+
+    def checksum(self, path: str) -> str:
+        """Returns the checksum of a granule, reused while unchanged."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.connection.execute(
+            "SELECT checksum FROM checksums WHERE path = ? and size = ? "
+            "and mtime = ?",
+            (path, stat.st_size, stat.st_mtime),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        checksum = granule_checksum(path)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime, checksum),
+        )
+        self.connection.commit()
+        return checksum
+
+    def _entry(self, checksum: str, quality_flag: str, fields: list):
+        row = self.connection.execute(
+            "SELECT directory, n_shots FROM entries WHERE checksum = ? "
+            "and quality_flag = ? and fields = ?",
+            (checksum, quality_flag, self._fields_key(fields)),
+        ).fetchone()
+        if row is None or not os.path.isdir(
+                os.path.join(self.root, row[0])):
+            return None
+        return row
+
+    def _write(
+        self,
+        path: str,
+        checksum: str,
+        quality_flag: str,
+        fields: list,
+    ) -> tuple:
+        """Extracts the columns of a granule into a new cache directory."""
+        key = hashlib.sha1(
+            f"{quality_flag}:{self._fields_key(fields)}".encode()
+        ).hexdigest()
+        name = os.path.splitext(os.path.basename(path))[0]
+        directory = f"{name}-{checksum[:16]}-{key[:8]}"
+        columns = extract_columns(path, quality_flag, fields)
+
+        # Columns are written aside and moved in place as a whole.
+        partial = os.path.join(self.root, f"{directory}.part")
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        for column, values in columns.items():
+            np.save(os.path.join(partial, f"{column}.npy"), values)
+        shutil.rmtree(os.path.join(self.root, directory), ignore_errors=True)
+        os.replace(partial, os.path.join(self.root, directory))
+
+        n_shots = len(columns["shot_number"])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                checksum,
+                quality_flag,
+                self._fields_key(fields),
+                os.path.abspath(path),
+                directory,
+                n_shots,
+                datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+        self.connection.commit()
+        logger.debug("Cached %d shots of %s", n_shots, path)
+        return directory, n_shots
+
+    def get(self, path: str, quality_flag: str, fields: list) -> dict:
+        """
+        Returns the quality filtered columns of a granule, see
+        `extract_columns`, as read-only memory mapped arrays. The granule
+        is extracted into the cache first if it is not cached yet.
+        """
+        checksum = self.checksum(path)
+        entry = self._entry(checksum, quality_flag, fields)
+        if entry is None:
+            entry = self._write(path, checksum, quality_flag, fields)
+        directory, n_shots = entry
+
+        columns = {}
+        for column in ["beam", "row", *BASE_COLUMNS, *fields]:
+            file = os.path.join(self.root, directory, f"{column}.npy")
+            # Empty arrays cannot be memory mapped.
+            columns[column] = np.load(file, mmap_mode="r" if n_shots else None)
+        return columns
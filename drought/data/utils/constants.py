@@ -36,6 +36,11 @@ EARTHDATA_USER = os.getenv("EARTHDATA_USER")
 EARTHDATA_PASSWORD = os.getenv("EARTHDATA_PASSWORD")
 
 GEDI_PATH = DATA_PATH / "GEDI"
+# Local DuckDB warehouse of GEDI shots extracted from the database.
+LOCAL_DB_FILE = GEDI_PATH / "gedi_shots.duckdb"
+
+# Local cache for derived files, e.g. the GEDI database table catalog.
+CACHE_PATH = Path(os.getenv("CACHE_PATH", Path.home() / ".cache" / "drought"))
 
 
 def gedi_product_path(product):
@@ -44,6 +49,7 @@ def gedi_product_path(product):
 
 GEDI_L1B_PATH = gedi_product_path(GediProduct.L1B)
 GEDI_L2A_PATH = gedi_product_path(GediProduct.L2A)
+GEDI_L2B_PATH = gedi_product_path(GediProduct.L2B)
 GEDI_L4A_PATH = gedi_product_path(GediProduct.L4A)
 JRC_PATH = DATA_PATH / "JRC"
 ENV_VARS_PATH = DATA_PATH / "EnvVars"
@@ -94,3 +100,7 @@ DB_NAME = os.getenv("DB_NAME")  # Database for GEDI shots
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_CONFIG = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:5432/{DB_NAME}"
+# Bump whenever the tables of the GEDI database change, so that cached
+# table catalogs are reflected again.
+GEDI_SCHEMA_VERSION = 1
+GEDI_CATALOG_FILE = CACHE_PATH / "gedi_table_catalog.json"
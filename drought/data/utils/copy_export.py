@@ -0,0 +1,139 @@
+"""Bulk export of query results with postgres COPY into Arrow."""
+from typing import Callable
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+# Size of the blocks the COPY stream is parsed in.
+DEFAULT_BLOCK_SIZE = 64 * 2**20
+
+# Arrow types of the postgres type OIDs found in the GEDI tables. Other
+# types, including the hex encoded WKB geometries, are kept as strings.
+PG_ARROW_TYPES = {
+    16: pa.bool_(),  # bool
+    20: pa.int64(),  # int8
+    21: pa.int16(),  # int2
+    23: pa.int32(),  # int4
+    700: pa.float32(),  # float4
+    701: pa.float64(),  # float8
+    1700: pa.float64(),  # numeric
+    1082: pa.date32(),  # date
+    1114: pa.timestamp("us"),  # timestamp
+    1184: pa.timestamp("us", tz="UTC"),  # timestamptz
+}
+
+
+def pg_arrow_schema(cursor, sql_query: str) -> pa.Schema:
+    """Returns the Arrow schema of the query result, without running it."""
+    cursor.execute(f"SELECT * FROM ({sql_query}) AS query LIMIT 0")
+    return pa.schema(
+        [
+            (column.name, PG_ARROW_TYPES.get(column.type_code, pa.string()))
+            for column in cursor.description
+        ]
+    )
+
+
+class CsvBlockParser(object):
+    """
+    File-like sink for `COPY ... TO STDOUT WITH (FORMAT csv, HEADER)`.
+
+    Buffers the stream and parses every `block_size` bytes of complete
+    lines into an Arrow table with the given `schema`, which is passed to
+    `on_table`. Assumes no quoted field contains a newline, which
+    holds for the numeric, time and WKB columns of the GEDI tables.
+    """
+
+    def __init__(
+        self,
+        schema: pa.Schema,
+        on_table: Callable,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+    ):
+        self.schema = schema
+        self.on_table = on_table
+        self.block_size = block_size
+        self.header = None
+        self.buffer = bytearray()
+        self.read_options = pa_csv.ReadOptions(block_size=block_size)
+        self.convert_options = pa_csv.ConvertOptions(
+            column_types=schema,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+        )
+
+    def write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            self._parse(final=False)
+
+    def close(self):
+        """Parses the remaining lines, call once the COPY has finished."""
+        self._parse(final=True)
+
+    def _parse(self, final: bool):
+        if self.header is None:
+            header_end = self.buffer.find(b"\n") + 1
+            if header_end == 0:
+                return
+            self.header = bytes(self.buffer[:header_end])
+            del self.buffer[:header_end]
+
+        end = len(self.buffer) if final else self.buffer.rfind(b"\n") + 1
+        if end == 0:
+            return
+        block = self.header + self.buffer[:end]
+        del self.buffer[:end]
+        table = pa_csv.read_csv(
+            pa.BufferReader(block),
+            read_options=self.read_options,
+            convert_options=self.convert_options,
+        )
+        self.on_table(table.select(self.schema.names))
+
+
+def copy_to_parquet(
+    engine,
+    sql_query: str,
+    path: str,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    compression: str = "zstd",
+    transform: Callable = None,
+) -> int:
+    """
+    Exports the query result into a parquet file at `path`, one row group
+    per parsed block, and returns the number of rows written. Every block
+    is passed through `transform`, if given, which maps an Arrow table to
+    another one whose schema only depends on the schema of its input.
+    """
+    if transform is None:
+        transform = lambda table: table  # noqa: E731
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        schema = pg_arrow_schema(cursor, sql_query)
+        out_schema = transform(schema.empty_table()).schema
+        with pq.ParquetWriter(
+            path, out_schema, compression=compression
+        ) as f:
+            parser = CsvBlockParser(
+                schema,
+                lambda table: f.write_table(transform(table)),
+                block_size,
+            )
+            cursor.copy_expert(
+                f"COPY ({sql_query}) TO STDOUT WITH (FORMAT csv, HEADER)",
+                parser,
+            )
+            parser.close()
+        n_rows = pq.ParquetFile(path).metadata.num_rows
+        connection.commit()
+    finally:
+        connection.close()
+    logger.info("Exported %d rows to %s", n_rows, path)
+    return n_rows
@@ -1,13 +1,70 @@
+import json
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator
+
 import geopandas as gpd
 import pandas as pd
 import pyproj
-from sqlalchemy import create_engine, inspect
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import NoSuchTableError, OperationalError
 
-from utils.constants import DB_CONFIG, WGS84
+from utils.constants import (
+    DB_CONFIG,
+    DB_HOST,
+    DB_NAME,
+    GEDI_CATALOG_FILE,
+    GEDI_SCHEMA_VERSION,
+    WGS84,
+)
+from utils.copy_export import DEFAULT_BLOCK_SIZE, copy_to_parquet
 from utils.logging_util import get_logger
+from utils.query_cache import QueryCache
+from utils.table_catalog import TableCatalog
+from utils.task_manifest import TaskManifest
 
 logger = get_logger(__file__)
 
+# Shot location columns, from which point geometries can be built locally.
+LON_LAT_COLUMNS = ["lon_lowestmode", "lat_lowestmode"]
+
+# Marks the end of the task iterator of GediQueryExecutor.
+_NO_TASK = object()
+
+# Default number of rows per chunk when streaming query results.
+DEFAULT_CHUNK_ROWS = 100_000
+
+# Product tables that have a `pai` column.
+PAI_TABLES = ["level_2b"]
+
+# Cadences that can be bucketed directly with postgres `date_trunc`.
+DATE_TRUNC_CADENCES = ["day", "week", "month", "quarter", "year"]
+
+# Keys the shots can be grouped by when aggregating in the database.
+GROUP_KEYS = {
+    "polygon_id": "polygons.polygon_id",
+    "year": "extract(year from shots.absolute_time)::int",
+    "month": "extract(month from shots.absolute_time)::int",
+    "day": "extract(day from shots.absolute_time)::int",
+}
+
+# Maximum number of vertices of the polygon parts shots are tested against.
+SUBDIVIDE_MAX_VERTICES = 64
+
+# Reducers that can be pushed down to the database.
+SQL_REDUCERS = {
+    "count": "count({})",
+    "mean": "avg({})",
+    "stddev": "stddev_samp({})",
+    "min": "min({})",
+    "max": "max({})",
+    "sum": "sum({})",
+    "median": "percentile_cont(0.5) WITHIN GROUP (ORDER BY {})",
+}
+
 
 def gedi_sql_query(
     table_name: str,
@@ -18,22 +75,30 @@ def gedi_sql_query(
     end_time: str = None,
     limit: int = None,
     force: bool = False,
+    conditions: list = None,
 ):
 
-    # NOTE additonal conditions can be specified here
-    conditions = []
-    # Temporal conditions
+    # Additional conditions on the shot columns, pushed into the WHERE
+    conditions = list(conditions or [])
+    # Temporal conditions, [start_time, end_time) so that consecutive
+    # windows do not share the shots of their boundary
     if start_time is not None and end_time is not None:
         conditions += [
-            f"absolute_time between '{start_time}' and '{end_time}'"
+            f"absolute_time >= '{start_time}'",
+            f"absolute_time < '{end_time}'",
         ]
     # Spatial conditions
     if geometry is not None:
         crs = pyproj.CRS.from_user_input(crs)
+        shape = (
+            f"ST_GeomFromText('{geometry.to_wkt().values[0]}', "
+            f"{crs.to_epsg()})"
+        )
+        # The bounding box test is answered by the spatial index, and only
+        # its candidates are tested exactly.
         conditions += [
-            "ST_Intersects(geometry, "
-            f"ST_GeomFromText( \
-                '{geometry.to_wkt().values[0]}', {crs.to_epsg()}))"
+            f"geometry && {shape}",
+            f"ST_Intersects(geometry, {shape})",
         ]
     # Combining conditions
     condition = (
@@ -54,18 +119,670 @@ def gedi_sql_query(
     return sql_query
 
 
+def gedi_sql_time_bucket(
+    cadence,
+    origin: str,
+    time_column: str = "absolute_time",
+):
+    """
+    Returns the SQL expression that assigns `time_column` to a time bucket.
+
+    `cadence` is either one of DATE_TRUNC_CADENCES (calendar buckets) or a
+    fixed window given as a `timedelta` or a number of days, in which case
+    buckets start at `origin` and are `cadence` long.
+    """
+    if isinstance(cadence, str):
+        if cadence not in DATE_TRUNC_CADENCES:
+            raise ValueError(
+                f"Unsupported cadence {cadence}. \
+                Must be one of {DATE_TRUNC_CADENCES} or a timedelta."
+            )
+        return f"date_trunc('{cadence}', {time_column})"
+
+    if not isinstance(cadence, timedelta):
+        cadence = timedelta(days=cadence)
+    seconds = int(cadence.total_seconds())
+    if seconds <= 0:
+        raise ValueError("Cadence must be a positive time interval.")
+    return (
+        f"'{origin}'::timestamp + floor(extract(epoch from "
+        f"{time_column} - '{origin}'::timestamp) / {seconds}) "
+        f"* interval '{seconds} seconds'"
+    )
+
+
+def gedi_qa_conditions(table_name: str, columns: list = "*") -> list:
+    """
+    Returns the quality conditions on the shots of a product table, the
+    quality flag equals 1 and, if PAI is queried, PAI is greater than 0.
+    Selecting all columns queries PAI only on the tables of PAI_TABLES.
+    """
+    conditions = [f"l{table_name.split('_')[1]}_quality_flag = 1"]
+    if (columns == "*" and table_name in PAI_TABLES) or (
+        columns != "*" and "pai" in columns
+    ):
+        conditions += ["pai > 0"]
+    return conditions
+
+
+@lru_cache(maxsize=64)
+def _polygons_cte(polygons: tuple, epsg: int, max_vertices: int) -> str:
+    polygon_values = ", ".join(
+        f"({polygon_id}, ST_GeomFromText('{wkt}', {epsg}))"
+        for polygon_id, wkt in polygons
+    )
+    return (
+        f"polygons (polygon_id, geometry) AS (VALUES {polygon_values}), "
+        "polygon_parts AS MATERIALIZED (SELECT polygon_id, "
+        f"ST_Subdivide(geometry, {max_vertices}) AS geometry FROM polygons)"
+    )
+
+
+def gedi_sql_polygons_cte(
+    polygons: gpd.GeoDataFrame,
+    id_column: str = "id",
+    max_vertices: int = SUBDIVIDE_MAX_VERTICES,
+):
+    """
+    Returns a `polygons (polygon_id, geometry)` CTE for the polygon set,
+    and a `polygon_parts` CTE holding the polygons subdivided into parts
+    of at most `max_vertices` vertices. The parts are computed once per
+    query (`MATERIALIZED` needs postgres 12) and the generated SQL is
+    cached for polygon sets that are queried repeatedly.
+    """
+    crs = pyproj.CRS.from_user_input(polygons.crs)
+    return _polygons_cte(
+        tuple(
+            (int(polygon_id), wkt)
+            for polygon_id, wkt in zip(
+                polygons[id_column], polygons.geometry.to_wkt()
+            )
+        ),
+        crs.to_epsg(),
+        max_vertices,
+    )
+
+
+def gedi_sql_polygon_join(
+    table_name: str,
+    polygons: gpd.GeoDataFrame,
+    start_time: str,
+    end_time: str,
+    conditions: list = None,
+    id_column: str = "id",
+):
+    """
+    Returns the `WITH`, `FROM` and `WHERE` clauses that join the shots of
+    [start_time, end_time) against the polygon set. Extra `conditions` on
+    the shot columns are and-ed to the temporal condition.
+
+    Shots are matched to the bounding box of the polygon set and of every
+    polygon with `&&`, which the spatial index answers, and only those
+    candidates are tested against the subdivided parts of their polygon.
+    Testing the parts in an `EXISTS` keeps shots on the edge between two
+    parts from being returned twice.
+    """
+    with_clause = f"WITH {gedi_sql_polygons_cte(polygons, id_column)}"
+    from_clause = (
+        f"FROM {table_name} AS shots JOIN polygons "
+        "ON shots.geometry && polygons.geometry"
+    )
+    conditions = [
+        f"shots.absolute_time >= '{start_time}'",
+        f"shots.absolute_time < '{end_time}'",
+        "shots.geometry && "
+        "(SELECT ST_Envelope(ST_Collect(geometry)) FROM polygons)",
+    ] + (conditions or []) + [
+        "EXISTS (SELECT 1 FROM polygon_parts AS parts "
+        "WHERE parts.polygon_id = polygons.polygon_id "
+        "and ST_Intersects(shots.geometry, parts.geometry))"
+    ]
+    where_clause = f"WHERE {' and '.join(conditions)}"
+    return with_clause, from_clause, where_clause
+
+
+def gedi_sql_polygon_query(
+    table_name: str,
+    polygons: gpd.GeoDataFrame,
+    start_time: str,
+    end_time: str,
+    columns: list = "*",
+    cadence="month",
+    origin: str = None,
+    id_column: str = "id",
+    conditions: list = None,
+):
+    """
+    Builds one query that joins the shots against the whole polygon set.
+
+    The polygons are inlined as a `VALUES` list, so every polygon and every
+    time window in [start_time, end_time) is served by a single query plan.
+    Each returned shot carries the `polygon_id` of the polygon it falls in
+    and the `time_bucket` it belongs to, both computed on the server.
+    Fixed-length buckets start at `origin`, which defaults to `start_time`.
+    Only shots meeting the extra `conditions` are returned.
+    """
+    if columns == "*":
+        shot_columns = "shots.*"
+    else:
+        shot_columns = ", ".join(f"shots.{column}" for column in columns)
+    time_bucket = gedi_sql_time_bucket(
+        cadence,
+        origin or start_time,
+        time_column="shots.absolute_time",
+    )
+    with_clause, from_clause, where_clause = gedi_sql_polygon_join(
+        table_name,
+        polygons,
+        start_time,
+        end_time,
+        conditions=conditions,
+        id_column=id_column,
+    )
+
+    sql_query = (
+        f"{with_clause} "
+        f"SELECT {shot_columns}, polygons.polygon_id, "
+        f"{time_bucket} AS time_bucket "
+        f"{from_clause} {where_clause}"
+    )
+    return sql_query
+
+
+def gedi_sql_count_query(
+    table_name: str,
+    polygons: gpd.GeoDataFrame,
+    start_time: str,
+    end_time: str,
+    conditions: list = None,
+    id_column: str = "id",
+):
+    """
+    Builds a query that counts the shots `gedi_sql_polygon_query` returns
+    for [start_time, end_time).
+    """
+    with_clause, from_clause, where_clause = gedi_sql_polygon_join(
+        table_name,
+        polygons,
+        start_time,
+        end_time,
+        conditions=conditions,
+        id_column=id_column,
+    )
+    return f"{with_clause} SELECT count(*) {from_clause} {where_clause}"
+
+
+def gedi_sql_reducer(column: str, reducer):
+    """
+    Returns the (SQL expression, output column name) of a reducer.
+
+    `reducer` is one of SQL_REDUCERS or a quantile given as a float in
+    [0, 1], which is computed with `percentile_cont`.
+    """
+    if isinstance(reducer, float):
+        if not 0 <= reducer <= 1:
+            raise ValueError(f"Quantile {reducer} must be in [0, 1].")
+        name = f"{column}_q{reducer * 100:g}".replace(".", "_")
+        return (
+            f"percentile_cont({reducer}) WITHIN GROUP "
+            f"(ORDER BY shots.{column})",
+            name,
+        )
+    if reducer not in SQL_REDUCERS:
+        raise ValueError(
+            f"Unsupported reducer {reducer}. \
+            Must be a quantile or one of {list(SQL_REDUCERS)}."
+        )
+    return SQL_REDUCERS[reducer].format(f"shots.{column}"), \
+        f"{column}_{reducer}"
+
+
+def gedi_sql_aggregate_query(
+    table_name: str,
+    polygons: gpd.GeoDataFrame,
+    measures: dict,
+    start_time: str,
+    end_time: str,
+    group_by: list = ["polygon_id", "year", "month"],
+    cadence="month",
+    origin: str = None,
+    conditions: list = None,
+    id_column: str = "id",
+):
+    """
+    Builds a query that reduces the shots per group inside the database.
+
+    `measures` maps a shot column to the list of its reducers, e.g.
+    {"pai": ["count", "mean", "median", 0.9]}, and every reducer becomes a
+    `<column>_<reducer>` output column. `group_by` is any of GROUP_KEYS,
+    where `time_bucket` buckets the shots by `cadence`.
+    """
+    group_keys = []
+    for key in group_by:
+        if key == "time_bucket":
+            group_keys.append(
+                gedi_sql_time_bucket(
+                    cadence,
+                    origin or start_time,
+                    time_column="shots.absolute_time",
+                )
+            )
+        elif key in GROUP_KEYS:
+            group_keys.append(GROUP_KEYS[key])
+        else:
+            raise ValueError(
+                f"Unsupported group key {key}. \
+                Must be one of {list(GROUP_KEYS) + ['time_bucket']}."
+            )
+
+    aggregates = []
+    for column, reducers in measures.items():
+        for reducer in reducers:
+            expression, name = gedi_sql_reducer(column, reducer)
+            aggregates.append(f"{expression} AS {name}")
+
+    with_clause, from_clause, where_clause = gedi_sql_polygon_join(
+        table_name,
+        polygons,
+        start_time,
+        end_time,
+        conditions=conditions,
+        id_column=id_column,
+    )
+    selected = [
+        f"{expression} AS {key}"
+        for key, expression in zip(group_by, group_keys)
+    ]
+    group_indices = ", ".join(str(i + 1) for i in range(len(group_by)))
+
+    sql_query = (
+        f"{with_clause} "
+        f"SELECT {', '.join(selected + aggregates)} "
+        f"{from_clause} {where_clause} "
+        f"GROUP BY {group_indices} ORDER BY {group_indices}"
+    )
+    return sql_query
+
+
+def _geometry_columns(columns, fetch_geometry: bool, lazy_geometry: bool):
+    """
+    Returns the columns to select and whether the geometry column is among
+    them. Lazy geometries are replaced by the lon/lat columns.
+    """
+    if lazy_geometry:
+        if columns != "*":
+            columns = columns + [
+                column for column in LON_LAT_COLUMNS if column not in columns
+            ]
+        return columns, False
+    if fetch_geometry and columns != "*" and "geometry" not in columns:
+        columns = columns + ["geometry"]
+    return columns, fetch_geometry
+
+
+def gedi_points(df: pd.DataFrame, crs: str = WGS84) -> gpd.GeoDataFrame:
+    """
+    Builds the shot point geometries from the lon/lat columns in one
+    vectorised call, instead of decoding a geometry per row.
+    """
+    lon, lat = LON_LAT_COLUMNS
+    return gpd.GeoDataFrame(
+        df, geometry=gpd.points_from_xy(df[lon], df[lat]), crs=crs
+    )
+
+
+def gedi_time_windows(
+    start_time: str,
+    end_time: str,
+    freq: str = "YS",
+    step_days: int = 1,
+    origin: str = None,
+) -> list:
+    """
+    Splits [start_time, end_time) into consecutive (start, end) windows
+    at the boundaries of the pandas offset alias `freq`, each moved back
+    onto the grid of multiples of `step_days` from `origin`, which
+    defaults to `start_time`.
+    """
+    start_time, end_time = pd.Timestamp(start_time), pd.Timestamp(end_time)
+    if start_time >= end_time:
+        return []
+    origin = pd.Timestamp(origin or start_time)
+    step = pd.Timedelta(days=step_days)
+    boundaries = sorted({
+        origin + ((boundary - origin) // step) * step
+        for boundary in pd.date_range(start_time, end_time, freq=freq)
+    })
+    boundaries = [
+        boundary for boundary in boundaries if start_time < boundary < end_time
+    ]
+    boundaries = [start_time, *boundaries, end_time]
+    return [
+        (start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def gedi_adaptive_windows(
+    estimate: Callable[[str, str], int],
+    start_time: str,
+    end_time: str,
+    target_rows: int,
+    freq: str = "YS",
+    step_days: int = 1,
+    origin: str = None,
+) -> list:
+    """
+    Splits [start_time, end_time) into windows of about `target_rows` rows.
+
+    Starts from the `freq` windows of `gedi_time_windows`, halves every
+    window whose `estimate(start, end)` exceeds `target_rows`, then merges
+    runs of consecutive small windows as long as their summed estimate
+    stays within `target_rows`. Window boundaries are kept on multiples of
+    `step_days` from `origin`, which defaults to `start_time`, and
+    `step_days` is also the shortest window.
+    """
+    origin = pd.Timestamp(origin or start_time)
+    step = pd.Timedelta(days=step_days)
+
+    def split(start, end):
+        n_rows = estimate(start, end)
+        n_steps = (pd.Timestamp(end) - pd.Timestamp(start)) // step
+        if n_rows <= target_rows or n_steps < 2:
+            return [(start, end, n_rows)]
+        # Snap the middle of the window to the step grid.
+        middle = pd.Timestamp(start) + (n_steps // 2) * step
+        middle = origin + ((middle - origin) // step) * step
+        middle = middle.strftime("%Y-%m-%d")
+        return split(start, middle) + split(middle, end)
+
+    windows = []
+    for window in gedi_time_windows(
+        start_time, end_time, freq, step_days, origin
+    ):
+        for start, end, n_rows in split(*window):
+            if windows and windows[-1][2] + n_rows <= target_rows:
+                windows[-1] = (windows[-1][0], end, windows[-1][2] + n_rows)
+            else:
+                windows.append((start, end, n_rows))
+    logger.debug(
+        "Planned %d windows of about %d rows between %s and %s",
+        len(windows), target_rows, start_time, end_time,
+    )
+    return [(start, end) for start, end, _ in windows]
+
+
+def gedi_plan_windows(
+    executor: "GediQueryExecutor",
+    manifest: TaskManifest,
+    shape: gpd.GeoDataFrame,
+    product_level: str,
+    columns: list,
+    start_times: dict,
+    end_time: str,
+    target_rows: int,
+    estimate: str,
+    step_days: int = 1,
+    origin: str = None,
+    conditions: list = None,
+) -> dict:
+    """
+    Returns the query windows of every polygon from its `start_times`
+    entry to `end_time`, planning them to hold about `target_rows` shots
+    each, see `gedi_adaptive_windows`. Plans are kept in the manifest, so
+    a rerun queries the same windows as the run it resumes.
+    """
+    def plan_task(database, polygon_id):
+        polygons = shape[shape.id == polygon_id]
+        return gedi_adaptive_windows(
+            lambda start, end: database.estimate_rows(
+                product_level, polygons, start, end,
+                conditions=conditions, method=estimate),
+            start_times[polygon_id],
+            end_time,
+            target_rows,
+            step_days=step_days,
+            origin=origin,
+        )
+
+    def is_planned(polygon_id):
+        windows = manifest.planned_windows(
+            product_level, polygon_id, columns, start_times[polygon_id],
+            end_time)
+        return bool(windows) and windows[0][0] == start_times[polygon_id] \
+            and windows[-1][1] == end_time
+
+    unplanned = [
+        polygon_id for polygon_id in shape.id if not is_planned(polygon_id)
+    ]
+    for polygon_id, windows in executor.map(plan_task, unplanned):
+        manifest.save_plan(product_level, polygon_id, columns, windows)
+    return {
+        polygon_id: manifest.planned_windows(
+            product_level, polygon_id, columns, start_times[polygon_id],
+            end_time)
+        for polygon_id in shape.id
+    }
+
+
 class GediDatabase(object):
-    """Database connector for the GEDI DB."""
+    """
+    Database connector for the GEDI DB.
 
-    def __init__(self):
-        self.engine = create_engine(DB_CONFIG, echo=False)
-        self.inspector = inspect(self.engine)
+    If a QueryCache is given, the results of `query`, `query_polygons` and
+    `aggregate` are served from it whenever the same query was run before.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 5,
+        cache: QueryCache = None,
+        catalog: TableCatalog = None,
+        max_overflow: int = 10,
+    ):
+        # Up to `max_overflow` connections beyond `pool_size` are opened on
+        # demand, SQLAlchemy's default.
+        self.engine = create_engine(
+            DB_CONFIG,
+            echo=False,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+        )
+        self.cache = cache
+        # Table columns are reflected lazily, on first use of each table.
+        self.catalog = (
+            catalog
+            if catalog is not None
+            else TableCatalog(
+                GEDI_CATALOG_FILE,
+                database=f"{DB_HOST}/{DB_NAME}",
+                schema_version=GEDI_SCHEMA_VERSION,
+            )
+        )
         self.allowed_cols = {}
-        for table_name in self.inspector.get_table_names():
-            allowed_cols = {
-                col["name"] for col in self.inspector.get_columns(table_name)
+
+    def _reflect_columns(self, table_name: str) -> set:
+        """Reflects the columns of one table and caches them."""
+        try:
+            columns = {
+                col["name"]
+                for col in inspect(self.engine).get_columns(table_name)
             }
-            self.allowed_cols[table_name] = allowed_cols
+        except NoSuchTableError:
+            columns = set()
+        if not columns:
+            raise ValueError(f"Unsupported table {table_name}.")
+        self.catalog.put(table_name, columns)
+        self.allowed_cols[table_name] = columns
+        return columns
+
+    def _table_columns(self, table_name: str) -> set:
+        """Returns the columns of the table, reflecting it if needed."""
+        if table_name not in self.allowed_cols:
+            columns = self.catalog.get(table_name)
+            if columns is None:
+                return self._reflect_columns(table_name)
+            self.allowed_cols[table_name] = columns
+        return self.allowed_cols[table_name]
+
+    def _check_columns(self, table_name: str, columns):
+        """Raises if the table or any of the columns is not in the DB."""
+        allowed_cols = self._table_columns(table_name)
+
+        if columns != "*":
+            # The cached catalog may predate newly added columns.
+            if not set(columns) <= allowed_cols:
+                allowed_cols = self._reflect_columns(table_name)
+            for column in columns:
+                if column not in allowed_cols:
+                    raise ValueError(
+                        f"`{column}` not allowed. \
+                            Must be one of {allowed_cols}"
+                    )
+
+    def _lazy_columns(self, table_name: str, columns, lazy_geometry: bool):
+        """
+        Expands `*` into the table's columns other than the geometry when
+        the geometry is not transferred, so it is not selected either.
+        """
+        if lazy_geometry and columns == "*":
+            return sorted(self._table_columns(table_name) - {"geometry"})
+        return columns
+
+    def _query_sql(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        use_geopandas: bool = False,
+        force: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+    ):
+        """
+        Returns the SQL query of `query` and whether it fetches the geometry
+        column.
+        """
+        self._check_columns(table_name, columns)
+        columns = self._lazy_columns(table_name, columns, lazy_geometry)
+
+        fetch_geometry = use_geopandas or geometry is not None
+        columns, fetch_geometry = _geometry_columns(
+            columns, fetch_geometry, lazy_geometry
+        )
+
+        # Construct sql query
+        sql_query = gedi_sql_query(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            limit=limit,
+            start_time=start_time,
+            end_time=end_time,
+            force=force,
+            conditions=conditions,
+        )
+        logger.debug("SQL Query: %s", sql_query)
+        return sql_query, fetch_geometry
+
+    def _polygons_sql(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        use_geopandas: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+    ):
+        """
+        Returns the SQL query of `query_polygons` and whether it fetches
+        the geometry column.
+        """
+        self._check_columns(table_name, columns)
+        columns = self._lazy_columns(table_name, columns, lazy_geometry)
+
+        columns, fetch_geometry = _geometry_columns(
+            columns, use_geopandas, lazy_geometry
+        )
+
+        sql_query = gedi_sql_polygon_query(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            conditions=conditions,
+        )
+        logger.debug("SQL Query: %s", sql_query)
+        return sql_query, fetch_geometry
+
+    def _read_sql(
+        self,
+        sql_query: str,
+        use_geopandas: bool,
+        columns="*",
+    ) -> pd.DataFrame:
+        """
+        Runs the query and loads the whole result in memory, or loads it
+        from the cache if there is one.
+        """
+        if self.cache is not None:
+            key = self.cache.key(sql_query, columns, use_geopandas)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.debug("Cache hit: %s", key)
+                return cached
+
+        if use_geopandas:
+            result = gpd.read_postgis(
+                sql_query, con=self.engine, geom_col="geometry"
+            )
+        else:
+            result = pd.read_sql(sql_query, con=self.engine)
+
+        if self.cache is not None:
+            self.cache.put(key, result)
+        return result
+
+    def _read_sql_iter(
+        self,
+        sql_query: str,
+        use_geopandas: bool,
+        chunk_rows: int,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Runs the query on a server-side cursor and yields the result in
+        chunks of at most `chunk_rows` rows, so only one chunk is held in
+        memory at a time.
+        """
+        with self.engine.connect().execution_options(
+            stream_results=True, max_row_buffer=chunk_rows
+        ) as connection:
+            if use_geopandas:
+                chunks = gpd.read_postgis(
+                    sql_query,
+                    con=connection,
+                    geom_col="geometry",
+                    chunksize=chunk_rows,
+                )
+            else:
+                chunks = pd.read_sql(
+                    sql_query, con=connection, chunksize=chunk_rows
+                )
+            yield from chunks
 
     def query(
         self,
@@ -78,52 +795,402 @@ class GediDatabase(object):
         limit: int = None,
         use_geopandas: bool = False,
         force: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
     ) -> pd.DataFrame:
+        """
+        Queries the shots of the table, optionally within a geometry and a
+        time range.
 
-        if table_name not in self.allowed_cols:
-            raise ValueError("Unsupported table {table_name}.")
+        With `lazy_geometry` set the geometry column is not transferred,
+        not even for all `columns`, the spatial filter still runs on the
+        server but only the lon/lat columns are returned. If
+        `use_geopandas` is set as well, the point geometries are built
+        locally from lon/lat.
+        """
+        sql_query, fetch_geometry = self._query_sql(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            start_time=start_time,
+            end_time=end_time,
+            limit=limit,
+            use_geopandas=use_geopandas,
+            force=force,
+            lazy_geometry=lazy_geometry,
+            conditions=conditions,
+        )
+        result = self._read_sql(sql_query, fetch_geometry, columns)
+        if use_geopandas and lazy_geometry:
+            return gedi_points(result)
+        return result
 
-        if columns != "*":
-            for column in columns:
-                if column in self.allowed_cols[table_name] is False:
-                    raise ValueError(
-                        f"`{column}` not allowed. \
-                            Must be one of {self.allowed_cols[table_name]}"
-                    )
+    def query_iter(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        use_geopandas: bool = False,
+        force: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    ) -> Iterator[pd.DataFrame]:
+        """Same as `query`, but streams the result in `chunk_rows` chunks."""
+        sql_query, fetch_geometry = self._query_sql(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            start_time=start_time,
+            end_time=end_time,
+            limit=limit,
+            use_geopandas=use_geopandas,
+            force=force,
+            lazy_geometry=lazy_geometry,
+            conditions=conditions,
+        )
+        chunks = self._read_sql_iter(sql_query, fetch_geometry, chunk_rows)
+        if use_geopandas and lazy_geometry:
+            return map(gedi_points, chunks)
+        return chunks
 
-        if use_geopandas or geometry is not None:
-            if columns != "*" and "geometry" not in columns:
-                columns += ["geometry"]
+    def query_polygons(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        use_geopandas: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+    ) -> pd.DataFrame:
+        """
+        Queries the shots of all polygons and all time windows at once.
+
+        Returns one row per (shot, polygon) with the extra columns
+        `polygon_id` and `time_bucket` (the start of the shot's window).
+        See `gedi_sql_polygon_query` for the supported cadences and `query`
+        for `lazy_geometry`. SQL `conditions` on the shot columns, such as
+        those of `gedi_qa_conditions`, are applied in the database.
+        """
+        sql_query, fetch_geometry = self._polygons_sql(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            use_geopandas=use_geopandas,
+            lazy_geometry=lazy_geometry,
+            conditions=conditions,
+        )
+        result = self._read_sql(sql_query, fetch_geometry, columns)
+        if use_geopandas and lazy_geometry:
+            return gedi_points(result)
+        return result
 
-            # Construct sql query
-            sql_query = gedi_sql_query(
+    def query_polygons_iter(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        use_geopandas: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Same as `query_polygons`, but streams the result in `chunk_rows`
+        chunks.
+        """
+        sql_query, fetch_geometry = self._polygons_sql(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            use_geopandas=use_geopandas,
+            lazy_geometry=lazy_geometry,
+            conditions=conditions,
+        )
+        chunks = self._read_sql_iter(sql_query, fetch_geometry, chunk_rows)
+        if use_geopandas and lazy_geometry:
+            return map(gedi_points, chunks)
+        return chunks
+
+    def estimate_rows(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        conditions: list = None,
+        id_column: str = "id",
+        method: str = "explain",
+    ) -> int:
+        """
+        Estimates the number of shots of the polygons in [start_time,
+        end_time). With `method="explain"` the planner's row estimate is
+        used, which is nearly free but only as good as the table
+        statistics, while `method="count"` runs an exact count.
+        """
+        if method == "count":
+            sql_query = gedi_sql_count_query(
                 table_name,
-                columns=columns,
-                geometry=geometry,
-                crs=crs,
-                limit=limit,
+                polygons,
                 start_time=start_time,
                 end_time=end_time,
-                force=force,
+                conditions=conditions,
+                id_column=id_column,
             )
-
-            logger.debug("SQL Query: %s", sql_query)
-            return gpd.read_postgis(
-                sql_query, con=self.engine, geom_col="geometry"
+        elif method == "explain":
+            # Explain the join itself, the estimate of a count(*) on top of
+            # it may be split across parallel workers.
+            sql_query = "EXPLAIN (FORMAT JSON) {} SELECT 1 {} {}".format(
+                *gedi_sql_polygon_join(
+                    table_name,
+                    polygons,
+                    start_time,
+                    end_time,
+                    conditions=conditions,
+                    id_column=id_column,
+                )
             )
-
         else:
-            # Construct sql query
-            sql_query = gedi_sql_query(
-                table_name,
-                columns=columns,
-                geometry=geometry,
-                crs=crs,
-                limit=limit,
-                start_time=start_time,
-                end_time=end_time,
-                force=force,
+            raise ValueError(
+                f"Unsupported method {method}. \
+                Must be one of ['explain', 'count']."
             )
 
-            logger.debug("SQL Query: %s", sql_query)
-            return pd.read_sql(sql_query, con=self.engine)
+        with self.engine.connect() as connection:
+            result = connection.execute(text(sql_query)).scalar()
+        if method == "count":
+            return int(result)
+        if isinstance(result, str):
+            result = json.loads(result)
+        return int(result[0]["Plan"]["Plan Rows"])
+
+    def export(
+        self,
+        path: str,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        force: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        transform: Callable = None,
+    ) -> int:
+        """
+        Bulk exports the result of `query` into a parquet file at `path`
+        with `COPY ... TO STDOUT`, parsed straight into Arrow, and returns
+        the number of exported rows. Geometries stay hex encoded WKB. Each
+        parsed Arrow table is passed through `transform` if given, see
+        `copy_to_parquet`.
+        """
+        sql_query, _ = self._query_sql(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            start_time=start_time,
+            end_time=end_time,
+            limit=limit,
+            force=force,
+            lazy_geometry=lazy_geometry,
+            conditions=conditions,
+        )
+        return copy_to_parquet(
+            self.engine, sql_query, path, block_size, transform=transform
+        )
+
+    def export_polygons(
+        self,
+        path: str,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        transform: Callable = None,
+    ) -> int:
+        """
+        Bulk exports the result of `query_polygons` into a parquet file at
+        `path`, see `export`.
+        """
+        sql_query, _ = self._polygons_sql(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            lazy_geometry=lazy_geometry,
+            conditions=conditions,
+        )
+        return copy_to_parquet(
+            self.engine, sql_query, path, block_size, transform=transform
+        )
+
+    def aggregate(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        measures: dict,
+        start_time: str,
+        end_time: str,
+        group_by: list = ["polygon_id", "year", "month"],
+        cadence="month",
+        origin: str = None,
+        conditions: list = None,
+        id_column: str = "id",
+    ) -> pd.DataFrame:
+        """
+        Reduces the shots of the polygons inside the database and returns
+        one row per group. See `gedi_sql_aggregate_query` for the supported
+        group keys and reducers.
+        """
+        self._check_columns(table_name, list(measures))
+
+        sql_query = gedi_sql_aggregate_query(
+            table_name,
+            polygons,
+            measures,
+            start_time=start_time,
+            end_time=end_time,
+            group_by=group_by,
+            cadence=cadence,
+            origin=origin,
+            conditions=conditions,
+            id_column=id_column,
+        )
+
+        logger.debug("SQL Query: %s", sql_query)
+        return self._read_sql(sql_query, False, list(measures))
+
+
+class GediQueryExecutor(object):
+    """
+    Runs GEDI query tasks concurrently on a pool of database connections.
+
+    Every task is run as `fn(database, task)` on one of `jobs` threads that
+    share a GediDatabase whose connection pool holds `jobs` connections.
+    At most `max_in_flight` tasks are submitted at a time, and tasks that
+    fail with one of `retry_on` are retried up to `retries` times with
+    exponential backoff starting at `backoff` seconds.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 4,
+        database: GediDatabase = None,
+        max_in_flight: int = None,
+        retries: int = 3,
+        backoff: float = 1.0,
+        retry_on: tuple = (OperationalError,),
+    ):
+        self.jobs = jobs
+        # Exactly `jobs` connections, one per worker thread.
+        self.database = (
+            database
+            if database is not None
+            else GediDatabase(pool_size=jobs, max_overflow=0)
+        )
+        self.max_in_flight = max_in_flight or 2 * jobs
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+
+    def _run(self, fn: Callable, task):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(self.database, task)
+            except self.retry_on as error:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2**attempt
+                logger.warning(
+                    "Task %s failed (%s), retrying in %.1fs.",
+                    task,
+                    error,
+                    delay,
+                )
+                time.sleep(delay)
+
+    def map(
+        self,
+        fn: Callable,
+        tasks: Iterable,
+        ordered: bool = True,
+    ) -> Iterator[tuple]:
+        """
+        Yields (task, result) pairs, in task order if `ordered` is set and
+        otherwise as soon as each task finishes.
+        """
+        tasks = iter(tasks)
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+
+            def fill():
+                while len(in_flight) < self.max_in_flight:
+                    task = next(tasks, _NO_TASK)
+                    if task is _NO_TASK:
+                        return
+                    in_flight.append((task, pool.submit(self._run, fn, task)))
+
+            try:
+                fill()
+                while in_flight:
+                    if ordered:
+                        finished = [in_flight.popleft()]
+                    else:
+                        wait(
+                            [future for _, future in in_flight],
+                            return_when=FIRST_COMPLETED,
+                        )
+                        finished = [
+                            (task, future)
+                            for task, future in in_flight
+                            if future.done()
+                        ]
+                        for item in finished:
+                            in_flight.remove(item)
+                    for task, future in finished:
+                        yield task, future.result()
+                    fill()
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
@@ -0,0 +1,236 @@
+"""Sidecar index of the space and time covered by GEDI granules."""
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+# Beams of a GEDI granule, the first four are coverage beams and the last
+# four full power beams.
+BEAMS = ["BEAM0000", "BEAM0001", "BEAM0010", "BEAM0011",
+         "BEAM0101", "BEAM0110", "BEAM1000", "BEAM1011"]
+
+# GEDI delta_time counts the seconds since this epoch.
+GEDI_EPOCH = np.datetime64("2018-01-01T00:00:00")
+
+# Number of shots read from a dataset at a time.
+BLOCK_ROWS = 100_000
+
+# Number of consecutive shots of a beam indexed as one track segment,
+# about 600 km of a track.
+SEGMENT_ROWS = 10_000
+
+
+def beam_dataset(beam: h5py.Group, field: str) -> h5py.Dataset:
+    """Returns the dataset of a field, in the beam or its geolocation."""
+    if field in beam:
+        return beam[field]
+    return beam["geolocation"][field]
+
+
+def read_masked(
+    dataset: h5py.Dataset,
+    mask: np.ndarray,
+    block_rows: int = BLOCK_ROWS,
+) -> np.ndarray:
+    """
+    Reads the rows of a dataset selected by the mask. Only the blocks of
+    `block_rows` rows holding selected shots are read, each from its first
+    to its last selected shot.
+    """
+    parts = []
+    for start in range(0, len(mask), block_rows):
+        rows = np.flatnonzero(mask[start:start + block_rows])
+        if len(rows) == 0:
+            continue
+        first, last = start + rows[0], start + rows[-1] + 1
+        parts.append(dataset[first:last][mask[first:last]])
+    if not parts:
+        return np.empty((0, *dataset.shape[1:]), dataset.dtype)
+    return np.concatenate(parts)
+
+
+def gedi_delta_time(time: str) -> float:
+    """Returns a time as seconds since the GEDI epoch."""
+    delta = np.datetime64(pd.Timestamp(time).to_datetime64()) - GEDI_EPOCH
+    return delta / np.timedelta64(1, "s")
+
+
+def granule_segments(path: str, segment_rows: int = SEGMENT_ROWS) -> list:
+    """
+    Returns the track segments of all beams of a granule, as tuples of
+    (beam, first_row, last_row, min_lon, max_lon, min_lat, max_lat,
+    min_time, max_time). Rows are [first_row, last_row), times are GEDI
+    delta_times, and segments without valid coordinates are left out.
+    """
+    segments = []
+    with h5py.File(path, "r") as granule:
+        for beam in BEAMS:
+            if beam not in granule:
+                continue
+            lon = beam_dataset(granule[beam], "lon_lowestmode")[:]
+            lat = beam_dataset(granule[beam], "lat_lowestmode")[:]
+            time = beam_dataset(granule[beam], "delta_time")[:]
+            valid = np.isfinite(lon) & np.isfinite(lat) \
+                & (np.abs(lon) <= 180) & (np.abs(lat) <= 90)
+            for first in range(0, len(lon), segment_rows):
+                rows = slice(first, first + segment_rows)
+                ok = valid[rows]
+                if not ok.any():
+                    continue
+                segments.append((
+                    beam, first, min(first + segment_rows, len(lon)),
+                    lon[rows][ok].min(), lon[rows][ok].max(),
+                    lat[rows][ok].min(), lat[rows][ok].max(),
+                    time[rows].min(), time[rows].max(),
+                ))
+    return segments
+
+
+class GranuleIndex(object):
+    """
+    Indexes the lon/lat bounding boxes and time ranges of the track
+    segments of GEDI granules in an sqlite R*Tree, so that the granules,
+    beams and rows covering an area and time range are found without
+    opening any granule.
+
+    The R*Tree stores 32 bit floats rounded outwards, so queries may
+    return a few segments just outside of the requested bounds, but never
+    miss one inside.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS granules ("
+            "granule_id INTEGER PRIMARY KEY, path TEXT UNIQUE, "
+            "size INTEGER, mtime REAL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "segment_id INTEGER PRIMARY KEY, granule_id INTEGER, "
+            "beam TEXT, first_row INTEGER, last_row INTEGER)"
+        )
+        self.connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS segment_bounds USING rtree("
+            "segment_id, min_lon, max_lon, min_lat, max_lat, "
+            "min_time, max_time)"
+        )
+        self.connection.commit()
+
+    def _is_indexed(self, path: str) -> bool:
+        """Returns whether the granule is indexed and unchanged since."""
+        row = self.connection.execute(
+            "SELECT size, mtime FROM granules WHERE path = ?", (path,)
+        ).fetchone()
+        stat = os.stat(path)
+        return row is not None and tuple(row) == (stat.st_size,
+                                                  stat.st_mtime)
+
+    def add(self, path: str, segments: list):
+        """Records the segments of a granule, replacing older ones."""
+        path = os.path.abspath(path)
+        self.remove(path)
+        stat = os.stat(path)
+        granule_id = self.connection.execute(
+            "INSERT INTO granules (path, size, mtime) VALUES (?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime),
+        ).lastrowid
+        for beam, first, last, *bounds in segments:
+            segment_id = self.connection.execute(
+                "INSERT INTO segments (granule_id, beam, first_row, last_row) "
+                "VALUES (?, ?, ?, ?)",
+                (granule_id, beam, int(first), int(last)),
+            ).lastrowid
+            self.connection.execute(
+                "INSERT INTO segment_bounds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (segment_id, *map(float, bounds)),
+            )
+        self.connection.commit()
+
+    def remove(self, path: str):
+        """Removes a granule and its segments from the index."""
+        path = os.path.abspath(path)
+        self.connection.execute(
+            "DELETE FROM segment_bounds WHERE segment_id IN ("
+            "SELECT segment_id FROM segments JOIN granules USING "
+            "(granule_id) WHERE path = ?)",
+            (path,),
+        )
+        self.connection.execute(
+            "DELETE FROM segments WHERE granule_id IN ("
+            "SELECT granule_id FROM granules WHERE path = ?)",
+            (path,),
+        )
+        self.connection.execute("DELETE FROM granules WHERE path = ?",
+                                (path,))
+
+    def update(
+        self,
+        paths: list,
+        jobs: int = 1,
+        segment_rows: int = SEGMENT_ROWS,
+    ) -> int:
+        """
+        Indexes the granules that are new or changed since they were
+        indexed, reading `jobs` of them at a time. Returns how many were
+        indexed.
+        """
+        paths = [
+            os.path.abspath(path) for path in paths
+            if not self._is_indexed(os.path.abspath(path))
+        ]
+        read = partial(granule_segments, segment_rows=segment_rows)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for path, segments in zip(paths, executor.map(read, paths)):
+                self.add(path, segments)
+                logger.debug("Indexed %d segments of %s",
+                             len(segments), path)
+        logger.info("Indexed %d granules in %s", len(paths), self.path)
+        return len(paths)
+
+    def segments(
+        self,
+        bounds,
+        start_time: str = None,
+        end_time: str = None,
+    ) -> pd.DataFrame:
+        """
+        Returns the segments whose bounding box intersects the bounds
+        [min_lon, min_lat, max_lon, max_lat] and whose time range
+        intersects [start_time, end_time), as a dataframe of path, beam,
+        first_row and last_row.
+        """
+        min_time = -np.inf if start_time is None \
+            else gedi_delta_time(start_time)
+        max_time = np.inf if end_time is None else gedi_delta_time(end_time)
+        return pd.read_sql_query(
+            "SELECT path, beam, first_row, last_row "
+            "FROM segment_bounds JOIN segments USING (segment_id) "
+            "JOIN granules USING (granule_id) "
+            "WHERE max_lon >= ? and min_lon <= ? and max_lat >= ? "
+            "and min_lat <= ? and max_time >= ? and min_time < ? "
+            "ORDER BY path, beam, first_row",
+            self.connection,
+            params=(bounds[0], bounds[2], bounds[1], bounds[3],
+                    min_time, max_time),
+        )
+
+    def granules(
+        self,
+        bounds,
+        start_time: str = None,
+        end_time: str = None,
+    ) -> list:
+        """Returns the paths of the granules intersecting bounds and time."""
+        return self.segments(bounds, start_time, end_time) \
+            .path.unique().tolist()
@@ -0,0 +1,604 @@
+"""Embedded DuckDB warehouse of extracted GEDI shots."""
+import os
+import threading
+from datetime import timedelta
+from typing import Callable, Iterator
+
+import duckdb
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from polygon_join import assign_polygons
+from utils.constants import LOCAL_DB_FILE, WGS84
+from utils.gedi_database import (
+    DATE_TRUNC_CADENCES,
+    DEFAULT_CHUNK_ROWS,
+    GROUP_KEYS,
+    LON_LAT_COLUMNS,
+    gedi_points,
+    gedi_sql_reducer,
+)
+from utils.logging_util import get_logger
+from utils.shot_index import ShotIndex
+
+logger = get_logger(__file__)
+
+# Columns the shots of a product need to be served locally.
+REQUIRED_COLUMNS = ["shot_number", "absolute_time", *LON_LAT_COLUMNS]
+
+# Columns the query scripts derive from the shots, which are not loaded.
+DERIVED_COLUMNS = [
+    "geometry",
+    "polygon_id",
+    "time_bucket",
+    "timestamp",
+    "year",
+    "month",
+    "polygon_spei",
+]
+
+# Pandas equivalents of the SQL_REDUCERS of the GEDI database.
+PANDAS_REDUCERS = {
+    "count": "count",
+    "mean": "mean",
+    "stddev": "std",
+    "min": "min",
+    "max": "max",
+    "sum": "sum",
+    "median": "median",
+}
+
+
+def local_sql_bounds(bounds) -> str:
+    """Returns the condition that the shot lies in (xmin, ymin, xmax, ymax)."""
+    lon, lat = LON_LAT_COLUMNS
+    xmin, ymin, xmax, ymax = bounds
+    return (
+        f"{lon} between {xmin} and {xmax} and {lat} between {ymin} and {ymax}"
+    )
+
+
+def local_sql_query(
+    table_name: str,
+    columns: str = "*",
+    bounds: tuple = None,
+    start_time: str = None,
+    end_time: str = None,
+    limit: int = None,
+    force: bool = False,
+    conditions: list = None,
+):
+    """
+    The DuckDB counterpart of `gedi_sql_query`. Shots are stored without
+    geometries, so the spatial condition is the lon/lat bounding box of
+    the geometry, which is tested exactly after loading the candidates.
+    """
+    conditions = list(conditions or [])
+    # Temporal conditions, [start_time, end_time) like gedi_sql_query
+    if start_time is not None and end_time is not None:
+        conditions += [
+            f"absolute_time >= '{start_time}'",
+            f"absolute_time < '{end_time}'",
+        ]
+    # Spatial conditions
+    if bounds is not None:
+        conditions += [local_sql_bounds(bounds)]
+    condition = (
+        f" WHERE {' and '.join(conditions)}" if len(conditions) > 0 else ""
+    )
+    limits = f" LIMIT {limit}" if limit is not None else ""
+
+    if not force and condition == "" and limit is None:
+        raise UserWarning(
+            "Warning! This will load the entire table. \
+            To proceed set `force`=True."
+        )
+
+    if columns != "*":
+        columns = ", ".join(columns)
+    return f"SELECT {columns} FROM {table_name}" + condition + limits
+
+
+def local_time_bucket(
+    times: pd.Series,
+    cadence,
+    origin: str,
+) -> pd.Series:
+    """
+    The pandas counterpart of `gedi_sql_time_bucket`. Tz-aware times are
+    bucketed in UTC, into naive buckets.
+    """
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+    if isinstance(cadence, str):
+        if cadence not in DATE_TRUNC_CADENCES:
+            raise ValueError(
+                f"Unsupported cadence {cadence}. \
+                Must be one of {DATE_TRUNC_CADENCES} or a timedelta."
+            )
+        if cadence == "day":
+            return times.dt.floor("D")
+        # Postgres weeks start on monday.
+        period = {"week": "W-SUN", "month": "M", "quarter": "Q", "year": "Y"}
+        return times.dt.to_period(period[cadence]).dt.start_time
+
+    if not isinstance(cadence, timedelta):
+        cadence = timedelta(days=cadence)
+    if cadence.total_seconds() <= 0:
+        raise ValueError("Cadence must be a positive time interval.")
+    origin = pd.Timestamp(origin)
+    return origin + ((times - origin) // cadence) * cadence
+
+
+class LocalGediDatabase(object):
+    """
+    Local stand-in for GediDatabase over an embedded DuckDB file, holding
+    shots extracted from the GEDI database with `load` or `load_files`.
+
+    Shots are stored with their lon/lat columns instead of PostGIS
+    geometries. Spatial filters select the candidates in the bounding box
+    in DuckDB and test them exactly with geopandas. Results carry the
+    same columns as those of GediDatabase, `geometry` is only available
+    through `use_geopandas`.
+    """
+
+    def __init__(self, path: str = LOCAL_DB_FILE, read_only: bool = False):
+        self.path = str(path)
+        if not read_only:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+        self.connection = duckdb.connect(self.path, read_only=read_only)
+        # Loads are serialised, queries run on their own cursors.
+        self.lock = threading.Lock()
+        # Shot numbers of every loaded table, read on its first load.
+        self.shot_indexes = {}
+
+    def _cursor(self):
+        return self.connection.cursor()
+
+    def _table_columns(self, table_name: str) -> list:
+        rows = self._cursor().execute(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = ? ORDER BY ordinal_position",
+            [table_name],
+        ).fetchall()
+        return [column for column, in rows]
+
+    def _check_columns(self, table_name: str, columns):
+        """Raises if the table or any of the columns is not loaded."""
+        allowed_cols = set(self._table_columns(table_name))
+        if not allowed_cols:
+            raise ValueError(f"Table `{table_name}` has not been loaded.")
+
+        if columns != "*":
+            for column in columns:
+                if column not in allowed_cols:
+                    raise ValueError(
+                        f"`{column}` not allowed. \
+                            Must be one of {allowed_cols}"
+                    )
+
+    @staticmethod
+    def _shot_columns(columns, spatial: bool):
+        """
+        Returns the stored columns to select, including lon/lat if the
+        shots are filtered or built spatially.
+        """
+        if columns == "*":
+            return columns
+        columns = [column for column in columns if column != "geometry"]
+        if spatial:
+            columns += [
+                column for column in LON_LAT_COLUMNS if column not in columns
+            ]
+        return columns
+
+    def _shot_index(self, table_name: str) -> ShotIndex:
+        if table_name not in self.shot_indexes:
+            shot_numbers = []
+            if self._table_columns(table_name):
+                shot_numbers = self._cursor().execute(
+                    f"SELECT shot_number FROM {table_name}"
+                ).fetchnumpy()["shot_number"]
+            self.shot_indexes[table_name] = ShotIndex(shot_numbers)
+        return self.shot_indexes[table_name]
+
+    def load(self, table_name: str, df: pd.DataFrame) -> int:
+        """
+        Appends the shots of `df` to the table and returns the number of
+        new shots. Columns derived by the query scripts are dropped, and
+        shots whose `shot_number` is already loaded are skipped.
+        """
+        missing = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+        if missing:
+            raise ValueError(f"Shots to load lack the columns {missing}.")
+        df = pd.DataFrame(df.drop(
+            columns=[col for col in DERIVED_COLUMNS if col in df.columns]
+        ))
+        df = df.loc[:, ~df.columns.str.startswith("Unnamed")]
+        # Extracts from postgres carry tz-aware times, which are stored as
+        # naive UTC like the rest.
+        df["absolute_time"] = pd.to_datetime(
+            df["absolute_time"], utc=True
+        ).dt.tz_localize(None)
+
+        with self.lock:
+            # Only shots not loaded before, found without scanning the table.
+            shot_index = self._shot_index(table_name)
+            df = shot_index.dedup(df)
+            cursor = self._cursor()
+            cursor.register("batch", df)
+            columns = self._table_columns(table_name)
+            if not columns:
+                cursor.execute(
+                    f"CREATE TABLE {table_name} AS SELECT * FROM batch LIMIT 0"
+                )
+            # Columns queried for the first time are added to the table.
+            types = cursor.execute("DESCRIBE batch").fetchall()
+            for column, column_type, *_ in types:
+                if columns and column not in columns:
+                    cursor.execute(
+                        f"ALTER TABLE {table_name} "
+                        f"ADD COLUMN {column} {column_type}"
+                    )
+            names = ", ".join(df.columns)
+            cursor.execute(
+                f"INSERT INTO {table_name} ({names}) SELECT {names} FROM batch"
+            )
+            cursor.unregister("batch")
+            shot_index.add(df["shot_number"].values)
+        logger.info("Loaded %d shots into %s", df.shape[0], table_name)
+        return df.shape[0]
+
+    def load_files(self, table_name: str, paths: list) -> int:
+        """
+        Loads csv or parquet shards written by the query scripts, which
+        must have been queried with `shot_number` and `absolute_time`.
+        """
+        n_shots = 0
+        for path in paths:
+            if str(path).endswith(".parquet"):
+                df = pd.read_parquet(path)
+            else:
+                df = pd.read_csv(path, index_col=0)
+            n_shots += self.load(table_name, df)
+        return n_shots
+
+    def _read(
+        self,
+        sql_query: str,
+        chunk_rows: int = None,
+    ) -> Iterator[pd.DataFrame]:
+        logger.debug("SQL Query: %s", sql_query)
+        cursor = self._cursor().execute(sql_query)
+        if chunk_rows is None:
+            yield cursor.fetchdf()
+            return
+        for batch in cursor.fetch_record_batch(chunk_rows):
+            yield batch.to_pandas()
+
+    def _query_chunks(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        use_geopandas: bool = False,
+        force: bool = False,
+        conditions: list = None,
+        chunk_rows: int = None,
+    ) -> Iterator[pd.DataFrame]:
+        self._check_columns(table_name, columns)
+        shape, bounds = None, None
+        if geometry is not None:
+            geometry = gpd.GeoSeries(geometry.geometry.values, crs=crs)
+            geometry = geometry.to_crs(WGS84)
+            # Like the GEDI database, only the first geometry is used.
+            shape, bounds = geometry.values[0], geometry.values[:1].bounds[0]
+
+        sql_query = local_sql_query(
+            table_name,
+            columns=self._shot_columns(
+                columns, geometry is not None or use_geopandas),
+            bounds=bounds,
+            start_time=start_time,
+            end_time=end_time,
+            # Candidates in the bounding box may still be outside.
+            limit=limit if shape is None else None,
+            force=force,
+            conditions=conditions,
+        )
+        n_rows = 0
+        for chunk in self._read(sql_query, chunk_rows):
+            if shape is not None:
+                points = gpd.points_from_xy(*chunk[LON_LAT_COLUMNS].values.T)
+                chunk = chunk.loc[points.intersects(shape)]
+                if limit is not None:
+                    chunk = chunk.iloc[:limit - n_rows]
+            n_rows += chunk.shape[0]
+            yield gedi_points(chunk) if use_geopandas else chunk
+            if limit is not None and n_rows >= limit:
+                return
+
+    def query(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        use_geopandas: bool = False,
+        force: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+    ) -> pd.DataFrame:
+        """
+        Queries the loaded shots of the table, see `GediDatabase.query`.
+        Geometries are always built locally from lon/lat, so
+        `lazy_geometry` makes no difference.
+        """
+        return pd.concat(
+            self._query_chunks(
+                table_name,
+                columns=columns,
+                geometry=geometry,
+                crs=crs,
+                start_time=start_time,
+                end_time=end_time,
+                limit=limit,
+                use_geopandas=use_geopandas,
+                force=force,
+                conditions=conditions,
+            )
+        )
+
+    def query_iter(
+        self,
+        table_name: str,
+        columns: str = "*",
+        geometry: gpd.GeoDataFrame = None,
+        crs: str = WGS84,
+        start_time: str = None,
+        end_time: str = None,
+        limit: int = None,
+        use_geopandas: bool = False,
+        force: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    ) -> Iterator[pd.DataFrame]:
+        """Same as `query`, but streams the result in `chunk_rows` chunks."""
+        return self._query_chunks(
+            table_name,
+            columns=columns,
+            geometry=geometry,
+            crs=crs,
+            start_time=start_time,
+            end_time=end_time,
+            limit=limit,
+            use_geopandas=use_geopandas,
+            force=force,
+            conditions=conditions,
+            chunk_rows=chunk_rows,
+        )
+
+    def _polygons_chunks(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        use_geopandas: bool = False,
+        conditions: list = None,
+        chunk_rows: int = None,
+    ) -> Iterator[pd.DataFrame]:
+        self._check_columns(table_name, columns)
+        # The shots of [start_time, end_time) in the polygons' bounding box.
+        conditions = [
+            f"absolute_time >= '{start_time}'",
+            f"absolute_time < '{end_time}'",
+            local_sql_bounds(polygons.to_crs(WGS84).total_bounds),
+        ] + (conditions or [])
+        selected = self._shot_columns(columns, spatial=True)
+        if selected != "*" and "absolute_time" not in selected:
+            selected = selected + ["absolute_time"]
+        sql_query = local_sql_query(
+            table_name, columns=selected, conditions=conditions
+        )
+
+        for chunk in self._read(sql_query, chunk_rows):
+            chunk = assign_polygons(chunk, polygons, id_column)
+            chunk["time_bucket"] = local_time_bucket(
+                chunk["absolute_time"], cadence, origin or start_time
+            )
+            if columns != "*" and "absolute_time" not in columns:
+                chunk = chunk.drop(columns=["absolute_time"])
+            yield gedi_points(chunk) if use_geopandas else chunk
+
+    def query_polygons(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        use_geopandas: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+    ) -> pd.DataFrame:
+        """
+        Queries the loaded shots of all polygons and all time windows at
+        once, see `GediDatabase.query_polygons`.
+        """
+        return pd.concat(
+            self._polygons_chunks(
+                table_name,
+                polygons,
+                start_time=start_time,
+                end_time=end_time,
+                columns=columns,
+                cadence=cadence,
+                origin=origin,
+                id_column=id_column,
+                use_geopandas=use_geopandas,
+                conditions=conditions,
+            )
+        )
+
+    def query_polygons_iter(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        use_geopandas: bool = False,
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Same as `query_polygons`, but streams the result in `chunk_rows`
+        chunks.
+        """
+        return self._polygons_chunks(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            use_geopandas=use_geopandas,
+            conditions=conditions,
+            chunk_rows=chunk_rows,
+        )
+
+    def estimate_rows(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        conditions: list = None,
+        id_column: str = "id",
+        method: str = "explain",
+    ) -> int:
+        """
+        Counts the loaded shots in the bounding box of the polygons, which
+        is cheap enough locally for both methods.
+        """
+        conditions = [
+            f"absolute_time >= '{start_time}'",
+            f"absolute_time < '{end_time}'",
+            local_sql_bounds(polygons.to_crs(WGS84).total_bounds),
+        ] + (conditions or [])
+        return self._cursor().execute(
+            f"SELECT count(*) FROM {table_name} "
+            f"WHERE {' and '.join(conditions)}"
+        ).fetchone()[0]
+
+    def export_polygons(
+        self,
+        path: str,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        start_time: str,
+        end_time: str,
+        columns: list = "*",
+        cadence="month",
+        origin: str = None,
+        id_column: str = "id",
+        lazy_geometry: bool = False,
+        conditions: list = None,
+        transform: Callable = None,
+        **kwargs,
+    ) -> int:
+        """
+        Writes the result of `query_polygons` into a parquet file at
+        `path`, and returns the number of rows written. The result is
+        passed through `transform` as an Arrow table, if given.
+        """
+        result = self.query_polygons(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            conditions=conditions,
+        )
+        table = pa.Table.from_pandas(result, preserve_index=False)
+        if transform is not None:
+            table = transform(table)
+        pq.write_table(table, path)
+        return table.num_rows
+
+    def aggregate(
+        self,
+        table_name: str,
+        polygons: gpd.GeoDataFrame,
+        measures: dict,
+        start_time: str,
+        end_time: str,
+        group_by: list = ["polygon_id", "year", "month"],
+        cadence="month",
+        origin: str = None,
+        conditions: list = None,
+        id_column: str = "id",
+    ) -> pd.DataFrame:
+        """
+        Reduces the loaded shots of the polygons per group, see
+        `GediDatabase.aggregate`.
+        """
+        shots = self.query_polygons(
+            table_name,
+            polygons,
+            start_time=start_time,
+            end_time=end_time,
+            columns=[*measures, "absolute_time"],
+            cadence=cadence,
+            origin=origin,
+            id_column=id_column,
+            conditions=conditions,
+        )
+        for key in group_by:
+            if key not in [*GROUP_KEYS, "time_bucket"]:
+                raise ValueError(
+                    f"Unsupported group key {key}. \
+                    Must be one of {list(GROUP_KEYS) + ['time_bucket']}."
+                )
+        for key in ["year", "month", "day"]:
+            shots[key] = getattr(shots["absolute_time"].dt, key)
+
+        aggregates = {}
+        for column, reducers in measures.items():
+            for reducer in reducers:
+                # Validates the reducer and names it like the database does.
+                _, name = gedi_sql_reducer(column, reducer)
+                if isinstance(reducer, float):
+                    aggregates[name] = (column, lambda s, q=reducer:
+                                        s.quantile(q))
+                else:
+                    aggregates[name] = (column, PANDAS_REDUCERS[reducer])
+        return shots.groupby(group_by, as_index=False).agg(**aggregates)
@@ -0,0 +1,182 @@
+"""Content-addressed on-disk cache for GEDI database query results."""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+import geopandas as gpd
+import pandas as pd
+
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+
+def normalise_sql(sql_query: str) -> str:
+    """Collapses all whitespace, so formatting does not change the key."""
+    return " ".join(sql_query.split())
+
+
+class QueryCache(object):
+    """
+    Caches query results as parquet files named by the hash of the query.
+
+    The cache holds at most `max_bytes` of results, evicting the least
+    recently used ones first, and entries older than `ttl` are dropped when
+    they are read. Hits, misses and evictions are counted in `stats`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = 10 * 2**30,
+        ttl: timedelta = timedelta(days=30),
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), check_same_thread=False
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+            "n_bytes INTEGER, is_geo INTEGER, created REAL, accessed REAL)"
+        )
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(sql_query: str, columns="*", use_geopandas: bool = False) -> str:
+        """Returns the cache key of a query and its selected columns."""
+        if columns != "*":
+            columns = ",".join(sorted(columns))
+        content = f"{normalise_sql(sql_query)}|{columns}|{use_geopandas}"
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _remove(self, key: str):
+        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if os.path.exists(self._path(key)):
+            os.remove(self._path(key))
+
+    def get(self, key: str) -> pd.DataFrame:
+        """Returns the cached result, or None on a miss."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT is_geo, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is not None and now - row[1] > self.ttl.total_seconds():
+                self._remove(key)
+                self.connection.commit()
+                row = None
+            if row is None or not os.path.exists(self._path(key)):
+                self.misses += 1
+                return None
+
+            self.connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self.connection.commit()
+        try:
+            if row[0]:
+                df = gpd.read_parquet(self._path(key))
+            else:
+                df = pd.read_parquet(self._path(key))
+        except FileNotFoundError:
+            # Evicted by another worker since it was looked up.
+            df = None
+        with self.lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return df
+
+    def put(self, key: str, df: pd.DataFrame):
+        """
+        Stores a result and evicts old entries beyond `max_bytes`.
+
+        Workers that missed on the same key each write their own temporary
+        file, which replaces the cached one as a whole, so `get` never
+        reads a partially written result.
+        """
+        path = self._path(key)
+        partial = f"{path}.{os.getpid()}-{threading.get_ident()}.part"
+        df.to_parquet(partial)
+        n_bytes = os.path.getsize(partial)
+        os.replace(partial, path)
+
+        # The entry is upserted and the cache evicted in one transaction.
+        with self.lock, self.connection:
+            now = time.time()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    n_bytes,
+                    isinstance(df, gpd.GeoDataFrame),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+
+    def _evict(self):
+        """
+        Drops the expired entries, then the least recently used ones until
+        the cache fits.
+        """
+        expired = self.connection.execute(
+            "SELECT key FROM entries WHERE created < ?",
+            (time.time() - self.ttl.total_seconds(),),
+        ).fetchall()
+        for key, in expired:
+            self._remove(key)
+            logger.debug("Dropped expired query %s", key)
+
+        total_bytes = self.connection.execute(
+            "SELECT coalesce(sum(n_bytes), 0) FROM entries"
+        ).fetchone()[0]
+        entries = self.connection.execute(
+            "SELECT key, n_bytes FROM entries ORDER BY accessed"
+        ).fetchall()
+        for key, n_bytes in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(key)
+            total_bytes -= n_bytes
+            self.evictions += 1
+            logger.debug("Evicted cached query %s", key)
+
+    def clear(self):
+        """Removes all cached results."""
+        with self.lock:
+            for key, in self.connection.execute(
+                "SELECT key FROM entries"
+            ).fetchall():
+                self._remove(key)
+            self.connection.commit()
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counts and the size of the cache."""
+        with self.lock:
+            n_entries, n_bytes = self.connection.execute(
+                "SELECT count(*), coalesce(sum(n_bytes), 0) FROM entries"
+            ).fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": n_entries,
+            "bytes": n_bytes,
+        }
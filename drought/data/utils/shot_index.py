@@ -0,0 +1,97 @@
+"""Sorted index of GEDI shot numbers, for deduplicating extracted shots."""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+
+class ShotIndex(object):
+    """
+    Set of shot numbers kept as a sorted, unique int64 array.
+
+    Membership is tested for a whole batch at once with a binary search,
+    so testing or adding m shots to an index of n shots costs
+    O(m log n) comparisons plus one O(n + m) copy when adding.
+    """
+
+    def __init__(self, shot_numbers=None):
+        if shot_numbers is None:
+            shot_numbers = []
+        self.shot_numbers = np.unique(np.asarray(shot_numbers, np.int64))
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False) -> "ShotIndex":
+        """Loads an index saved with `save`, or an empty one if missing."""
+        index = cls()
+        if os.path.exists(path):
+            # The saved array is sorted and unique already.
+            index.shot_numbers = np.load(path, mmap_mode="r" if mmap else None)
+        return index
+
+    def save(self, path: str):
+        """Saves the index as a .npy file."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.part", "wb") as f:
+            np.save(f, self.shot_numbers)
+        os.replace(f"{path}.part", path)
+        logger.debug("Saved %d shot numbers to %s", len(self), path)
+
+    def __len__(self) -> int:
+        return len(self.shot_numbers)
+
+    def contains(self, shot_numbers) -> np.ndarray:
+        """Returns a boolean mask of the shots that are in the index."""
+        shot_numbers = np.asarray(shot_numbers, np.int64)
+        indexed = self.shot_numbers
+        if len(indexed) == 0:
+            return np.zeros(len(shot_numbers), bool)
+        positions = np.searchsorted(indexed, shot_numbers)
+        positions[positions == len(indexed)] = len(indexed) - 1
+        return indexed[positions] == shot_numbers
+
+    def new_mask(self, shot_numbers) -> np.ndarray:
+        """
+        Returns a boolean mask of the shots that are not in the index,
+        counting only the first of shots repeated within the batch.
+        """
+        shot_numbers = np.asarray(shot_numbers, np.int64)
+        first = np.zeros(len(shot_numbers), bool)
+        first[np.unique(shot_numbers, return_index=True)[1]] = True
+        return first & ~self.contains(shot_numbers)
+
+    def add(self, shot_numbers) -> int:
+        """Adds the shots to the index and returns how many were new."""
+        with self.lock:
+            new = np.unique(np.asarray(shot_numbers, np.int64))
+            new = new[~self.contains(new)]
+            if len(new):
+                self.shot_numbers = np.insert(
+                    self.shot_numbers,
+                    np.searchsorted(self.shot_numbers, new),
+                    new,
+                )
+        return len(new)
+
+    def dedup(
+        self,
+        df: pd.DataFrame,
+        column: str = "shot_number",
+    ) -> pd.DataFrame:
+        """Returns the rows of shots that are not in the index yet."""
+        return df.loc[self.new_mask(df[column].values)]
+
+    def merge(
+        self,
+        df: pd.DataFrame,
+        column: str = "shot_number",
+    ) -> pd.DataFrame:
+        """Returns the rows of new shots and adds them to the index."""
+        df = self.dedup(df, column)
+        self.add(df[column].values)
+        return df
@@ -0,0 +1,73 @@
+"""File-backed catalog of the column names of the GEDI database tables."""
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+
+class TableCatalog(object):
+    """
+    Remembers the columns of every reflected table in a json file, so a
+    new GediDatabase does not have to reflect the schema again.
+
+    The file is ignored if it was written for another `database`, for
+    another `schema_version` (bump it whenever the tables change), or if
+    it was last modified more than `max_age` ago.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        database: str = "",
+        schema_version: int = 1,
+        max_age: timedelta = timedelta(days=7),
+    ):
+        self.path = path
+        self.database = database
+        self.schema_version = schema_version
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.tables = self._load()
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        age = time.time() - os.path.getmtime(self.path)
+        if age > self.max_age.total_seconds():
+            logger.debug("Table catalog %s expired.", self.path)
+            return {}
+        with open(self.path) as f:
+            catalog = json.load(f)
+        if (
+            catalog.get("database") != self.database
+            or catalog.get("schema_version") != self.schema_version
+        ):
+            logger.debug("Table catalog %s is outdated.", self.path)
+            return {}
+        return {table: set(cols) for table, cols in catalog["tables"].items()}
+
+    def get(self, table_name: str) -> set:
+        """Returns the cached columns of the table, or None if unknown."""
+        return self.tables.get(table_name)
+
+    def put(self, table_name: str, columns: set):
+        """Caches the columns of the table and rewrites the file."""
+        with self.lock:
+            self.tables[table_name] = set(columns)
+            catalog = {
+                "database": self.database,
+                "schema_version": self.schema_version,
+                "tables": {
+                    table: sorted(cols) for table, cols in self.tables.items()
+                },
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            with open(f"{self.path}.part", "w") as f:
+                json.dump(catalog, f)
+            os.replace(f"{self.path}.part", self.path)
@@ -0,0 +1,183 @@
+"""Manifest of completed GEDI extraction tasks, for resumable queries."""
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+
+from utils.logging_util import get_logger
+
+logger = get_logger(__file__)
+
+
+class TaskManifest(object):
+    """
+    Records every completed (product, polygon, window, fields) extraction
+    task together with its row count and output shard in a sqlite file.
+
+    Shard paths are stored relative to the directory of the manifest, so
+    the directory can be moved as a whole.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(self.directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "product TEXT, polygon_id INTEGER, window_start TEXT, "
+            "window_end TEXT, fields TEXT, n_rows INTEGER, shard TEXT, "
+            "completed_at TEXT, PRIMARY KEY "
+            "(product, polygon_id, window_start, window_end, fields))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS plans ("
+            "product TEXT, polygon_id INTEGER, fields TEXT, "
+            "window_start TEXT, window_end TEXT, PRIMARY KEY "
+            "(product, polygon_id, fields, window_start))"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def fields_key(fields: list) -> str:
+        """Returns the key tasks of the given fields are recorded under."""
+        return ",".join(sorted(fields))
+
+    def is_done(
+        self,
+        product: str,
+        polygon_id: int,
+        window: tuple,
+        fields: list,
+    ) -> bool:
+        """Returns whether the task has been completed before."""
+        row = self.connection.execute(
+            "SELECT 1 FROM tasks WHERE product = ? and polygon_id = ? "
+            "and window_start = ? and window_end = ? and fields = ?",
+            (product, int(polygon_id), *window, self.fields_key(fields)),
+        ).fetchone()
+        return row is not None
+
+    def record(
+        self,
+        product: str,
+        polygon_id: int,
+        window: tuple,
+        fields: list,
+        n_rows: int,
+        shard: str = None,
+    ):
+        """Marks the task as completed, `shard` is None if it was empty."""
+        if shard is not None:
+            shard = os.path.relpath(shard, self.directory)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                product,
+                int(polygon_id),
+                *window,
+                self.fields_key(fields),
+                int(n_rows),
+                shard,
+                datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+        self.connection.commit()
+
+    def last_window_end(
+        self,
+        product: str,
+        polygon_id: int,
+        fields: list,
+    ) -> str:
+        """
+        Returns the end of the latest completed window of the polygon, if
+        any, so every polygon resumes from its own last task.
+        """
+        row = self.connection.execute(
+            "SELECT max(window_end) FROM tasks "
+            "WHERE product = ? and polygon_id = ? and fields = ?",
+            (product, int(polygon_id), self.fields_key(fields)),
+        ).fetchone()
+        return row[0]
+
+    def planned_windows(
+        self,
+        product: str,
+        polygon_id: int,
+        fields: list,
+        start_time: str,
+        end_time: str,
+    ) -> list:
+        """Returns the planned windows inside [start_time, end_time)."""
+        rows = self.connection.execute(
+            "SELECT window_start, window_end FROM plans WHERE product = ? "
+            "and polygon_id = ? and fields = ? and window_start >= ? "
+            "and window_end <= ? ORDER BY window_start",
+            (
+                product,
+                int(polygon_id),
+                self.fields_key(fields),
+                start_time,
+                end_time,
+            ),
+        ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def save_plan(
+        self,
+        product: str,
+        polygon_id: int,
+        fields: list,
+        windows: list,
+    ):
+        """
+        Stores the windows planned for a polygon, so a rerun queries the
+        same windows even if the row estimates changed in between. Earlier
+        plans overlapping the new windows are replaced.
+        """
+        if not windows:
+            return
+        self.connection.execute(
+            "DELETE FROM plans WHERE product = ? and polygon_id = ? "
+            "and fields = ? and window_start < ? and window_end > ?",
+            (
+                product,
+                int(polygon_id),
+                self.fields_key(fields),
+                windows[-1][1],
+                windows[0][0],
+            ),
+        )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?, ?)",
+            [
+                (product, int(polygon_id), self.fields_key(fields), *window)
+                for window in windows
+            ],
+        )
+        self.connection.commit()
+
+    def shards(self, product: str, fields: list) -> list:
+        """Returns the non-empty shards, ordered by window and polygon."""
+        rows = self.connection.execute(
+            "SELECT shard FROM tasks WHERE product = ? and fields = ? "
+            "and shard IS NOT NULL ORDER BY window_start, polygon_id",
+            (product, self.fields_key(fields)),
+        ).fetchall()
+        return [os.path.join(self.directory, shard) for shard, in rows]
+
+
+def concat_csv_shards(shard_paths: list, output_path: str):
+    """
+    Concatenates csv shards with identical columns into one csv, keeping
+    only the header of the first shard.
+    """
+    with open(output_path, "w") as output:
+        for i, shard_path in enumerate(shard_paths):
+            with open(shard_path) as shard:
+                header = shard.readline()
+                if i == 0:
+                    output.write(header)
+                shutil.copyfileobj(shard, output)
+    logger.info("Wrote %d shards to %s", len(shard_paths), output_path)
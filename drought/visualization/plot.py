@@ -1,23 +1,25 @@
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
+from drought.data.cube import cell_frames
 
 sns.set()  # Setting seaborn as default style even if use only matplotlib
 palette = sns.color_palette("hls", 8)
 
+# The plots per polygon take a long DataFrame with a polygon_id column, or
+# an AnalysisCube, from which each polygon's series is read as one chunk.
+
 
 def layered_plot_per_polygon(data: pd.DataFrame, x, bar_y, line_y, title):
     fig, ax = plt.subplots(4, 2, figsize=(30, 24), sharey=False, sharex=True)
     fig.suptitle(title, fontsize=30)
     fig.tight_layout(pad=3.0, h_pad=4.0, w_pad=8.0)
 
-    for i in range(8):
+    # Select polygon from the data. Polygon IDs go from 1 to 8.
+    for i, (polygon_id, polygon_data) in enumerate(
+            cell_frames(data, range(1, 9))):
         subplot = ax[i // 2, i % 2]
 
-        # Select polygon from the data. Polygon IDs go from 1 to 8.
-        polygon_id = i + 1
-        polygon_data = data[data['polygon_id'] == polygon_id]
-
         # Bar plot.
         sns.barplot(polygon_data, x=x, y=bar_y, color='#6BC5ED', ax=subplot)
         subplot.set_title(f"Polygon {polygon_id}", fontsize=20)
@@ -43,13 +45,11 @@ def layered_pointplot_per_polygon(data: pd.DataFrame, x: str, y1: str, y2: str,
     fig.suptitle(title, fontsize=30)
     fig.tight_layout(pad=3.0, h_pad=4.0, w_pad=8.0)
 
-    for i in range(8):
+    # Select polygon from the data. Polygon IDs go from 1 to 8.
+    for i, (polygon_id, polygon_data) in enumerate(
+            cell_frames(data, range(1, 9))):
         subplot = ax[i // 2, i % 2]
 
-        # Select polygon from the data. Polygon IDs go from 1 to 8.
-        polygon_id = i + 1
-        polygon_data = data[data['polygon_id'] == polygon_id]
-
         # Bar plot.
         sns.pointplot(polygon_data, x=x, y=y1, color='#6BC5ED',
                       ax=subplot)
@@ -68,13 +68,11 @@ def barplot_per_polygon(data: pd.DataFrame, x, y, ylabel, title,
     fig.suptitle(title, fontsize=30)
     fig.tight_layout(pad=3.0, h_pad=4.0, w_pad=8.0)
 
-    for i in range(8):
+    # Select polygon from the data. Polygon IDs go from 1 to 8.
+    for i, (polygon_id, polygon_data) in enumerate(
+            cell_frames(data, range(1, 9))):
         subplot = ax[i // 2, i % 2]
 
-        # Select polygon from the data. Polygon IDs go from 1 to 8.
-        polygon_id = i + 1
-        polygon_data = data[data['polygon_id'] == polygon_id]
-
         # Plot.
         sns.barplot(polygon_data, x=x, y=y, color=color, ax=subplot)
         subplot.set_title(f"Polygon {polygon_id}", fontsize=20)
@@ -85,10 +83,8 @@ def barplot_per_polygon(data: pd.DataFrame, x, y, ylabel, title,
 
 def catplot_per_polygon(data: pd.DataFrame, x, y, hue, kind, bands, title,
                         sharey=False) -> plt.figure:
-    for i in range(8):
-        # Select polygon from the data. Polygon IDs go from 1 to 8.
-        polygon_id = i + 1
-        polygon_data = data[data['polygon_id'] == polygon_id]
+    # Select polygon from the data. Polygon IDs go from 1 to 8.
+    for polygon_id, polygon_data in cell_frames(data, range(1, 9)):
         melt = pd.melt(polygon_data[[x, *bands]], id_vars=x,
                        var_name=hue, value_name=y)
 
@@ -105,13 +101,11 @@ def plot_per_polygon(data: pd.DataFrame, title, plot_func, fig=None, ax=None,
         fig.suptitle(title, fontsize=30)
         fig.tight_layout(pad=3.0, h_pad=4.0, w_pad=8.0)
 
-    for i in range(8):
+    # Select polygon from the data. Polygon IDs go from 1 to 8.
+    for i, (polygon_id, polygon_data) in enumerate(
+            cell_frames(data, range(1, 9))):
         subplot = ax[i // 2, i % 2]
 
-        # Select polygon from the data. Polygon IDs go from 1 to 8.
-        polygon_id = i + 1
-        polygon_data = data[data['polygon_id'] == polygon_id]
-
         # Plot.
         if twin_axis:
             plot_func(polygon_data, subplot.twinx())
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# The data modules are imported as a package from the repository root, or
+# as scripts run from drought/data, and read their data paths from the
+# environment.
+ROOT = Path(__file__).parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "drought" / "data"))
+os.environ.setdefault("DATA_PATH", tempfile.gettempdir())
+os.environ.setdefault("USER_PATH", tempfile.gettempdir())
@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+from utils.local_database import LocalGediDatabase
+
+
+def shots(times):
+    return pd.DataFrame({
+        "shot_number": range(len(times)),
+        "absolute_time": times,
+        "lon_lowestmode": 0.5,
+        "lat_lowestmode": 0.5,
+        "pai": 1.0,
+    })
+
+
+def test_load_tz_aware_times(tmp_path):
+    # Shots extracted from postgres have tz-aware times.
+    times = pd.to_datetime([
+        "2019-01-07 23:00:00-02:00",
+        "2019-01-08 01:00:00+00:00",
+        "2019-01-01 00:00:00+00:00",
+    ], utc=True).tz_convert("America/Sao_Paulo")
+    database = LocalGediDatabase(tmp_path / "shots.duckdb")
+    assert database.load("level_2b", shots(times)) == 3
+
+    polygons = gpd.GeoDataFrame(
+        {"id": [1]}, geometry=[box(0, 0, 1, 1)], crs="EPSG:4326")
+    result = database.query_polygons(
+        "level_2b", polygons, "2019-01-01", "2019-02-01",
+        columns=["shot_number", "absolute_time"],
+        cadence=timedelta(days=7), origin="2019-01-01",
+    ).sort_values("shot_number")
+
+    assert result.absolute_time.dt.tz is None
+    assert list(result.absolute_time) == list(pd.to_datetime([
+        "2019-01-08 01:00", "2019-01-08 01:00", "2019-01-01 00:00"]))
+    assert list(result.time_bucket) == list(pd.to_datetime([
+        "2019-01-08", "2019-01-08", "2019-01-01"]))
+
+    monthly = database.query_polygons(
+        "level_2b", polygons, "2019-01-01", "2019-02-01",
+        columns=["shot_number"], cadence="month",
+    )
+    assert (monthly.time_bucket == pd.Timestamp("2019-01-01")).all()
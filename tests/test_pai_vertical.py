@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from drought.data.profile_cube import ProfileAccumulator
+from gedi_vertical_analysis import vertical_stats
+from pai_vertical import bin_heights, pad_profiles, parse_profiles
+
+
+def profile(values, bins=30):
+    return str(list(values) + [0.0] * (bins - len(values)))
+
+
+def test_profiles_are_ground_first(tmp_path):
+    # A cumulative pai_z falls from the ground up to the top of the canopy
+    # at 15 m, its pavd_z is densest between 5 and 10 m.
+    pai_z = parse_profiles(pd.Series([profile([3.0, 2.0, 0.5])]))
+    pavd_z = parse_profiles(pd.Series([profile([0.1, 0.4, 0.2])]))
+
+    assert list(bin_heights()[:3]) == [0, 5, 10]
+    assert vertical_stats(pavd_z, ['max_height'])['max_height'][0] == 5
+    assert vertical_stats(pai_z, ['height_q50'])['height_q50'][0] == 0
+    # Padded profiles start from the top of the canopy instead.
+    assert list(pad_profiles(pai_z)[0, :4]) == [0.5, 2.0, 3.0, 0.0]
+
+    accumulator = ProfileAccumulator(histogram_bins=0).add(
+        [1], [0], {'pai_z': pai_z, 'pavd_z': pavd_z})
+    cube = accumulator.to_cube(str(tmp_path / 'cube'), quantiles=[])
+    assert list(cube.heights) == list(bin_heights())
+    means = cube.to_frame(variables=['pavd_z_mean'])
+    assert means.loc[means.pavd_z_mean.idxmax(), 'height'] == 5
+    assert np.isclose(means.pavd_z_mean.max(), 0.4)